@@ -1,45 +1,143 @@
 
-from kernsecbench.microwave_wrapper import run_linux_benchmark, RAW_LOG_DIR
-from kernsecbench.results_analysis import streams_to_scalar_run_map, parse_lmbench_scalars, parse_sqlite_scalars, parse_lm_streams, parse_inkscape_scalars, parse_glibc_scalars, print_key_figures, analyze_scalars_across_runs, analyze_streams_across_runs
+from kernsecbench.microwave_wrapper import run_linux_benchmark, run_linux_benchmark_agent, run_linux_benchmark_kexec, build_tester, save_run_kernel_logs, is_saved_kernel_log, RAW_LOG_DIR
+from kernsecbench.results_analysis import streams_to_scalar_run_map, parse_lmbench_scalars, parse_sqlite_scalars, parse_lm_streams, parse_inkscape_scalars, parse_glibc_scalars, print_key_figures, analyze_scalars_across_runs, analyze_streams_across_runs, merge_run_map, overhead_confidence
 from kernsecbench.test_configs import kconfig_map, BASE_DEFCONFIG
 from microwave2.utils.kernel_config import Kconfig, generate_kconfig
 from microwave2.utils.utils import Arch
+from microwave2.utils.qemu import QemuResourceAllocator, QemuLease
+from microwave2.testers.pipeline import PipelineExecutor, BuildTimeHistory, RUN_STAGE
 from microwave2.results.kernel_log import RawKernelLogResult, KernelLog
+from microwave2.runners.log_monitor import ABNORMAL_STOPS
+from microwave2.testers.retry import CAUSE_EXTRACTION_ERROR
+from kernsecbench.campaign import CampaignManifest, BUILDING, BOOTING, DONE, FAILED
+from kernsecbench.ingest import find_saved_logs, ingest_logs
 
 
 import os
 
 
-def do_run_all_benchmarks(num_iters):
-    # Run all benchmarks num_iters times
-    for i in range(num_iters):
-        print(f"Running iteration {i + 1} of {num_iters}")
-        do_run_sqlite()
-        do_run_stressng()
-        do_run_lmbench()
-        do_run_glibc_bench()
-        do_run_inkscape()
-        # do_run_ksbench()
+# Same order do_run_all_benchmarks runs them in separately
+BENCH_BUNDLE = ["launch_sqlite.sh", "launch_stressng.sh",
+                "launch_lmbench.sh", "launch_glibc.sh", "launch_inkscape.sh"]
+
+# Manifest state a cell moves to as each tester stage starts
+STAGE_STATES = {"download": BUILDING, "build": BUILDING, "install": BOOTING, "run": BOOTING}
+
+
+def do_run_all_benchmarks(num_iters, max_vms: int = 1, bundle: bool = False, resume: bool = False, samples: int = None,
+                          agent: bool = False, kexec: bool = False):
+    """Run every benchmark on every config, tracking each (config, benchmark, iteration) cell in
+    the campaign manifest.
+    - resume: only rerun cells that never finished (e.g. the previous run died), ignores num_iters
+    - samples: top up every (config, benchmark) to this many successful runs, ignores num_iters
+    - bundle: run every benchmark of an iteration in a single boot per config
+    - agent: boot each config once and run all its cells over the guest agent
+    - kexec: like agent, but one VM for the whole campaign that kexecs from config to config"""
+    manifest = CampaignManifest()
+    config_names = list(kconfig_map.keys())
+
+    if samples is not None:
+        cells = manifest.queue_top_up(config_names, BENCH_BUNDLE, samples)
+    elif resume:
+        cells = manifest.queue_unfinished(config_names, BENCH_BUNDLE)
+    else:
+        cells = manifest.queue_new_iterations(config_names, BENCH_BUNDLE, num_iters)
+
+    print(f"Campaign has {len(cells)} cells to run")
+    run_campaign_cells(cells, manifest, max_vms=max_vms, bundle=bundle, agent=agent, kexec=kexec)
+    print(f"Campaign state: {manifest.summary()}")
+
+
+def run_campaign_cells(cells: list, manifest: CampaignManifest, max_vms: int = 1, bundle: bool = False, agent: bool = False,
+                       kexec: bool = False):
+    """Run (config, launch script, iteration) cells, one iteration at a time.
+    With agent, each config instead boots once and runs all of its cells, iteration by iteration.
+    With kexec, a single VM runs every config's cells, kexecing into each config's kernel in turn"""
+    if agent or kexec:
+        config_runs = {}
+        for config, script, iteration in sorted(cells, key=lambda cell: (cell[2], BENCH_BUNDLE.index(cell[1]))):
+            config_runs.setdefault(config, []).append((script, iteration))
+        if kexec:
+            run_configs_kexec(config_runs, "lmbench", manifest=manifest)
+            return
+        for config, runs in config_runs.items():
+            run_config_agent(config, runs, "lmbench", manifest=manifest)
+        return
+
+    iterations = sorted({iteration for _, _, iteration in cells})
+    for iteration in iterations:
+        print(f"Running iteration {iteration} ({iterations.index(iteration) + 1} of {len(iterations)})")
+        iter_cells = [(config, script) for config, script, cell_iter in cells if cell_iter == iteration]
+
+        if bundle:
+            # One boot per config, configs missing the same benchmarks share a run_bench call
+            config_scripts = {}
+            for config, script in iter_cells:
+                config_scripts.setdefault(config, []).append(script)
+            groups = {}
+            for config, scripts in config_scripts.items():
+                ordered = tuple(script for script in BENCH_BUNDLE if script in scripts)
+                groups.setdefault(ordered, []).append(config)
+            for scripts, configs in groups.items():
+                run_bench(launch_script=list(scripts), bench_name="lmbench", max_vms=max_vms,
+                          configs=configs, manifest=manifest, iteration=iteration)
+            continue
 
+        for script in BENCH_BUNDLE:
+            configs = [config for config, cell_script in iter_cells if cell_script == script]
+            if configs:
+                run_bench(launch_script=script, bench_name="lmbench", max_vms=max_vms,
+                          configs=configs, manifest=manifest, iteration=iteration)
+
+
+def mark_cells(manifest: CampaignManifest, config_name: str, launch_script, iteration: int, state: str, message: str = None):
+    """Move the cells covered by one run (several if launch scripts are bundled) to state"""
+    if manifest is None:
+        return
+    scripts = launch_script if isinstance(launch_script, list) else [launch_script]
+    for script in scripts:
+        manifest.set_state(config_name, script, iteration, state, message)
+
+
+def finish_run(result, kconfig: Kconfig, test_name: str, launch_script, config_name: str,
+               manifest: CampaignManifest = None, iteration: int = None, log_base_dir: str = RAW_LOG_DIR):
+    """Save the logs of a finished run, and mark its cells done (or failed, if a benchmark left nothing to
+    extract results from or the VM was stopped early while it ran, e.g. on a kernel crash)"""
+    saved = save_run_kernel_logs(result, kconfig, test_name, launch_script, log_base_dir)
+    scripts = launch_script if isinstance(launch_script, list) else [launch_script]
+    for script in scripts:
+        if script not in saved:
+            mark_cells(manifest, config_name, script, iteration, FAILED, f"{CAUSE_EXTRACTION_ERROR}: no output in bundled run")
+            continue
+        stop_reason = saved[script].stop_reason
+        missing = saved[script].missing_results()
+        if stop_reason is not None and stop_reason["kind"] in ABNORMAL_STOPS:
+            mark_cells(manifest, config_name, script, iteration, FAILED, f"VM stopped ({stop_reason['kind']}): {stop_reason['detail']}")
+        elif missing is not None:
+            mark_cells(manifest, config_name, script, iteration, FAILED, f"{CAUSE_EXTRACTION_ERROR}: {missing}")
+        else:
+            mark_cells(manifest, config_name, script, iteration, DONE)
+    return result
 
-def do_run_glibc_bench():
-    run_bench(launch_script="launch_glibc.sh", bench_name="lmbench")
 
+def do_run_glibc_bench(max_vms: int = 1):
+    run_bench(launch_script="launch_glibc.sh", bench_name="lmbench", max_vms=max_vms)
 
-def do_run_lmbench():
-    run_bench(launch_script="launch_lmbench.sh", bench_name="lmbench")
 
+def do_run_lmbench(max_vms: int = 1):
+    run_bench(launch_script="launch_lmbench.sh", bench_name="lmbench", max_vms=max_vms)
 
-def do_run_inkscape():
-    run_bench(launch_script="launch_inkscape.sh", bench_name="lmbench")
 
+def do_run_inkscape(max_vms: int = 1):
+    run_bench(launch_script="launch_inkscape.sh", bench_name="lmbench", max_vms=max_vms)
 
-def do_run_stressng():
-    run_bench(launch_script="launch_stressng.sh", bench_name="lmbench")
 
+def do_run_stressng(max_vms: int = 1):
+    run_bench(launch_script="launch_stressng.sh", bench_name="lmbench", max_vms=max_vms)
 
-def do_run_sqlite():
-    run_bench(launch_script="launch_sqlite.sh", bench_name="lmbench")
+
+def do_run_sqlite(max_vms: int = 1):
+    run_bench(launch_script="launch_sqlite.sh", bench_name="lmbench", max_vms=max_vms)
 
 
 ANALYSIS_DIR = os.path.join(os.path.dirname(__file__), "results-analysis")
@@ -52,10 +150,27 @@ def get_output_dir(config_name: str):
     return output_dir
 
 
+# Launch script that produces each phoronix test's results
+PHORONIX_TEST_SCRIPTS = {
+    "glibc": "launch_glibc.sh",
+    "inkscape": "launch_inkscape.sh",
+    "sqlite": "launch_sqlite.sh",
+}
+
+
 def extract_phoronix_stats(json_path: str, config_name: str, reuslt_no: int = 0):
-    kernel_log = KernelLog.from_JSON(json_path)
+    _, scalars = extract_phoronix_test_stats(json_path, config_name, reuslt_no)
+    return scalars
+
+
+def extract_phoronix_test_stats(json_path: str, config_name: str, reuslt_no: int = 0):
+    """(test name, scalars) of the first phoronix test found in the log, (None, None) if there isn't one"""
+    return phoronix_stats_from_log(KernelLog.load(json_path), config_name, reuslt_no)
+
+
+def phoronix_stats_from_log(kernel_log: KernelLog, config_name: str, reuslt_no: int = 0):
+    """extract_phoronix_test_stats on an already loaded log"""
     # Extract the glibc stats, which are in raw lines between "Aux log file:" and "[TAG: AUX GLIBC-BENCH RESULTS]"
-    kernel_log_lines = kernel_log.get_raw_lines()
 
     # test to tag pairs and parse function map
     parse_fuc_map = {
@@ -64,26 +179,19 @@ def extract_phoronix_stats(json_path: str, config_name: str, reuslt_no: int = 0)
         "sqlite": ("Aux log file:", "[TAG: AUX SQLITE-BENCH RESULTS]", parse_sqlite_scalars),
     }
     scalars = None
+    found_test = None
     # Figure out which test to run for each, if both tags are present the parse with specific function
     for test, (start_tag, end_tag, parse_func) in parse_fuc_map.items():
-        lines = []
-        try:
-            start = kernel_log_lines.index(start_tag)
-            end = kernel_log_lines.index(end_tag)
-            lines = kernel_log_lines[start + 1:end]
-        except ValueError as e:
-            # print(f"Error: {e}")
-            print(f"{test} results not found in kernel log for config: ", config_name)
-            continue
-            # return None
-            # raise e
+        # Framed results port copy if the run had one, otherwise scan the aux log for the tags
+        results_str = kernel_log.records.get_text(test) if kernel_log.records is not None else None
+        if results_str is None:
+            lines = kernel_log.section(start_tag, end_tag)
+            if lines is None:
+                print(f"{test} results not found in kernel log for config: ", config_name)
+                continue
 
-        # Print the lines
-        # print(f"{test} Results:")
-        # for line in lines:
-        #     print(line)
-        # Join into single string
-        results_str = "\n".join(lines)
+            # Join into single string
+            results_str = lines.text()
 
         # Dump to current file location + "results-analysis/<bench_name>_<config_name>"
         output_dir = get_output_dir(config_name)
@@ -92,9 +200,10 @@ def extract_phoronix_stats(json_path: str, config_name: str, reuslt_no: int = 0)
             f.write(results_str)
         # Parse the results
         scalars = parse_func(results_str)
+        found_test = test
         break
 
-    return scalars
+    return found_test, scalars
 
     # try:
     #     glibc_start = kernel_log_lines.index("Aux log file:")
@@ -120,25 +229,21 @@ def extract_phoronix_stats(json_path: str, config_name: str, reuslt_no: int = 0)
 
 def extract_lmbench_stats(json_path: str, config_name: str, result_no: int = 0):
     # Deserialize into kernel log object
-    kernel_log = KernelLog.from_JSON(json_path)
+    return lmbench_stats_from_log(KernelLog.load(json_path), config_name, result_no)
 
+
+def lmbench_stats_from_log(kernel_log: KernelLog, config_name: str, result_no: int = 0):
+    """(scalars, streams) of the lmbench run in an already loaded log, (None, None) if there isn't one"""
     # Extract the lmbench stats, which are in raw lines between [TAG: AUX LMBENCH RESULTS] and [TAG: AUX LMBENCH RESULTS END]
-    kernel_log_lines = kernel_log.get_raw_lines()
-    try:
-        lmbench_start = kernel_log_lines.index("[TAG: AUX LMBENCH RESULTS]")
-        lmbench_end = kernel_log_lines.index("[TAG: AUX LMBENCH RESULTS END]")
-        lmbench_lines = kernel_log_lines[lmbench_start + 1:lmbench_end]
-    except ValueError as e:
-        # print(f"Error: {e}")
-        print("LMBench results not found in kernel log for config: ", config_name)
-        return None, None
-        # raise e
-    # Print the lines
-    # print("LMBench Results:")
-    # for line in lmbench_lines:
-    #     print(line)
-    # Join into single string
-    lmbench_results_str = "\n".join(lmbench_lines)
+    # Framed results port copy if the run had one (exact bytes of the results file)
+    lmbench_results_str = kernel_log.records.get_text("lmbench") if kernel_log.records is not None else None
+    if lmbench_results_str is None:
+        lmbench_lines = kernel_log.section("[TAG: AUX LMBENCH RESULTS]", "[TAG: AUX LMBENCH RESULTS END]")
+        if lmbench_lines is None:
+            print("LMBench results not found in kernel log for config: ", config_name)
+            return None, None
+        # Join into single string
+        lmbench_results_str = lmbench_lines.text()
 
     # Dump to current file location + "results-analysis/<bench_name>_<config_name>"
     output_dir = get_output_dir(config_name)
@@ -158,79 +263,54 @@ def extract_lmbench_stats(json_path: str, config_name: str, result_no: int = 0):
     print("End of LMBench Results")
 
 
-def do_analyze_lmbench():
+# Run on every saved log by ingest_logs, name -> fn(kernel_log, config_name, result_no)
+EXTRACTORS = {
+    "phoronix": phoronix_stats_from_log,
+    "lmbench": lmbench_stats_from_log,
+}
+
+
+def do_analyze_lmbench(max_workers: int = None):
     """
     Analyze the results of the skeleton benchmark.
     """
     bench_prefix = "lmbench"
     config_scalar_results = {}
     config_stream_results = {}
+
+    # Every log is loaded once, in a worker process, and all extractors run on it
+    jobs = []
     for config_name, kconfig_str in kconfig_map.items():
-        print(f"Analyzing {bench_prefix} with {config_name}")
-        curr_log_dir = os.path.join(
-            RAW_LOG_DIR, f"{bench_prefix}_{config_name}_{BASE_DEFCONFIG}")
         test_log_dir = os.path.join(
-            curr_log_dir, f"test_lmbench_{config_name}")
-
-        # for each json in the format kernel_[date].json excluding kernel_current.json
-        scalars = None
-        streams = None
-        glibc_scalars = None
-        result_no = 0
-
+            RAW_LOG_DIR, f"{bench_prefix}_{config_name}_{BASE_DEFCONFIG}", f"test_lmbench_{config_name}")
         # If does not exist, move on
         if not os.path.exists(test_log_dir):
             print(f"Error: {test_log_dir} does not exist")
             continue
+        jobs += find_saved_logs(test_log_dir, config_name)
+
+    print(f"Analyzing {len(jobs)} {bench_prefix} logs")
+    for job, results in zip(jobs, ingest_logs(jobs, EXTRACTORS, max_workers=max_workers)):
+        config_name = job.config_name
+        log_name = os.path.basename(job.path)
+        if results is None:
+            continue
 
-        for file in os.listdir(test_log_dir):
-            if file.startswith("kernel_") and file.endswith(".json") and file != "kernel_current.json":
-                # get the date from the filename
-                date = file.split("_")[1].split(".")[0]
-                # get the path to the json file
-                json_path = os.path.join(test_log_dir, file)
-                print(f"Analyzing {os.path.basename(json_path)}")
-                glibc_scalars = extract_phoronix_stats(
-                    json_path, config_name, result_no)
-                if glibc_scalars is not None:
-                    # print("Found glibc results, press enter to continue")
-                    # print(glibc_scalars)
-                    # input("Press enter to continue")
-                    if (config_scalar_results.get(config_name) is None):
-                        config_scalar_results[config_name] = [glibc_scalars]
-                    else:
-                        config_scalar_results[config_name].append(
-                            glibc_scalars)
-                else:
-                    print(
-                        f"Error: {os.path.basename(json_path)} does not contain glibc results")
-                scalars, streams = extract_lmbench_stats(
-                    json_path, config_name, result_no)
-                if scalars is not None:
-                    if (config_scalar_results.get(config_name) is None):
-                        config_scalar_results[config_name] = [scalars]
-                    else:
-                        config_scalar_results[config_name].append(scalars)
-                else:
-                    print(
-                        f"Error: {os.path.basename(json_path)} does not contain scalar results")
-                if streams is not None:
-                    if (config_stream_results.get(config_name) is None):
-                        config_stream_results[config_name] = [streams]
-                    else:
-                        config_stream_results[config_name].append(streams)
-                else:
-                    print(
-                        f"Error: {os.path.basename(json_path)} does not contain stream results")
-
-                result_no += 1
-
-        # scalar_path = os.path.join(get_output_dir(config_name), "lmbench_scalar.csv")
-        # dump_scalar_csv(config_results[config_name], fn=scalar_path)
-
-    # print("Config results:")
-    # print(config_results)
-    # analyze_streams_across_runs(config_stream_results)
+        _, glibc_scalars = results["phoronix"]
+        if glibc_scalars is not None:
+            config_scalar_results.setdefault(config_name, []).append(glibc_scalars)
+        else:
+            print(f"Error: {log_name} does not contain glibc results")
+
+        scalars, streams = results["lmbench"]
+        if scalars is not None:
+            config_scalar_results.setdefault(config_name, []).append(scalars)
+        else:
+            print(f"Error: {log_name} does not contain scalar results")
+        if streams is not None:
+            config_stream_results.setdefault(config_name, []).append(streams)
+        else:
+            print(f"Error: {log_name} does not contain stream results")
 
     stream_scalar_map = streams_to_scalar_run_map(config_stream_results)
 
@@ -254,19 +334,262 @@ def do_analyze_results():
     pass
 
 
-def run_bench(launch_script: str, bench_name: str, interactive: bool = False) -> None:
-
-    # For this benchmark, will run each kconfig once
-    for config_name, (kconfig_str, extra_args) in kconfig_map.items():
-        print(f"Running {bench_name} with {config_name}")
-        full_run_name = f"{bench_name}_{config_name}"
-        kconfig = generate_kconfig(arch=Arch.X86, defconfig_names=[
-            "manmin_nosec_defconfig"], kconfig_strings=[kconfig_str], label_base=full_run_name, allow_def_override=True)
-        run_linux_benchmark(test_name=f"test_{full_run_name}", kconfig=kconfig,
-                            build_function=None, launch_script=launch_script, interactive=interactive, extra_args=extra_args)
-        print(f"Finished {bench_name} with {config_name}")
+def load_script_scalars(config_names: list, bench_prefix: str = "lmbench", max_workers: int = None) -> dict:
+    """
+    Scalar results already in the kernel-logs tree, split by the launch script that produced them:
+    { launch_script : { config_name : [ scalars_record1, scalars_record2, … ] } }
+    (lmbench streams aren't included, they are too noisy to converge on)
+    """
+    jobs = []
+    for config_name in config_names:
+        test_log_dir = os.path.join(RAW_LOG_DIR, f"{bench_prefix}_{config_name}_{BASE_DEFCONFIG}",
+                                    f"test_{bench_prefix}_{config_name}")
+        if os.path.exists(test_log_dir):
+            jobs += find_saved_logs(test_log_dir, config_name)
+
+    script_results = {}
+    for job, results in zip(jobs, ingest_logs(jobs, EXTRACTORS, max_workers=max_workers)):
+        if results is None:
+            continue
+        test, phoronix_scalars = results["phoronix"]
+        if phoronix_scalars:
+            script = PHORONIX_TEST_SCRIPTS[test]
+            script_results.setdefault(script, {}).setdefault(job.config_name, []).append(phoronix_scalars)
+
+        lmbench_scalars, _ = results["lmbench"]
+        if lmbench_scalars:
+            script_results.setdefault("launch_lmbench.sh", {}).setdefault(job.config_name, []).append(lmbench_scalars)
+    return script_results
+
+
+def unresolved_cells(script_results: dict, config_names: list, manifest: CampaignManifest, attempts: dict,
+                     target_ci: float, min_iters: int, max_iters: int, baseline: str = "basline", metrics: list = None) -> list:
+    """(config, launch script) pairs that still need another sample: fewer than min_iters samples, or a
+    tracked metric whose CI on overhead vs baseline is wider than target_ci (in %). Pairs stop after
+    max_iters samples or max_iters attempts in this campaign, whichever comes first"""
+    pending = []
+    for script in BENCH_BUNDLE:
+        results = script_results.get(script, {})
+        confidence = overhead_confidence(merge_run_map(results), baseline) if results else {}
+        script_pending = []
+        for config in config_names:
+            # Benchmarks without a parser (stress-ng) only count runs that finished
+            n = len(results.get(config, [])) if results else manifest.count_done(config, script)
+            if n >= max_iters or attempts.get((config, script), 0) >= max_iters:
+                continue
+            if n < min_iters:
+                script_pending.append(config)
+                continue
+            if not results or config == baseline:
+                continue
+            widths = [stats["ci_half_width_pct"] for metric, stats in confidence.get(config, {}).items()
+                      if metrics is None or metric in metrics]
+            if not widths or max(widths) > target_ci:
+                script_pending.append(config)
+
+        # Every overhead CI also depends on the baseline's samples
+        if script_pending and baseline in config_names and baseline not in script_pending:
+            n = len(results.get(baseline, [])) if results else 0
+            if n < max_iters and attempts.get((baseline, script), 0) < max_iters:
+                script_pending.append(baseline)
+
+        pending += [(config, script) for config in script_pending]
+    return pending
+
+
+def do_run_adaptive(target_ci: float, min_iters: int = 3, max_iters: int = 15, budget: int = None,
+                    max_vms: int = 1, bundle: bool = False, metrics: list = None):
+    """Keep scheduling iterations, only for (config, benchmark) pairs whose overhead vs the baseline isn't
+    known to within target_ci percent yet. Stops once everything is resolved or budget benchmark runs are used"""
+    manifest = CampaignManifest()
+    config_names = list(kconfig_map.keys())
+    attempts = {}
+    runs_used = 0
+
+    while True:
+        script_results = load_script_scalars(config_names)
+        pending = unresolved_cells(script_results, config_names, manifest, attempts,
+                                   target_ci, min_iters, max_iters, metrics=metrics)
+        if not pending:
+            print("All tracked metrics resolved")
+            break
+
+        if budget is not None:
+            pending = pending[:budget - runs_used]
+            if not pending:
+                print(f"Budget of {budget} benchmark runs used up")
+                break
+
+        print(f"Scheduling another iteration for {len(pending)} unresolved (config, benchmark) pairs:")
+        cells = []
+        for config, script in pending:
+            print(f"  {config} {script}")
+            attempts[(config, script)] = attempts.get((config, script), 0) + 1
+            cells += manifest.queue_new_iterations([config], [script], 1)
+
+        run_campaign_cells(cells, manifest, max_vms=max_vms, bundle=bundle)
+        runs_used += len(cells)
+
+    print(f"Adaptive campaign used {runs_used} benchmark runs, campaign state: {manifest.summary()}")
+
+
+def bench_kconfig(bench_name: str, config_name: str, kconfig_str: str):
+    """Kconfig for a single kconfig_map entry"""
+    full_run_name = f"{bench_name}_{config_name}"
+    return generate_kconfig(arch=Arch.X86, defconfig_names=[
+        "manmin_nosec_defconfig"], kconfig_strings=[kconfig_str], label_base=full_run_name, allow_def_override=True)
+
+
+def run_bench(launch_script, bench_name: str, interactive: bool = False, max_vms: int = 1,
+              configs: list = None, manifest: CampaignManifest = None, iteration: int = None) -> None:
+    """Run the benchmark once on each kconfig. With max_vms > 1 the configs go through a
+    stage pipeline, so one config's kernel builds while up to max_vms others are booted.
+    launch_script can be a list, to run several benchmarks in one boot.
+    - configs: names from kconfig_map to run, all of them by default
+    - manifest/iteration: if given, the state of each run's cells is recorded in the campaign manifest"""
+    if configs is None:
+        configs = list(kconfig_map.keys())
+
+    if interactive or max_vms <= 1:
+        # For this benchmark, will run each kconfig once
+        for config_name in configs:
+            # Stages already retry what is worth retrying (see microwave2/testers/retry.py), anything
+            # that still gets out only costs this config
+            try:
+                run_config(config_name, launch_script, bench_name, interactive=interactive,
+                           manifest=manifest, iteration=iteration)
+            except Exception as e:
+                print(f"{bench_name} {config_name} raised: {e}")
+                mark_cells(manifest, config_name, launch_script, iteration, FAILED, f"Raised: {e}")
+        return
+
+    run_bench_pipelined(launch_script, bench_name, max_vms, configs, manifest, iteration)
+
+
+def run_config(config_name: str, launch_script, bench_name: str, interactive: bool = False,
+               manifest: CampaignManifest = None, iteration: int = None, lease: QemuLease = None,
+               log_base_dir: str = RAW_LOG_DIR) -> bool:
+    """Build, boot and save the logs of a single config, returns whether it succeeded"""
+    kconfig_str, extra_args = kconfig_map[config_name]
+    print(f"Running {bench_name} with {config_name}")
+    kconfig = bench_kconfig(bench_name, config_name, kconfig_str)
+    test_name = f"test_{bench_name}_{config_name}"
+
+    def on_stage(stage):
+        mark_cells(manifest, config_name, launch_script, iteration, STAGE_STATES[stage])
+
+    result = run_linux_benchmark(test_name=test_name, kconfig=kconfig, build_function=None, launch_script=launch_script,
+                                 interactive=interactive, extra_args=extra_args, log_base_dir=None, lease=lease, on_stage=on_stage)
+    print(f"Finished {bench_name} with {config_name}")
+    if interactive:
+        return True
+    if result is None:
+        mark_cells(manifest, config_name, launch_script, iteration, FAILED, "Run failed")
+        return False
+    finish_run(result, kconfig, test_name, launch_script, config_name, manifest, iteration, log_base_dir)
+    return True
+
+
+def run_config_agent(config_name: str, runs: list, bench_name: str, manifest: CampaignManifest = None,
+                     lease: QemuLease = None, log_base_dir: str = RAW_LOG_DIR) -> bool:
+    """Build and boot a single config once, and run each (launch script, iteration) of runs in that
+    boot over the guest agent. Returns whether the boot worked (individual runs may still fail)"""
+    kconfig_str, extra_args = kconfig_map[config_name]
+    print(f"Running {bench_name} with {config_name} over the guest agent ({len(runs)} runs)")
+    kconfig = bench_kconfig(bench_name, config_name, kconfig_str)
+    test_name = f"test_{bench_name}_{config_name}"
+
+    def on_stage(stage):
+        for script, iteration in runs:
+            mark_cells(manifest, config_name, script, iteration, STAGE_STATES[stage])
+
+    def on_record(script, iteration, success):
+        if success:
+            mark_cells(manifest, config_name, script, iteration, DONE)
+        else:
+            mark_cells(manifest, config_name, script, iteration, FAILED, "Agent run failed")
+
+    success = run_linux_benchmark_agent(test_name=test_name, kconfig=kconfig, build_function=None, runs=runs,
+                                        log_base_dir=log_base_dir, extra_args=extra_args, lease=lease,
+                                        on_stage=on_stage, on_record=on_record)
+    print(f"Finished {bench_name} with {config_name}")
+    if not success:
+        # Runs that never started are still marked building/booting
+        for script, iteration in runs:
+            state = manifest.get_state(config_name, script, iteration) if manifest is not None else None
+            if state not in (DONE, FAILED):
+                mark_cells(manifest, config_name, script, iteration, FAILED, "Agent boot failed")
+    return success
+
+
+def run_configs_kexec(config_runs: dict, bench_name: str, manifest: CampaignManifest = None,
+                      log_base_dir: str = RAW_LOG_DIR) -> None:
+    """Build every config of config_runs (config -> [(launch script, iteration)]), then run them all in
+    one VM that boots the first config's kernel and kexecs into each next one"""
+    print(f"Running {bench_name} with {len(config_runs)} configs in one VM, switching kernels with kexec")
+    segments = []
+    test_configs = {}
+    for config_name, runs in config_runs.items():
+        kconfig_str, extra_args = kconfig_map[config_name]
+        test_name = f"test_{bench_name}_{config_name}"
+        segments.append((test_name, bench_kconfig(bench_name, config_name, kconfig_str), extra_args, runs))
+        test_configs[test_name] = config_name
+
+    def on_stage(test_name, stage):
+        config_name = test_configs[test_name]
+        for script, iteration in config_runs[config_name]:
+            mark_cells(manifest, config_name, script, iteration, STAGE_STATES[stage])
+
+    def on_record(test_name, script, iteration, success):
+        if success:
+            mark_cells(manifest, test_configs[test_name], script, iteration, DONE)
+        else:
+            mark_cells(manifest, test_configs[test_name], script, iteration, FAILED, "Agent run failed")
 
-    pass
+    booted = run_linux_benchmark_kexec(segments, build_function=None, log_base_dir=log_base_dir,
+                                       on_stage=on_stage, on_record=on_record)
+    for test_name, success in booted.items():
+        if success:
+            continue
+        config_name = test_configs[test_name]
+        print(f"{bench_name} {config_name} never booted")
+        for script, iteration in config_runs[config_name]:
+            state = manifest.get_state(config_name, script, iteration) if manifest is not None else None
+            if state not in (DONE, FAILED):
+                mark_cells(manifest, config_name, script, iteration, FAILED, "Kernel build or boot failed")
+
+
+def run_bench_pipelined(launch_script, bench_name: str, max_vms: int, configs: list,
+                        manifest: CampaignManifest = None, iteration: int = None) -> None:
+    """Run every kconfig through the download/build/install/run pipeline, longest build first"""
+    allocator = QemuResourceAllocator(max_vms=max_vms)
+    print(f"Running {bench_name} with up to {allocator.get_num_slots()} concurrent VMs")
+
+    pipeline = PipelineExecutor(stage_limits={RUN_STAGE: allocator.get_num_slots()})
+    build_history = BuildTimeHistory()
+
+    for config_name in configs:
+        kconfig_str, extra_args = kconfig_map[config_name]
+        test_name = f"test_{bench_name}_{config_name}"
+        kconfig = bench_kconfig(bench_name, config_name, kconfig_str)
+        tester = build_tester(test_name=test_name, kconfig=kconfig,
+                              build_function=None, launch_script=launch_script, extra_args=extra_args)
+
+        def on_result(result, kconfig=kconfig, test_name=test_name, config_name=config_name):
+            return finish_run(result, kconfig, test_name, launch_script, config_name, manifest, iteration)
+
+        def on_stage(stage, config_name=config_name):
+            mark_cells(manifest, config_name, launch_script, iteration, STAGE_STATES[stage])
+
+        pipeline.add_tester(config_name, tester, allocator=allocator, build_label=kconfig.get_label(),
+                            build_history=build_history, on_result=on_result, on_stage=on_stage)
+
+    results = pipeline.run()
+    for config_name in configs:
+        result = results[f"{config_name}:{RUN_STAGE}"]
+        if result.is_failure():
+            print(f"{bench_name} {config_name} failed: {result.message}")
+            mark_cells(manifest, config_name, launch_script, iteration, FAILED, result.message)
 
 
 def run_ksbench_single(interactive: bool, extra_kconfig_str: str, label_base: str, launch_script: str) -> None:
@@ -7,7 +7,11 @@ AUX_LOG_PATH="/dev/virtio-ports/host-port"
 echo "[TAG: RUNNING KERNCOMPILE-BENCH]"
 
 echo "Starting kerncompile-bench..."
-echo 3 | phoronix-test-suite batch-run build-linux-kernel >> $AUX_LOG_PATH 2>&1
+run_output=$(mktemp)
+echo 3 | phoronix-test-suite batch-run build-linux-kernel 2>&1 | tee "$run_output" >> $AUX_LOG_PATH
+# Framed copy of the run output on the results port (the analysis prefers it over scanning the aux log)
+microwave-record results kerncompile "$run_output" || true
+rm -f "$run_output"
 
 latest_result=$(
   phoronix-test-suite list-saved-results | \
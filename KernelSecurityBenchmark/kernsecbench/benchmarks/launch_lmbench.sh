@@ -37,9 +37,8 @@ echo "=== Benchmark complete; dumping results at $RESULTS_FILE to aux log ==="
 echo "[TAG: AUX LMBENCH RESULTS]" > "$AUX_LOG_PATH"
 cat "$RESULTS_FILE" > "$AUX_LOG_PATH"
 echo "[TAG: AUX LMBENCH RESULTS END]" >> "$AUX_LOG_PATH"
-echo "[TAG: AUX LMBENCH RESULTS BASE64]" >> "$AUX_LOG_PATH"
-base64 "$RESULTS_FILE" | tr -d '\n' | tr -d '\r' >> "$AUX_LOG_PATH"
-echo "[TAG: AUX LMBENCH RESULTS BASE64 END]" >> "$AUX_LOG_PATH"
+# Exact bytes, framed on the results port (the analysis prefers these over the aux log copy)
+microwave-record results lmbench "$RESULTS_FILE" || true
 echo "============================================"
 
 # # Also base64 encode the results and print as single line
@@ -7,7 +7,11 @@ AUX_LOG_PATH="/dev/virtio-ports/host-port"
 echo "[TAG: RUNNING STRESSNG-BENCH]"
 
 echo "Starting stressng-bench..."
-echo "2,3,4,8,9,10,11,12,13,14,15,16,17,19,20,21,22,23,27,28,31,37,39" | phoronix-test-suite batch-run stress-ng >> $AUX_LOG_PATH 2>&1
+run_output=$(mktemp)
+echo "2,3,4,8,9,10,11,12,13,14,15,16,17,19,20,21,22,23,27,28,31,37,39" | phoronix-test-suite batch-run stress-ng 2>&1 | tee "$run_output" >> $AUX_LOG_PATH
+# Framed copy of the run output on the results port (the analysis prefers it over scanning the aux log)
+microwave-record results stressng "$run_output" || true
+rm -f "$run_output"
 
 latest_result=$(
   phoronix-test-suite list-saved-results | \
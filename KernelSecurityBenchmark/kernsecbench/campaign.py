@@ -0,0 +1,157 @@
+"""
+Persistent manifest of a benchmark campaign -- records the state of every (config, benchmark, iteration)
+cell, so an interrupted run-all-benchmarks can pick up where it left off instead of starting over
+"""
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+from kernsecbench.microwave_wrapper import RAW_LOG_DIR
+
+QUEUED = "queued"
+BUILDING = "building"
+BOOTING = "booting"
+DONE = "done"
+FAILED = "failed"
+CELL_STATES = [QUEUED, BUILDING, BOOTING, DONE, FAILED]
+
+DEFAULT_MANIFEST_PATH = os.path.join(RAW_LOG_DIR, "campaign.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cells (
+    config TEXT NOT NULL,
+    benchmark TEXT NOT NULL,
+    iteration INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    message TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (config, benchmark, iteration)
+);
+CREATE TABLE IF NOT EXISTS transitions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    config TEXT NOT NULL,
+    benchmark TEXT NOT NULL,
+    iteration INTEGER NOT NULL,
+    old_state TEXT,
+    new_state TEXT NOT NULL,
+    message TEXT,
+    time REAL NOT NULL
+);
+"""
+
+
+class CampaignManifest:
+    """SQLite backed record of cell states. Every call opens its own connection, so it is safe
+    to use from pipeline threads (and other processes sharing the results dir)"""
+
+    def __init__(self, path: str = DEFAULT_MANIFEST_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with closing(self.connect()) as conn:
+            conn.executescript(SCHEMA)
+
+    def connect(self) -> sqlite3.Connection:
+        # Autocommit mode, transactions are started explicitly with BEGIN IMMEDIATE
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def set_state(self, config: str, benchmark: str, iteration: int, state: str, message: str = None):
+        """Atomically move a cell to state (creating it if needed), and record the transition"""
+        if state not in CELL_STATES:
+            raise ValueError(f"Unknown cell state: {state}")
+
+        now = time.time()
+        with closing(self.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT state FROM cells WHERE config=? AND benchmark=? AND iteration=?",
+                                   (config, benchmark, iteration)).fetchone()
+                old_state = row[0] if row is not None else None
+                # A cell counts as attempted each time it starts building
+                attempt = 1 if state == BUILDING else 0
+                conn.execute("""INSERT INTO cells (config, benchmark, iteration, state, attempts, message, updated)
+                                VALUES (?, ?, ?, ?, ?, ?, ?)
+                                ON CONFLICT (config, benchmark, iteration) DO UPDATE SET
+                                    state=excluded.state, attempts=attempts + ?, message=excluded.message, updated=excluded.updated""",
+                             (config, benchmark, iteration, state, attempt, message, now, attempt))
+                conn.execute("""INSERT INTO transitions (config, benchmark, iteration, old_state, new_state, message, time)
+                                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                             (config, benchmark, iteration, old_state, state, message, now))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def get_state(self, config: str, benchmark: str, iteration: int) -> str:
+        with closing(self.connect()) as conn:
+            row = conn.execute("SELECT state FROM cells WHERE config=? AND benchmark=? AND iteration=?",
+                               (config, benchmark, iteration)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_cells(self, state: str = None) -> list:
+        """(config, benchmark, iteration, state) of every cell, optionally only those in state"""
+        query = "SELECT config, benchmark, iteration, state FROM cells"
+        args = ()
+        if state is not None:
+            query += " WHERE state=?"
+            args = (state,)
+        with closing(self.connect()) as conn:
+            return conn.execute(query + " ORDER BY iteration, config, benchmark", args).fetchall()
+
+    def count_done(self, config: str, benchmark: str) -> int:
+        with closing(self.connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM cells WHERE config=? AND benchmark=? AND state=?",
+                                (config, benchmark, DONE)).fetchone()[0]
+
+    def next_iteration(self, config: str, benchmark: str) -> int:
+        """Iterations are numbered from 1"""
+        with closing(self.connect()) as conn:
+            row = conn.execute("SELECT MAX(iteration) FROM cells WHERE config=? AND benchmark=?",
+                               (config, benchmark)).fetchone()
+        return 1 if row[0] is None else row[0] + 1
+
+    def unfinished_cells(self, configs: list, benchmarks: list) -> list:
+        """(config, benchmark, iteration) of cells that never reached done, e.g. from a run that died"""
+        return [(config, benchmark, iteration) for config, benchmark, iteration, state in self.get_cells()
+                if state != DONE and config in configs and benchmark in benchmarks]
+
+    def queue_cells(self, cells: list) -> list:
+        for config, benchmark, iteration in cells:
+            self.set_state(config, benchmark, iteration, QUEUED)
+        return cells
+
+    def queue_new_iterations(self, configs: list, benchmarks: list, num_iters: int) -> list:
+        """Queue num_iters new iterations of every (config, benchmark), after any existing ones"""
+        cells = []
+        for config in configs:
+            for benchmark in benchmarks:
+                start = self.next_iteration(config, benchmark)
+                cells += [(config, benchmark, iteration) for iteration in range(start, start + num_iters)]
+        return self.queue_cells(cells)
+
+    def queue_unfinished(self, configs: list, benchmarks: list) -> list:
+        """Requeue every cell that isn't done (only those whose config and benchmark still exist)"""
+        return self.queue_cells(self.unfinished_cells(configs, benchmarks))
+
+    def queue_top_up(self, configs: list, benchmarks: list, samples: int) -> list:
+        """Queue enough cells that every (config, benchmark) ends up with samples done cells,
+        retrying unfinished cells before adding new iterations"""
+        unfinished = self.unfinished_cells(configs, benchmarks)
+        cells = []
+        for config in configs:
+            for benchmark in benchmarks:
+                needed = samples - self.count_done(config, benchmark)
+                if needed <= 0:
+                    continue
+                retry = [cell for cell in unfinished if cell[0] == config and cell[1] == benchmark][:needed]
+                start = self.next_iteration(config, benchmark)
+                new = [(config, benchmark, iteration) for iteration in range(start, start + needed - len(retry))]
+                cells += retry + new
+        return self.queue_cells(cells)
+
+    def summary(self) -> dict:
+        """Number of cells in each state"""
+        with closing(self.connect()) as conn:
+            rows = conn.execute("SELECT state, COUNT(*) FROM cells GROUP BY state").fetchall()
+        return {state: count for state, count in rows}
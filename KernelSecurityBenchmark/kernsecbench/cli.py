@@ -1,6 +1,6 @@
 import click
 
-from kernsecbench.benchmark import do_run_sqlite, do_run_stressng, do_run_inkscape, do_analyze_results, do_run_all_benchmarks, do_run_lmbench, do_analyze_lmbench, do_run_glibc_bench
+from kernsecbench.benchmark import do_run_sqlite, do_run_stressng, do_run_inkscape, do_analyze_results, do_run_all_benchmarks, do_run_lmbench, do_analyze_lmbench, do_run_glibc_bench, do_run_adaptive
 import platform
 
 
@@ -11,9 +11,10 @@ def cli():
 
 
 @cli.command()
-def run_lmbench():
+@click.option('--vms', type=click.INT, default=1, help='Maximum number of VMs to run at once')
+def run_lmbench(vms):
     print("Running lmbench benchmarks")
-    do_run_lmbench()
+    do_run_lmbench(max_vms=vms)
 
 
 @cli.command()
@@ -42,15 +43,89 @@ def run_stressng():
 
 @cli.command()
 @click.option('--iters', type=click.INT, default=1, help='Number of iterations to run')
-def run_all_benchmarks(iters):
+@click.option('--vms', type=click.INT, default=1, help='Maximum number of VMs to run at once')
+@click.option('--bundle', is_flag=True, default=False, help='Run every benchmark in a single boot per config')
+@click.option('--resume', is_flag=True, default=False, help='Only rerun cells of the campaign manifest that never finished')
+@click.option('--samples', type=click.INT, default=None, help='Top up every config and benchmark to this many successful runs')
+@click.option('--agent', is_flag=True, default=False, help='Boot each config once and run every benchmark and iteration over the guest agent')
+@click.option('--kexec', is_flag=True, default=False, help='Like --agent, but one VM for all configs that kexecs into each config\'s kernel')
+def run_all_benchmarks(iters, vms, bundle, resume, samples, agent, kexec):
     print("Running all benchmarks")
-    do_run_all_benchmarks(num_iters=iters)
+    do_run_all_benchmarks(num_iters=iters, max_vms=vms, bundle=bundle, resume=resume, samples=samples, agent=agent, kexec=kexec)
 
 
 @cli.command()
-def analyze_benchmarks():
+@click.option('--target-ci', type=click.FLOAT, default=2.0, help='Stop once the CI on overhead vs baseline is within this many percent')
+@click.option('--min-iters', type=click.INT, default=3, help='Samples every config and benchmark gets regardless')
+@click.option('--max-iters', type=click.INT, default=15, help='Most samples of any config and benchmark')
+@click.option('--budget', type=click.INT, default=None, help='Most benchmark runs to spend in total')
+@click.option('--metric', 'metrics', multiple=True, help='Only track these metrics (default all)')
+@click.option('--vms', type=click.INT, default=1, help='Maximum number of VMs to run at once')
+@click.option('--bundle', is_flag=True, default=False, help='Run every benchmark in a single boot per config')
+def run_adaptive(target_ci, min_iters, max_iters, budget, metrics, vms, bundle):
+    print("Running benchmarks until overheads are resolved")
+    do_run_adaptive(target_ci=target_ci, min_iters=min_iters, max_iters=max_iters, budget=budget,
+                    max_vms=vms, bundle=bundle, metrics=list(metrics) if metrics else None)
+
+
+@cli.command()
+@click.option('--queue', 'queue_dir', required=True, type=click.Path(), help='Shared queue directory')
+@click.option('--iters', type=click.INT, default=1, help='Number of iterations to queue')
+@click.option('--bundle', is_flag=True, default=False, help='Queue one job per config and iteration running every benchmark')
+@click.option('--log-dir', type=click.Path(), default=None, help='Shared kernel-logs tree (holds the campaign manifest)')
+def enqueue(queue_dir, iters, bundle, log_dir):
+    from kernsecbench.worker import enqueue_campaign
+    from kernsecbench.microwave_wrapper import RAW_LOG_DIR
+    from kernsecbench.benchmark import BENCH_BUNDLE
+    enqueue_campaign(queue_dir, iters, BENCH_BUNDLE, bundle=bundle, log_base_dir=log_dir or RAW_LOG_DIR)
+
+
+@cli.command()
+@click.option('--queue', 'queue_dir', required=True, type=click.Path(), help='Shared queue directory')
+@click.option('--worker-id', default=None, help='Defaults to <hostname>-<pid>, reuse an id to recover its jobs after a crash')
+@click.option('--lease', 'lease_seconds', type=click.FLOAT, default=3600, help='Seconds a claim lasts without a heartbeat')
+@click.option('--heartbeat', 'heartbeat_seconds', type=click.FLOAT, default=60, help='Seconds between heartbeats')
+@click.option('--poll', 'poll_seconds', type=click.FLOAT, default=30, help='Seconds between checks of an empty queue')
+@click.option('--exit-when-empty', is_flag=True, default=False, help='Exit once no jobs are pending or claimed')
+@click.option('--slot', type=click.INT, default=None, help='VM resource slot, give each worker on one host its own')
+@click.option('--log-dir', type=click.Path(), default=None, help='Shared kernel-logs tree to save results to')
+@click.option('--dry-run', type=click.FLOAT, default=None, help='Sleep this many seconds per job instead of booting')
+def worker(queue_dir, worker_id, lease_seconds, heartbeat_seconds, poll_seconds, exit_when_empty, slot, log_dir, dry_run):
+    from kernsecbench.worker import run_worker
+    from kernsecbench.microwave_wrapper import RAW_LOG_DIR
+    run_worker(queue_dir, worker_id=worker_id, lease_seconds=lease_seconds, heartbeat_seconds=heartbeat_seconds,
+               poll_seconds=poll_seconds, exit_when_empty=exit_when_empty, slot=slot,
+               log_base_dir=log_dir or RAW_LOG_DIR, dry_run=dry_run)
+
+
+@cli.command()
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--start-tag', default=None, help='Only print the lines after this tag (e.g. "Aux log file:")')
+@click.option('--end-tag', default=None, help='...and before this one')
+def show_log(path, start_tag, end_tag):
+    """Print a saved kernel log (kernel_current.mwlog is the latest run)"""
+    from microwave2.results.log_store import LogFile, is_log_file
+    from microwave2.results.kernel_log import KernelLog
+    if not is_log_file(path):
+        print(KernelLog.load(path).log_str())
+        return
+    log_file = LogFile(path)
+    if start_tag is None:
+        lines = log_file.lines()
+    else:
+        start = log_file.find_tag(start_tag)
+        if start is None:
+            raise click.ClickException(f"{start_tag} not in {path}")
+        end = log_file.find_tag(end_tag, after=start) if end_tag is not None else None
+        lines = log_file.lines(start + 1, end)
+    print("\n".join(lines))
+
+
+@cli.command()
+@click.option('--jobs', type=click.INT, default=None, help='Processes to load logs with (default one per CPU)')
+def analyze_benchmarks(jobs):
     print("Analyzing benchmark results")
-    do_analyze_lmbench()
+    do_analyze_lmbench(max_workers=jobs)
 
 
 if __name__ == "__main__":
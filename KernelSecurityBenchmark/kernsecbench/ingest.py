@@ -0,0 +1,55 @@
+"""
+Results ingestion: every saved kernel log is loaded exactly once and handed to all the extractors,
+with the logs spread over a process pool (loading and parsing is CPU bound, threads wouldn't help).
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, List
+
+from kernsecbench.microwave_wrapper import is_saved_kernel_log
+from microwave2.results.kernel_log import KernelLog
+
+
+@dataclass
+class IngestJob:
+    path: str
+    config_name: str
+    # Position among the config's logs, extractors number their copies of the results with it
+    result_no: int
+
+
+def find_saved_logs(test_log_dir: str, config_name: str) -> List[IngestJob]:
+    """One job per saved run in test_log_dir, in name order"""
+    files = sorted(file for file in os.listdir(test_log_dir) if is_saved_kernel_log(file))
+    return [IngestJob(os.path.join(test_log_dir, file), config_name, result_no)
+            for result_no, file in enumerate(files)]
+
+
+def ingest_log(job: IngestJob, extractors: Dict[str, Callable]) -> dict:
+    """Load job's log and run every extractor on it: extractor name -> what it returned.
+    None if the log couldn't be loaded"""
+    print(f"Analyzing {os.path.basename(job.path)} ({job.config_name})")
+    try:
+        kernel_log = KernelLog.load(job.path)
+    except Exception as e:
+        print(f"Error: couldn't load {job.path}: {e}")
+        return None
+    return {name: extractor(kernel_log, job.config_name, job.result_no)
+            for name, extractor in extractors.items()}
+
+
+def ingest_logs(jobs: List[IngestJob], extractors: Dict[str, Callable], max_workers: int = None) -> List[dict]:
+    """ingest_log every job, results in the same order as jobs. Extractors must be module level
+    functions (they are pickled to the workers by name)
+    - max_workers: worker processes, defaults to one per CPU. 1 runs everything in this process"""
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, len(jobs))
+    if max_workers <= 1:
+        return [ingest_log(job, extractors) for job in jobs]
+
+    # Big chunks keep the pickling overhead down, small enough that the workers stay balanced
+    chunksize = max(1, len(jobs) // (max_workers * 4))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(ingest_log, jobs, [extractors] * len(jobs), chunksize=chunksize))
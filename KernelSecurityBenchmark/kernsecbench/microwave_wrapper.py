@@ -18,9 +18,12 @@ from microwave2.tests.linux_test import LinuxTest
 
 from microwave2.remote import GitConfig, GitAuthInfo
 from microwave2.results.result import Result, TestResult
-from microwave2.results.kernel_log import RawKernelLogResult, KernelLog
+from microwave2.results.kernel_log import RawKernelLogResult, KernelLog, split_bundle_log
+from microwave2.results.log_store import LOG_FILE_EXT, is_log_file
 
 from microwave2.utils.utils import Arch
+from microwave2.utils.qemu import QemuLease
+from typing import Callable
 import platform
 import os
 from datetime import datetime
@@ -44,6 +47,7 @@ RAW_LOG_DIR = os.path.join(os.path.dirname(
 
 TEST_BUILD_MODULE = "build_benchmarks.py"
 LAUNCH_SCRIPT = "launch.sh"
+SAVED_LOG_CURRENT = "kernel_current" + LOG_FILE_EXT
 
 TEST_ORG = "denzel-farmer"
 TEST_REPO = "KernelSecurityBenchmarks"
@@ -67,7 +71,9 @@ def build_tester(test_name: str,
                  launch_script: str = LAUNCH_SCRIPT,  # Launch script relative to benchmarks dir
                  test_subdir: str = BENCHMARK_REPO_REL_DIR,
                  target_subdir: str = None,
-                 extra_args: str = None
+                 extra_args: str = None,
+                 lease: QemuLease = None,
+                 agent: bool = False
                  ) -> KernelTester:
     """Build tester for a linux kernel"""
     # input("Building tester for linux kernel")
@@ -118,7 +124,9 @@ def build_tester(test_name: str,
     tester_config = TesterConfig(
         test_config=test_config,
         target_config=target_config,
-        extra_args=extra_args
+        extra_args=extra_args,
+        lease=lease,
+        agent=agent
     )
 
     return KernelTester(tester_config)
@@ -129,26 +137,94 @@ def saved_kernel_log_dir(log_base_dir: str, kconfig: Kconfig, test_name: str) ->
 
 
 def build_saved_kernel_log_path(log_base_dir: str, kconfig: str, test_name: str) -> str:
-    return saved_kernel_log_dir(log_base_dir, kconfig, test_name) + "/kernel_current.json"
+    return os.path.join(saved_kernel_log_dir(log_base_dir, kconfig, test_name), SAVED_LOG_CURRENT)
+
+
+def is_saved_kernel_log(file_name: str) -> bool:
+    """Whether file_name (in a saved_kernel_log_dir) is one run's saved log, either format.
+    kernel_current.* are the latest run again, not a run of their own"""
+    if not file_name.startswith("kernel_") or file_name.startswith("kernel_current"):
+        return False
+    return file_name.endswith(".json") or is_log_file(file_name)
+
+
+def save_kernel_logs(result: TestResult, kconfig: Kconfig, test_name: str, log_base_dir: str = RAW_LOG_DIR, record_name: str = None) -> TestResult:
+    """Save the kernel log of a finished run under log_base_dir, as kernel_<date>.mwlog, and point
+    the kernel_current.mwlog symlink at it
+    - record_name: appended to the dated name, so several records saved in the same second don't collide"""
+    kernel_logs = result.get_kernel_log()
+    log_full_base = saved_kernel_log_dir(
+        log_base_dir, kconfig, test_name)
+    os.makedirs(log_full_base, exist_ok=True)
+
+    date_time_str = datetime.now().strftime("%d_%m_%y-%H:%M:%S")
+    if record_name is not None:
+        date_time_str += f"-{record_name}"
+    log_name = f"kernel_{date_time_str}{LOG_FILE_EXT}"
+    kernel_logs.to_file(os.path.join(log_full_base, log_name))
+
+    # Relative link so the tree can be moved or copied between hosts, swapped in atomically
+    current_path = build_saved_kernel_log_path(log_base_dir, kconfig, test_name)
+    tmp_link = f"{current_path}.tmp"
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(log_name, tmp_link)
+    os.replace(tmp_link, current_path)
+
+    return result
 
 
-def run_linux_benchmark(test_name: str, kconfig: Kconfig, build_function: str, launch_script: str = LAUNCH_SCRIPT, interactive: bool = False, log_base_dir: str = RAW_LOG_DIR, extra_args: str = None) -> TestResult:
-    """Run a linux kernel benchmark"""
+def save_bundle_kernel_logs(result: TestResult, kconfig: Kconfig, test_name: str, launch_scripts: list, log_base_dir: str = RAW_LOG_DIR) -> dict:
+    """Split the kernel log of a boot that ran several launch scripts, and save one record per script.
+    Returns launch script -> saved kernel log, for the scripts a record was saved for"""
+    saved = {}
+    split_logs = split_bundle_log(result.get_kernel_log(), [os.path.basename(script) for script in launch_scripts])
+    for script in launch_scripts:
+        name = os.path.basename(script)
+        if name not in split_logs:
+            print(f"No output from {name} in bundled run of {test_name}, not saving a record for it")
+            continue
+        record_name = os.path.splitext(name)[0]
+        save_kernel_logs(RawKernelLogResult(split_logs[name], name=record_name),
+                         kconfig, test_name, log_base_dir, record_name=record_name)
+        saved[script] = split_logs[name]
+    return saved
+
+
+def save_run_kernel_logs(result: TestResult, kconfig: Kconfig, test_name: str, launch_script, log_base_dir: str = RAW_LOG_DIR) -> dict:
+    """Save the kernel logs of a run, split per launch script if several were bundled into the boot.
+    Returns launch script -> saved kernel log, for the scripts a record was saved for"""
+    if isinstance(launch_script, list):
+        return save_bundle_kernel_logs(result, kconfig, test_name, launch_script, log_base_dir)
+    save_kernel_logs(result, kconfig, test_name, log_base_dir)
+    return {launch_script: result.get_kernel_log()}
+
+
+def run_linux_benchmark(test_name: str, kconfig: Kconfig, build_function: str, launch_script: str = LAUNCH_SCRIPT, interactive: bool = False, log_base_dir: str = RAW_LOG_DIR, extra_args: str = None, lease: QemuLease = None, on_stage: Callable[[str], None] = None) -> TestResult:
+    """Run a linux kernel benchmark
+    - launch_script: a list of launch scripts runs them all in one boot, each saved as its own record
+    - lease: host resources for the VM, required when several benchmarks boot at once
+    - on_stage: called with "download", "build" and "run" as each step starts"""
 
     tester = build_tester(test_name=test_name,
                           kconfig=kconfig,
                           build_function=build_function,
                           launch_script=launch_script,
-                          extra_args=extra_args)
+                          extra_args=extra_args,
+                          lease=lease)
 
     # TODO add support for adding a 'run label' to runs, which allows identifying runs with different configs but same target name
 
-    result = tester.download()
+    if on_stage is not None:
+        on_stage("download")
+    result = tester.run_stage("download", tester.download)
     if (result.is_failure()):
         print("Failed to download components")
         print(result.message, result.error)
         return None
-    result = tester.build(rebuild=False, interactive=interactive)
+    if on_stage is not None:
+        on_stage("build")
+    result = tester.run_stage("build", tester.build, rebuild=False, interactive=interactive)
     if (result.is_failure()):
         print("Failed to build components")
         print(result.message, result.error)
@@ -159,31 +235,172 @@ def run_linux_benchmark(test_name: str, kconfig: Kconfig, build_function: str, l
         tester.run_interactive()
         return None
 
-    result = tester.run()
+    if on_stage is not None:
+        on_stage("run")
+    result = tester.run_stage("run", tester.run)
     if (result.is_failure()):
         print("Failed to run test")
         print(result.message, result.error)
         return None
 
     if (log_base_dir is not None):
-        kernel_logs = result.get_kernel_log()
-        log_full_base = saved_kernel_log_dir(
-            log_base_dir, kconfig, test_name)
-        os.makedirs(log_full_base, exist_ok=True)
-
-        # Save full kernel log to json
-        json_current_path = build_saved_kernel_log_path(
-            log_base_dir, kconfig, test_name)
-        kernel_logs.to_JSON(json_current_path)
-
-        # Save copy of json with date/time in name
-        date_time_str = datetime.now().strftime("%d_%m_%y-%H:%M:%S")
-        json_full_path = os.path.join(
-            log_full_base, f"kernel_{date_time_str}.json")
-        kernel_logs.to_JSON(json_full_path)
-
-        # Dump to current path in only log readable format
-        log_current_path = os.path.join(log_full_base, "kernel_current.log")
-        kernel_logs.dump_log(log_current_path)
+        save_run_kernel_logs(result, kconfig, test_name, launch_script, log_base_dir)
 
     return result
+
+
+def run_linux_benchmark_agent(test_name: str, kconfig: Kconfig, build_function: str, runs: list,
+                              log_base_dir: str = RAW_LOG_DIR, extra_args: str = None, lease: QemuLease = None,
+                              on_stage: Callable[[str], None] = None, on_record: Callable[[str, int, bool], None] = None) -> bool:
+    """Run a list of (launch script, iteration) pairs in a single boot, driven over the guest agent
+    instead of rebooting for each. Each run is saved as its own record
+    - on_record: called with (launch_script, iteration, success) after each run
+    Returns False if the kernel couldn't be built/booted, per run failures only go to on_record"""
+    launch_scripts = list(dict.fromkeys(script for script, _ in runs))
+    tester = build_tester(test_name=test_name,
+                          kconfig=kconfig,
+                          build_function=build_function,
+                          launch_script=launch_scripts,
+                          extra_args=extra_args,
+                          lease=lease,
+                          agent=True)
+
+    if on_stage is not None:
+        on_stage("download")
+    result = tester.run_stage("download", tester.download)
+    if (result.is_failure()):
+        print("Failed to download components")
+        print(result.message, result.error)
+        return False
+    if on_stage is not None:
+        on_stage("build")
+    result = tester.run_stage("build", tester.build, rebuild=False)
+    if (result.is_failure()):
+        print("Failed to build components")
+        print(result.message, result.error)
+        return False
+
+    if on_stage is not None:
+        on_stage("run")
+    agent_runner = start_agent(tester)
+    if agent_runner is None:
+        print("Failed to boot with the guest agent")
+        return False
+
+    try:
+        run_agent_runs(agent_runner, tester, runs, kconfig, test_name, log_base_dir, on_record)
+    finally:
+        agent_runner.stop()
+
+    return True
+
+
+def start_agent(tester: KernelTester):
+    """tester.start_agent(), retried like any other run (see microwave2/testers/retry.py)"""
+    started = {}
+
+    def start() -> Result:
+        started["agent_runner"] = tester.start_agent()
+        if started["agent_runner"] is None:
+            return Result.failure("Failed to boot with the guest agent")
+        return Result.success()
+
+    tester.run_stage("run", start)
+    return started.get("agent_runner")
+
+
+def run_agent_runs(agent_runner, tester: KernelTester, runs: list, kconfig: Kconfig, test_name: str,
+                   log_base_dir: str = RAW_LOG_DIR, on_record: Callable[[str, int, bool], None] = None):
+    """Run (launch script, iteration) pairs on a started AgentRunner, each saved as its own record"""
+    for script, iteration in runs:
+        record_name = f"{os.path.splitext(os.path.basename(script))[0]}-i{iteration}"
+        result = agent_runner.run(os.path.join("/test", script), name=record_name, iteration=iteration)
+        if not result.is_failure():
+            result = tester.check_loaded_modules(result)
+        if not result.is_failure():
+            # The boot's attempts, the agent doesn't retry single runs
+            result.get_kernel_log().attempts = [attempt.to_json() for attempt in tester.attempts]
+        if result.is_failure():
+            print(f"Failed to run {script} (iteration {iteration})")
+            print(result.message, result.error)
+        elif log_base_dir is not None:
+            save_kernel_logs(result, kconfig, test_name, log_base_dir, record_name=record_name)
+        if on_record is not None:
+            on_record(script, iteration, not result.is_failure())
+
+
+def run_linux_benchmark_kexec(segments: list, build_function: str, log_base_dir: str = RAW_LOG_DIR,
+                              on_stage: Callable[[str, str], None] = None,
+                              on_record: Callable[[str, str, int, bool], None] = None) -> dict:
+    """Run several kernels' (launch script, iteration) pairs in one VM: the first kernel boots with the
+    guest agent, then the VM kexecs into each next one instead of QEMU starting again. Every kernel
+    is built first. The VM keeps the first kernel's image, so this is meant for kernel only builds
+    - segments: (test_name, kconfig, extra_args, runs) per kernel, in the order they run
+    - on_stage: called with (test_name, stage) as each step of a kernel starts
+    - on_record: called with (test_name, launch_script, iteration, success) after each run
+    Returns test_name -> whether that kernel was built and booted, per run failures only go to on_record"""
+    # Every image gets every script, since the one that boots runs them all
+    launch_scripts = list(dict.fromkeys(script for _, _, _, runs in segments for script, _ in runs))
+
+    testers = {}
+    for test_name, kconfig, extra_args, runs in segments:
+        tester = build_tester(test_name=test_name,
+                              kconfig=kconfig,
+                              build_function=build_function,
+                              launch_script=launch_scripts,
+                              extra_args=extra_args,
+                              agent=True)
+        if on_stage is not None:
+            on_stage(test_name, "download")
+        result = tester.run_stage("download", tester.download)
+        if (result.is_failure()):
+            print(f"Failed to download components of {test_name}")
+            print(result.message, result.error)
+            continue
+        if on_stage is not None:
+            on_stage(test_name, "build")
+        result = tester.run_stage("build", tester.build, rebuild=False)
+        if (result.is_failure()):
+            print(f"Failed to build components of {test_name}")
+            print(result.message, result.error)
+            continue
+        if not tester.config.target_config.build_options.kernel_only:
+            print(f"Warning: {test_name} isn't a kernel only build, its modules won't be in the VM after a kexec")
+        testers[test_name] = tester
+
+    booted = {test_name: False for test_name, _, _, _ in segments}
+    agent_runner = None
+    try:
+        for test_name, kconfig, extra_args, runs in segments:
+            tester = testers.get(test_name)
+            if tester is None:
+                continue
+            if on_stage is not None:
+                on_stage(test_name, "run")
+
+            if agent_runner is not None:
+                kernel_path, cmdline = tester.get_boot_kernel()
+                result = agent_runner.switch_kernel(kernel_path, cmdline)
+                if result.is_failure():
+                    # The VM is most likely gone, start over with a fresh one
+                    print(f"Failed to kexec into {test_name}, booting it instead")
+                    print(result.message, result.error)
+                    agent_runner.stop()
+                    agent_runner = None
+            if agent_runner is None:
+                agent_runner = start_agent(tester)
+                if agent_runner is None:
+                    print(f"Failed to boot {test_name} with the guest agent")
+                    continue
+
+            booted[test_name] = True
+            record = None
+            if on_record is not None:
+                def record(script, iteration, success, test_name=test_name):
+                    on_record(test_name, script, iteration, success)
+            run_agent_runs(agent_runner, tester, runs, kconfig, test_name, log_base_dir, record)
+    finally:
+        if agent_runner is not None:
+            agent_runner.stop()
+
+    return booted
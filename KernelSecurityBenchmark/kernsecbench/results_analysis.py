@@ -11,6 +11,7 @@ from datetime import datetime
 from collections import defaultdict
 import math
 from scipy.stats import linregress   # SciPy gives r², stderr, etc.
+from scipy.stats import t as student_t
 
 
 def _fit_power_law(x: np.ndarray, y: np.ndarray):
@@ -621,6 +622,49 @@ def merge_run_map(raw_run_map: dict[str, list[list[dict]]]):
     return merged_map
 
 
+def overhead_confidence(merged_map: dict[str, list[dict]], baseline: str = "basline",
+                        confidence: float = 0.95) -> dict[str, dict[str, dict]]:
+    """
+    Overhead of every run vs `baseline`, with a confidence interval, from the
+    output of `merge_run_map`.
+
+    Returns
+    -------
+    { run_name : { metric : {overhead_pct, ci_half_width_pct, sample_count} } }
+        ci_half_width_pct is inf until both run and baseline have >= 2 samples.
+        Metrics the baseline doesn't have (or with a zero baseline mean) are skipped.
+    """
+    if baseline not in merged_map:
+        return {}
+    base_rows = {m["metric"]: m for m in merged_map[baseline]}
+
+    out: dict[str, dict[str, dict]] = {}
+    for run_name, rows in merged_map.items():
+        if run_name == baseline:
+            continue
+        per_metric = {}
+        for m in rows:
+            b = base_rows.get(m["metric"])
+            if b is None or b["value"] == 0:
+                continue
+            overhead = (m["value"] - b["value"]) / abs(b["value"]) * 100
+            n, n_b = m["sample_count"], b["sample_count"]
+            if n < 2 or n_b < 2:
+                half_width = math.inf
+            else:
+                # Welch style standard error, with the smaller sample's dof to stay conservative
+                stderr = math.sqrt(m["stdev"] ** 2 / n + b["stdev"] ** 2 / n_b)
+                t_crit = student_t.ppf(0.5 + confidence / 2, min(n, n_b) - 1)
+                half_width = t_crit * stderr / abs(b["value"]) * 100
+            per_metric[m["metric"]] = {
+                "overhead_pct":      overhead,
+                "ci_half_width_pct": half_width,
+                "sample_count":      n,
+            }
+        out[run_name] = per_metric
+    return out
+
+
 # ----------------------------------------------------------------------
 # 2.  Simple descriptive statistics
 # ----------------------------------------------------------------------
@@ -0,0 +1,255 @@
+"""
+Shared job queue so several benchmark hosts can work through one campaign. Jobs (config x launch
+script(s) x iteration) live in an SQLite file in a shared directory, workers claim them with
+expiring leases and keep them alive with heartbeats. A job whose worker died goes back to the queue
+once its lease expires.
+"""
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+from kernsecbench.microwave_wrapper import RAW_LOG_DIR
+from kernsecbench.campaign import CampaignManifest, DONE, FAILED
+from kernsecbench.test_configs import kconfig_map
+
+PENDING = "pending"
+CLAIMED = "claimed"
+
+QUEUE_DB_NAME = "queue.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    config TEXT NOT NULL,
+    launch_scripts TEXT NOT NULL,
+    iteration INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    heartbeat REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    message TEXT,
+    UNIQUE (config, launch_scripts, iteration)
+);
+"""
+
+
+class WorkQueue:
+    """SQLite backed job queue. Every state change happens in a BEGIN IMMEDIATE transaction,
+    so any number of worker processes (on any host that can see queue_dir) can share it"""
+
+    def __init__(self, queue_dir: str, max_attempts: int = 3):
+        self.queue_dir = queue_dir
+        self.path = os.path.join(queue_dir, QUEUE_DB_NAME)
+        self.max_attempts = max_attempts
+        os.makedirs(queue_dir, exist_ok=True)
+        with closing(self.connect()) as conn:
+            conn.executescript(SCHEMA)
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def transaction(self, func):
+        """Run func(conn) inside a write transaction, returns its result"""
+        with closing(self.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(conn)
+                conn.execute("COMMIT")
+                return result
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, config: str, launch_script, iteration: int) -> bool:
+        """Add a job, launch_script can be a list to bundle several into one boot. Returns False
+        if the job was already queued"""
+        scripts = launch_script if isinstance(launch_script, list) else [launch_script]
+
+        def do_enqueue(conn):
+            cursor = conn.execute("""INSERT OR IGNORE INTO jobs (config, launch_scripts, iteration, state)
+                                     VALUES (?, ?, ?, ?)""", (config, json.dumps(scripts), iteration, PENDING))
+            return cursor.rowcount == 1
+        return self.transaction(do_enqueue)
+
+    def expire_leases(self, conn, now: float):
+        """Requeue claimed jobs whose lease ran out (their worker crashed or hung), or fail them
+        once they've used up their attempts"""
+        expired = conn.execute("SELECT id, worker, attempts FROM jobs WHERE state=? AND lease_expires < ?",
+                               (CLAIMED, now)).fetchall()
+        for job in expired:
+            print(f"[WorkQueue] Lease of job {job['id']} held by {job['worker']} expired")
+            state = FAILED if job["attempts"] >= self.max_attempts else PENDING
+            conn.execute("UPDATE jobs SET state=?, worker=NULL, lease_expires=NULL, message=? WHERE id=?",
+                         (state, f"Lease held by {job['worker']} expired", job["id"]))
+
+    def claim(self, worker_id: str, lease_seconds: float) -> dict:
+        """Claim the oldest pending job, None if there isn't one"""
+        def do_claim(conn):
+            now = time.time()
+            self.expire_leases(conn, now)
+            job = conn.execute("SELECT * FROM jobs WHERE state=? ORDER BY iteration, id LIMIT 1", (PENDING,)).fetchone()
+            if job is None:
+                return None
+            conn.execute("""UPDATE jobs SET state=?, worker=?, lease_expires=?, heartbeat=?, attempts=attempts + 1
+                            WHERE id=?""", (CLAIMED, worker_id, now + lease_seconds, now, job["id"]))
+            job = dict(job)
+            job["launch_scripts"] = json.loads(job["launch_scripts"])
+            return job
+        return self.transaction(do_claim)
+
+    def heartbeat(self, job_id: int, worker_id: str, lease_seconds: float) -> bool:
+        """Extend the lease on a job, False if the worker no longer holds it"""
+        def do_heartbeat(conn):
+            now = time.time()
+            cursor = conn.execute("""UPDATE jobs SET lease_expires=?, heartbeat=?
+                                     WHERE id=? AND worker=? AND state=?""",
+                                  (now + lease_seconds, now, job_id, worker_id, CLAIMED))
+            return cursor.rowcount == 1
+        return self.transaction(do_heartbeat)
+
+    def finish(self, job_id: int, worker_id: str, success: bool, message: str = None) -> bool:
+        """Mark a claimed job done, or requeue it (failed once out of attempts). False if the
+        worker no longer held the job (its lease expired and it may have run elsewhere)"""
+        def do_finish(conn):
+            job = conn.execute("SELECT attempts FROM jobs WHERE id=? AND worker=? AND state=?",
+                               (job_id, worker_id, CLAIMED)).fetchone()
+            if job is None:
+                return False
+            if success:
+                state = DONE
+            else:
+                state = FAILED if job["attempts"] >= self.max_attempts else PENDING
+            conn.execute("UPDATE jobs SET state=?, worker=NULL, lease_expires=NULL, message=? WHERE id=?",
+                         (state, message, job_id))
+            return True
+        return self.transaction(do_finish)
+
+    def release_worker(self, worker_id: str):
+        """Put back any jobs a previous process with the same worker id left claimed"""
+        def do_release(conn):
+            cursor = conn.execute("""UPDATE jobs SET state=?, worker=NULL, lease_expires=NULL, message=?
+                                     WHERE worker=? AND state=?""",
+                                  (PENDING, f"Released on restart of {worker_id}", worker_id, CLAIMED))
+            return cursor.rowcount
+        return self.transaction(do_release)
+
+    def remaining(self) -> int:
+        """Jobs that are pending or claimed"""
+        with closing(self.connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE state IN (?, ?)", (PENDING, CLAIMED)).fetchone()[0]
+
+    def summary(self) -> dict:
+        with closing(self.connect()) as conn:
+            rows = conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return {row[0]: row[1] for row in rows}
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def enqueue_campaign(queue_dir: str, num_iters: int, launch_scripts: list, bundle: bool = False,
+                     log_base_dir: str = RAW_LOG_DIR) -> int:
+    """Queue num_iters new iterations of every config and launch script (one job per config and
+    iteration if bundled). Cells are also recorded in the campaign manifest of log_base_dir"""
+    queue = WorkQueue(queue_dir)
+    manifest = CampaignManifest(os.path.join(log_base_dir, "campaign.sqlite"))
+    cells = manifest.queue_new_iterations(list(kconfig_map.keys()), launch_scripts, num_iters)
+
+    num_jobs = 0
+    if bundle:
+        bundles = {}
+        for config, script, iteration in cells:
+            bundles.setdefault((config, iteration), []).append(script)
+        for (config, iteration), scripts in bundles.items():
+            ordered = [script for script in launch_scripts if script in scripts]
+            num_jobs += queue.enqueue(config, ordered, iteration)
+    else:
+        for config, script, iteration in cells:
+            num_jobs += queue.enqueue(config, script, iteration)
+
+    print(f"Queued {num_jobs} jobs in {queue_dir}")
+    return num_jobs
+
+
+def run_worker(queue_dir: str, worker_id: str = None, lease_seconds: float = 3600, heartbeat_seconds: float = 60,
+               poll_seconds: float = 30, exit_when_empty: bool = False, slot: int = None,
+               log_base_dir: str = RAW_LOG_DIR, dry_run: float = None):
+    """Claim and run jobs until the queue is empty (or forever, polling, unless exit_when_empty).
+    - slot: QemuResourceAllocator slot to run VMs in, give each worker on one host its own
+    - dry_run: instead of booting, sleep this many seconds and succeed (to test the queue itself)"""
+    if worker_id is None:
+        worker_id = default_worker_id()
+    queue = WorkQueue(queue_dir)
+    manifest = CampaignManifest(os.path.join(log_base_dir, "campaign.sqlite"))
+
+    released = queue.release_worker(worker_id)
+    if released:
+        print(f"[Worker {worker_id}] Released {released} jobs left claimed by a previous run")
+
+    allocator = None
+    if slot is not None and dry_run is None:
+        from microwave2.utils.qemu import QemuResourceAllocator
+        allocator = QemuResourceAllocator()
+
+    while True:
+        job = queue.claim(worker_id, lease_seconds)
+        if job is None:
+            if exit_when_empty and queue.remaining() == 0:
+                print(f"[Worker {worker_id}] Queue empty, exiting")
+                break
+            time.sleep(poll_seconds)
+            continue
+
+        config, scripts, iteration = job["config"], job["launch_scripts"], job["iteration"]
+        launch_script = scripts if len(scripts) > 1 else scripts[0]
+        print(f"[Worker {worker_id}] Claimed job {job['id']}: {config} {scripts} iteration {iteration} (attempt {job['attempts'] + 1})")
+
+        # Keep the lease alive while the job runs
+        stop_heartbeat = threading.Event()
+
+        def heartbeat_loop(job_id=job["id"]):
+            while not stop_heartbeat.wait(heartbeat_seconds):
+                if not queue.heartbeat(job_id, worker_id, lease_seconds):
+                    print(f"[Worker {worker_id}] Lost lease on job {job_id}")
+                    return
+        heartbeat_thread = threading.Thread(target=heartbeat_loop, daemon=True)
+        heartbeat_thread.start()
+
+        lease = None
+        try:
+            if dry_run is not None:
+                time.sleep(dry_run)
+                for script in scripts:
+                    manifest.set_state(config, script, iteration, DONE, f"Dry run by {worker_id}")
+                success, message = True, None
+            else:
+                # Imported here so dry runs don't need the benchmark/analysis dependencies
+                from kernsecbench.benchmark import run_config
+                if allocator is not None:
+                    lease = allocator.acquire(f"test_lmbench_{config}-linux.img", slot=slot)
+                success = run_config(config, launch_script, "lmbench", manifest=manifest, iteration=iteration,
+                                     lease=lease, log_base_dir=log_base_dir)
+                message = None if success else "Run failed"
+        except Exception as e:
+            print(f"[Worker {worker_id}] Job {job['id']} raised: {e}")
+            success, message = False, str(e)
+        finally:
+            stop_heartbeat.set()
+            heartbeat_thread.join()
+            if lease is not None:
+                allocator.release(lease)
+
+        if not queue.finish(job["id"], worker_id, success, message):
+            print(f"[Worker {worker_id}] Job {job['id']} was reclaimed before finishing, result may be duplicated")
+        else:
+            print(f"[Worker {worker_id}] Finished job {job['id']}: {'success' if success else message}")
+
+    print(f"[Worker {worker_id}] Queue state: {queue.summary()}")
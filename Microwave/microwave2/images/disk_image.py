@@ -78,4 +78,8 @@ class DiskImage:
         self.edit_mode = False
 
         return Result.success()
+
+    def cleanup(self):
+        """Release any host resources held by the image (mounts, output files), should be overriden if needed"""
+        pass
        
@@ -0,0 +1,153 @@
+"""
+Read-only ext4 side disk carrying everything a run adds to the guest (test code, kernel modules and
+headers, init script), built with mke2fs -d so no root, nbd device or mount is needed on the host.
+The guest hook (see build_payload_hook) copies it over / at login and runs the init script.
+Images are cached by content hash, so repeat runs of the same test and kernel reuse one file. The
+cache is kept under a size budget by dropping the least recently used images (see prune_payload_cache).
+"""
+import hashlib
+import os
+import shutil
+import time
+
+from microwave2.results.result import Result
+from microwave2.utils.log import log, warn, error, debug, info
+from microwave2.utils.utils import run_command_better
+
+PAYLOAD_LABEL = "MWPAYLOAD"
+# Layout inside the payload: rootfs/ is merged onto the guest's /, the rest sits next to it
+PAYLOAD_ROOTFS = "rootfs"
+PAYLOAD_INIT_NAME = "microwave_init.sh"
+PAYLOAD_AUTORUN_NAME = "autorun"
+
+# Headroom for ext4 metadata on top of the file contents
+PAYLOAD_SLACK_MB = 16
+# Sizes are rounded up to this (the file is sparse), so most payloads come out the same size. A warm
+# start snapshot only fits payload disks of the size it was taken with
+PAYLOAD_SIZE_STEP_MB = 64
+
+# Disk space the cached images may take (MICROWAVE_PAYLOAD_CACHE_MB overrides it)
+DEFAULT_PAYLOAD_CACHE_MB = 8192
+# Images used more recently than this are never evicted, another run may be about to boot with one
+PAYLOAD_MIN_AGE = 3600
+
+
+def tree_hash(root: str) -> str:
+    """Hash of the relative paths, modes, symlink targets and contents of every file under root"""
+    sha = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]):
+            path = os.path.join(dirpath, name)
+            stat = os.lstat(path)
+            sha.update(f"{os.path.relpath(path, root)}\0{stat.st_mode}\0".encode())
+            if os.path.islink(path):
+                sha.update(os.readlink(path).encode())
+                continue
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    sha.update(chunk)
+        for name in dirnames:
+            sha.update(f"{os.path.relpath(os.path.join(dirpath, name), root)}/\0".encode())
+    return sha.hexdigest()[:16]
+
+
+def tree_size_mb(root: str) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            total += os.lstat(os.path.join(dirpath, name)).st_size
+    return total // (1 << 20) + 1
+
+
+def prune_payload_cache(cache_dir: str, max_mb: int, keep: str = None):
+    """Delete the least recently used payload images until the cache fits in max_mb (counting the
+    blocks actually used, the images are sparse). keep and images used in the last PAYLOAD_MIN_AGE
+    seconds stay, even if that leaves the cache over budget"""
+    images = []
+    for name in os.listdir(cache_dir):
+        if not (name.startswith("payload-") and name.endswith(".ext4")):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        images.append((stat.st_mtime, stat.st_blocks * 512, path))
+    total = sum(size for _, size, _ in images)
+    budget = max_mb << 20
+    now = time.time()
+    for mtime, size, path in sorted(images):
+        if total <= budget:
+            break
+        if path == keep or now - mtime < PAYLOAD_MIN_AGE:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        info(f"[PayloadDisk] Evicted {os.path.basename(path)} from the payload cache")
+
+
+class PayloadDisk:
+    """Staging directory that is filled like a mounted image would be, then turned into a cached
+    ext4 image by build()"""
+    def __init__(self, staging_dir: str, cache_dir: str, max_cache_mb: int = None):
+        self.staging_dir = staging_dir
+        self.cache_dir = cache_dir
+        if max_cache_mb is None:
+            max_cache_mb = int(os.environ.get("MICROWAVE_PAYLOAD_CACHE_MB", DEFAULT_PAYLOAD_CACHE_MB))
+        self.max_cache_mb = max_cache_mb
+        self.image_path = None
+
+    def get_rootfs_dir(self) -> str:
+        return os.path.join(self.staging_dir, PAYLOAD_ROOTFS)
+
+    def get_init_path(self) -> str:
+        return os.path.join(self.staging_dir, PAYLOAD_INIT_NAME)
+
+    def reset(self):
+        """Start from an empty staging dir"""
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+        os.makedirs(self.get_rootfs_dir())
+        self.image_path = None
+
+    def set_init_script(self, init_script: str, autorun: bool):
+        with open(self.get_init_path(), "w") as f:
+            f.write(init_script)
+        os.chmod(self.get_init_path(), 0o755)
+        autorun_path = os.path.join(self.staging_dir, PAYLOAD_AUTORUN_NAME)
+        if autorun:
+            open(autorun_path, "w").close()
+        elif os.path.exists(autorun_path):
+            os.remove(autorun_path)
+
+    def build(self) -> Result:
+        """Build (or reuse) the ext4 image for the current staging contents"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        content_hash = tree_hash(self.staging_dir)
+        image_path = os.path.join(self.cache_dir, f"payload-{content_hash}.ext4")
+        if os.path.exists(image_path):
+            info(f"[PayloadDisk] Reusing payload {content_hash}")
+            # mtime is the last use, for eviction
+            os.utime(image_path)
+            self.image_path = image_path
+            return Result.success()
+
+        size_mb = int(tree_size_mb(self.staging_dir) * 1.3) + PAYLOAD_SLACK_MB
+        size_mb = -(-size_mb // PAYLOAD_SIZE_STEP_MB) * PAYLOAD_SIZE_STEP_MB
+        tmp_path = f"{image_path}.{os.getpid()}.tmp"
+        command = ["mke2fs", "-q", "-F", "-t", "ext4", "-L", PAYLOAD_LABEL, "-d", self.staging_dir, tmp_path, f"{size_mb}M"]
+        result = run_command_better(command, verbose=True)
+        if result.is_failure():
+            error(f"[PayloadDisk] Failed to build payload image: {result.get_stderr()}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return result
+
+        os.replace(tmp_path, image_path)
+        info(f"[PayloadDisk] Built payload {content_hash} ({size_mb} MB)")
+        self.image_path = image_path
+        prune_payload_cache(self.cache_dir, self.max_cache_mb, keep=image_path)
+        return Result.success()
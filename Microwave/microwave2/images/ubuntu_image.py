@@ -1,3 +1,4 @@
+import fcntl
 import os
 
 # from tempfile import NamedTemporaryFile
@@ -15,9 +16,12 @@ from microwave2.utils.log import log, warn, error, debug, info
 from typing import List, Optional
 
 from microwave2.utils.utils import Arch, get_arch_string_ubuntu_url, download_url, run_command, mount_device, umount, debug_pause, makedirs, mount_by_label, bind_mount, run_chroot_command
-from microwave2.utils.qemu import launch_kernel_raw, QemuDrive, SimpleQemuParam, QemuCommand, QemuResources, QemuKernel, qemu_nbd_connect, qemu_nbd_disconnect, qemu_img_resize
+from microwave2.utils.qemu import launch_kernel_raw, QemuDrive, SimpleQemuParam, QemuCommand, QemuResources, QemuKernel, QemuLease, qemu_nbd_connect, qemu_nbd_disconnect, qemu_img_resize, qemu_img_create_overlay, BOOT_PROFILE_DEFAULT, BOOT_PROFILE_FAST, X86_CUSTOM_KERNEL, X86_MICROVM
 from microwave2.local_storage import local_paths
+from microwave2.utils.console_policy import ConsolePolicy, get_console_policy, CONSOLE_SERIAL
 from microwave2.images.ubuntu_resources import get_userdata,METADATA,CLOUD_MINIMAL_IMG_URL_ARM,CLOUD_MINIMAL_IMG_URL_X86,CLOUD_IMG_URL_X86,CLOUD_IMG_URL_ARM,build_bash_profile, get_kernel_cmdline
+from microwave2.images.ubuntu_resources import get_guest_hooks, get_guest_config_files, get_payload_hook_profile_line
+from microwave2.images.payload_disk import PayloadDisk
 import tempfile
 import platform
 
@@ -37,7 +41,11 @@ class UbuntuDiskImage(DiskImage):
     """Image for testing, can be built from scratch. Really three copies:
     - base image, unmodified and downloaded from ubuntu
     - template image, modified with cloud-init -- modifications to this are shared for all tests on the machine
-    - final image, a copy of the working image that will be modified per test"""
+    - final image, a copy of the working image that will be modified per test
+    By default the final image is a thin qcow2 overlay on the template (or on a named layer, itself an
+    overlay on the template), so creating it writes almost nothing. MICROWAVE_IMAGE_OVERLAY=0 copies instead.
+    With payload=True (or MICROWAVE_IMAGE_PAYLOAD=1) the final image is never mounted: edits go to a
+    PayloadDisk that is attached at boot and unpacked by the guest, so runs need no root or nbd device"""
     def __init__(
             self,
             arch: Arch,
@@ -45,7 +53,13 @@ class UbuntuDiskImage(DiskImage):
             temp_dir: str=None,
             output_dir: str=None,
             base_url: str=None,
-            size_gb: int=25) -> None:
+            size_gb: int=25,
+            lease: QemuLease=None,
+            overlay: bool=None,
+            base_layer: str=None,
+            payload: bool=None,
+            boot_profile: str=None,
+            console_policy: ConsolePolicy=None) -> None:
         
         # Call parent constructor
         super().__init__(arch=arch, image_name=image_name, temp_dir=temp_dir, output_dir=output_dir)
@@ -77,10 +91,48 @@ class UbuntuDiskImage(DiskImage):
         # self.is_mounted = False
         self.mountpoint = os.path.join(self.temp_workdir, "mountpoint")
         self.boot_partition_mountpoint = os.path.join(self.mountpoint, "boot")
-        self.devname = "/dev/nbd2" # TODO make this configurable
+        self.devname = "/dev/nbd2"
+        self.lease = None
+        if lease is not None:
+            self.set_lease(lease)
 
         self.use_override_kernel = False
         self.installed_kernel_dir = None
+        self.pvh_kernel_path = None
+        self.cleaned_up = False
+
+        if overlay is None:
+            overlay = os.environ.get("MICROWAVE_IMAGE_OVERLAY") != "0"
+        self.overlay = overlay
+        # Optional intermediate layer (e.g. per config) that output images are overlaid on
+        self.base_layer = base_layer
+
+        if payload is None:
+            payload = os.environ.get("MICROWAVE_IMAGE_PAYLOAD") == "1"
+        self.payload = payload
+        self.payload_disk = None # Created per construct, since the image name can change with the lease
+
+        # Default boot profile for boot_image, MICROWAVE_BOOT_PROFILE=fast opts into microvm + minimal init
+        if boot_profile is None:
+            boot_profile = os.environ.get("MICROWAVE_BOOT_PROFILE", BOOT_PROFILE_DEFAULT)
+        self.boot_profile = boot_profile
+
+        # Where guest output goes (see utils/console_policy.py), MICROWAVE_CONSOLE_POLICY=quiet keeps
+        # benchmark output off the serial console
+        if console_policy is None:
+            console_policy = get_console_policy()
+        self.console_policy = console_policy
+
+    def set_lease(self, lease: QemuLease):
+        """Use the output image name, nbd device and ports from a lease, so concurrent runs don't collide.
+        Must be called before the image is constructed."""
+        if self.is_editable():
+            raise Exception("Can't change lease while image is being edited")
+        self.lease = lease
+        self.image_name = lease.image_name
+        self.mountpoint = os.path.join(self.temp_workdir, f"mountpoint-slot{lease.slot}")
+        self.boot_partition_mountpoint = os.path.join(self.mountpoint, "boot")
+        self.devname = lease.nbd_device
 
     def base_image_path(self):
         """Path to the base image file"""
@@ -90,6 +142,109 @@ class UbuntuDiskImage(DiskImage):
         """Path to the template image file"""
         return os.path.join(self.temp_workdir, f"template-ubuntu-{self.arch.ubuntu_url_str()}.qcow2")
     
+    def layer_image_path(self, layer_name: str):
+        """Path to a named intermediate layer image"""
+        return os.path.join(self.temp_workdir, f"layer-{layer_name}-ubuntu-{self.arch.ubuntu_url_str()}.qcow2")
+
+    def delete_layers(self):
+        """Remove every layer, they are only valid as long as the template they sit on is unchanged"""
+        suffix = f"-ubuntu-{self.arch.ubuntu_url_str()}.qcow2"
+        for name in os.listdir(self.temp_workdir):
+            if name.startswith("layer-") and name.endswith(suffix):
+                info(f"[UbuntuDiskImage] Removing stale layer {name}")
+                os.remove(os.path.join(self.temp_workdir, name))
+
+    def create_layer(self, layer_name: str, recreate: bool=False) -> Result:
+        """Create a named layer as an overlay on the template, if it doesn't exist yet"""
+        self.build_template_image(rebuild=False, redownload=False)
+        layer_path = self.layer_image_path(layer_name)
+        if os.path.exists(layer_path) and not recreate:
+            return Result.success()
+        if os.path.exists(layer_path):
+            os.remove(layer_path)
+        result = qemu_img_create_overlay(layer_path, self.template_image_path())
+        if result.is_failure():
+            error(f"[UbuntuDiskImage] Failed to create layer {layer_name}")
+        return result
+
+    def edit_layer(self, layer_name: str) -> Result:
+        """Mount a layer for editing (creating it if needed), changes are seen by every output image
+        built on it afterwards. No output image using the layer may be in use meanwhile"""
+        if self.is_editable():
+            return Result.failure("Image is already in edit mode")
+        result = self.create_layer(layer_name)
+        if result.is_failure():
+            return result
+        if self.mount_image(self.layer_image_path(layer_name)) is None:
+            return Result.failure(f"Failed to mount layer {layer_name}")
+        return DiskImage.construct(self, editable=True)
+
+    def guest_hooks_stamp_path(self):
+        """Exists once the template has the current guest hooks (payload hook, fast boot init, agent, hvc0 autologin) installed"""
+        return self.template_image_path() + ".guest-hooks-v8"
+
+    def ensure_guest_hooks(self) -> Result:
+        """Install the guest hooks into a template built before they were part of the cloud-init config.
+        Done once per template (the stamp file says it's done) under a lock, so concurrent constructs
+        don't both install. Needs root to mount the template, so the hooks go into a copy that then
+        replaces the template: VMs still running on the old one keep their file, nothing they read
+        from changes underneath them"""
+        if os.path.exists(self.guest_hooks_stamp_path()):
+            return Result.success()
+
+        with open(self.template_image_path() + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Someone else may have installed them while we waited
+            if os.path.exists(self.guest_hooks_stamp_path()):
+                return Result.success()
+            return self.install_guest_hooks()
+
+    def install_guest_hooks(self) -> Result:
+        """Copy of the template with the guest hooks installed replaces it, see ensure_guest_hooks"""
+        info("[UbuntuDiskImage] Installing guest hooks into template")
+        hooked_path = self.template_image_path() + ".hooks.tmp"
+        shutil.copy(self.template_image_path(), hooked_path)
+        if self.mount_image(hooked_path) is None:
+            self.unmount_image()
+            os.remove(hooked_path)
+            return Result.failure("Failed to mount template to install guest hooks")
+
+        success = True
+        for guest_path, contents in get_guest_hooks().items():
+            hook_path = os.path.join(self.temp_workdir, os.path.basename(guest_path))
+            with open(hook_path, "w") as f:
+                f.write(contents)
+            hook_dest = os.path.join(self.mountpoint, guest_path.lstrip("/"))
+            success = success and run_command(["sudo", "install", "-D", "-m", "755", hook_path, hook_dest])
+        for guest_path, contents in get_guest_config_files().items():
+            file_path = os.path.join(self.temp_workdir, os.path.basename(guest_path))
+            with open(file_path, "w") as f:
+                f.write(contents)
+            file_dest = os.path.join(self.mountpoint, guest_path.lstrip("/"))
+            success = success and run_command(["sudo", "install", "-D", "-m", "644", file_path, file_dest])
+        profile_path = os.path.join(self.mountpoint, "root", ".bash_profile")
+        profile_line = get_payload_hook_profile_line()
+        success = success and run_command(["sudo", "bash", "-c", f"grep -qxF '{profile_line}' {profile_path} 2>/dev/null || echo '{profile_line}' >> {profile_path}"])
+        self.unmount_image()
+        if not success:
+            os.remove(hooked_path)
+            return Result.failure("Failed to install guest hooks")
+
+        os.replace(hooked_path, self.template_image_path())
+        # The template changed underneath any existing layers
+        self.delete_layers()
+        open(self.guest_hooks_stamp_path(), "w").close()
+        return Result.success()
+
+    def payload_staging_dir(self):
+        return os.path.join(self.temp_workdir, f"payload-staging-{self.image_name}")
+
+    def get_edit_root(self):
+        """Directory standing in for the image's / while editing"""
+        if self.payload_disk is not None:
+            return self.payload_disk.get_rootfs_dir()
+        return self.mountpoint
+
     def download_base_image(self):
         """Unconditionally download the base image from the cloud to temp dir"""
 
@@ -131,6 +286,7 @@ class UbuntuDiskImage(DiskImage):
         # Get the first kernel file
         kernel_file = kernel_files[0]
         self.installed_kernel_path = os.path.join(installed_kernel_dir, kernel_file)
+        self.pvh_kernel_path = None
         debug(f"Found kernel file: {self.installed_kernel_path}")
         self.use_override_kernel = True
         print("Kernel override set to", installed_kernel_dir)
@@ -138,6 +294,10 @@ class UbuntuDiskImage(DiskImage):
         return Result.success()
         # return self.replace_boot_partition(installed_kernel_dir)
 
+    def set_pvh_kernel(self, vmlinux_path: str):
+        """Uncompressed vmlinux (built with CONFIG_PVH) to boot instead of the vmlinuz in the fast boot profile"""
+        self.pvh_kernel_path = vmlinux_path
+
     def replace_boot_partition(self, partition_contents: str) -> Result:
         """Replace contents of the boot partition with the specified folder. Does not fix up grub or efi."""
          
@@ -277,14 +437,16 @@ class UbuntuDiskImage(DiskImage):
             dest = dest[1:]
 
         # Construct full destination path
-        dest_full = os.path.join(self.mountpoint, dest)
+        dest_full = os.path.join(self.get_edit_root(), dest)
+        # Payload staging dirs belong to us, only a mounted image needs root
+        sudo = self.payload_disk is None
         
-        makedirs(dest_full, sudo=True, delete=False)
+        makedirs(dest_full, sudo=sudo, delete=False)
         print(f"Syncing folder from {source} to {dest_full}")
-        print(f"Mountpoint: {self.mountpoint}")
+        print(f"Mountpoint: {self.get_edit_root()}")
         # Rsync source to dest
         rsync_command = RsyncCommand(source=source, destination=dest_full, archive=True, verbose=False, force_copy_contents=True, delete=delete_contents)
-        success = rsync_command.sync_better(sudo=True)
+        success = rsync_command.sync_better(sudo=sudo)
 
         print("Sync success:", success)
         debug_pause("Folder synced")
@@ -305,11 +467,22 @@ class UbuntuDiskImage(DiskImage):
         if (rebuild):
             print("[ubuntu image][construct] WARNING: Rebuild flag does nothing for UbuntuDiskImage")
         
+        # These rely on scripts (or for a console other than the serial port, its autologin) installed in
+        # the template, which has to be final before an output image is overlaid on it
+        if self.payload or self.boot_profile == BOOT_PROFILE_FAST or self.console_policy.kernel_console != CONSOLE_SERIAL:
+            self.build_template_image(rebuild=False, redownload=False)
+            result = self.ensure_guest_hooks()
+            if result.is_failure():
+                return result
+
         # create output image
         self.create_output_image(rebuild=False, recopy=True)
 
+        if self.payload:
+            self.payload_disk = PayloadDisk(self.payload_staging_dir(), os.path.join(self.temp_workdir, "payloads"))
+            self.payload_disk.reset()
         # If editable, mount the image
-        if (editable):
+        elif (editable):
             self.mount_image()
 
         # debug_pause("Constructed image", 20)
@@ -324,7 +497,12 @@ class UbuntuDiskImage(DiskImage):
             print("Image is not in edit mode, can't finish edit")
             return Result.failure("Image is not in edit mode")
         
-        self.unmount_image()
+        if self.payload_disk is not None:
+            result = self.payload_disk.build()
+            if result.is_failure():
+                return result
+        else:
+            self.unmount_image()
 
         # Clears 'edit mode' flag
         return super().finish_edit()
@@ -413,6 +591,9 @@ class UbuntuDiskImage(DiskImage):
             print("Template image already exists, skipping build...")
             return
 
+        # Layers point at the old template's contents
+        self.delete_layers()
+
         # Copy the base image to the template image
         shutil.copy(self.base_image_path(), self.template_image_path())
 
@@ -424,6 +605,8 @@ class UbuntuDiskImage(DiskImage):
 
         # Boot the template image with the seed ISO
         self.boot_template_image(cloud_init_config=True)
+        # The cloud-init config installs the guest hooks
+        open(self.guest_hooks_stamp_path(), "w").close()
 
     def create_output_image(self, rebuild=False, recopy=False):
         """Create a new output image based on template image"""
@@ -437,16 +620,35 @@ class UbuntuDiskImage(DiskImage):
         # If necessary, download and build the template image
         self.build_template_image(rebuild=rebuild, redownload=False)
 
-        # Copy the template image to the output image
-        shutil.copy(self.template_image_path(), self.output_image_path())
+        if not self.overlay:
+            # Copy the template image to the output image
+            shutil.copy(self.template_image_path(), self.output_image_path())
+            return
+
+        backing_path = self.template_image_path()
+        if self.base_layer is not None:
+            result = self.create_layer(self.base_layer)
+            if result.is_success():
+                backing_path = self.layer_image_path(self.base_layer)
+            else:
+                warn(f"[UbuntuDiskImage] Layer {self.base_layer} unavailable, overlaying the template directly")
+
+        if os.path.exists(self.output_image_path()):
+            os.remove(self.output_image_path())
+        result = qemu_img_create_overlay(self.output_image_path(), backing_path)
+        if result.is_failure():
+            warn("[UbuntuDiskImage] Failed to create overlay image, falling back to a full copy")
+            shutil.copy(self.template_image_path(), self.output_image_path())
 
     # Mount the output image to free mountpoint
-    def mount_image(self):
-        """Mount the output image to a free mountpoint"""
+    def mount_image(self, image_path: str=None):
+        """Mount the output image (or image_path, e.g. a layer) to a free mountpoint"""
         self.unmount_image()
+        if image_path is None:
+            image_path = self.output_image_path()
         
         run_command(["sudo", "modprobe", "nbd", "max_part=8"])
-        dev = qemu_nbd_connect(self.devname, self.output_image_path())
+        dev = qemu_nbd_connect(self.devname, image_path)
         if dev is None:
             print("Failed to connect image to nbd")
             return None
@@ -527,29 +729,40 @@ class UbuntuDiskImage(DiskImage):
         return self.launch_marker
     
     # launch_script_path is relative path from /test dir (TODO should change this)
-    def set_launch_script(self, launch_script_path, target_name:str, autoshutdown=True, dmesg_redirect=True, autorun=True, script_name="microwave_init.sh"):
-        """Set the launch script for the image"""
-        if self.mountpoint is None:
+    def set_launch_script(self, launch_script_path, target_name:str, autoshutdown=True, dmesg_redirect=True, autorun=True, script_name="microwave_init.sh", agent=False):
+        """Set the launch script for the image. A list of launch scripts runs them all, in order, in one boot.
+        With agent, the boot starts the guest agent instead and the host runs the scripts over it"""
+        edit_root = self.get_edit_root()
+        if edit_root is None:
             print("No image mounted, can't set launch script")
             return
 
-        # Confirm launch script exists at /test/<launch_script_path>
-        # If launch_script_path has leading slash, remove it
-        if launch_script_path.startswith("/"):
-            rel_launch_script_path = launch_script_path[1:]
+        launch_script_paths = launch_script_path if isinstance(launch_script_path, list) else [launch_script_path]
+        image_launch_script_paths = []
+        for launch_script_path in launch_script_paths:
+            # Confirm launch script exists at /test/<launch_script_path>
+            # If launch_script_path has leading slash, remove it
+            if launch_script_path.startswith("/"):
+                rel_launch_script_path = launch_script_path[1:]
+            else:
+                rel_launch_script_path = launch_script_path
+                
+            full_launch_script_path = os.path.join(edit_root, rel_launch_script_path)
+            image_launch_script_path = os.path.join("/", rel_launch_script_path)
+            print("Mountpoint:", edit_root)
+            print("Full launch script path:", full_launch_script_path)
+            print("Launch script path:", launch_script_path)
+            print("Image launch script path:", image_launch_script_path)
+            if not os.path.exists(full_launch_script_path):
+                print("Launch script not found at", full_launch_script_path)
+                debug_pause()
+                return
+            image_launch_script_paths.append(image_launch_script_path)
+
+        if len(image_launch_script_paths) == 1:
+            image_launch_script_path = image_launch_script_paths[0]
         else:
-            rel_launch_script_path = launch_script_path
-            
-        full_launch_script_path = os.path.join(self.mountpoint, rel_launch_script_path)
-        image_launch_script_path = os.path.join("/", rel_launch_script_path)
-        print("Mountpoint:", self.mountpoint)
-        print("Full launch script path:", full_launch_script_path)
-        print("Launch script path:", launch_script_path)
-        print("Image launch script path:", image_launch_script_path)
-        if not os.path.exists(full_launch_script_path):
-            print("Launch script not found at", full_launch_script_path)
-            debug_pause()
-            return
+            image_launch_script_path = image_launch_script_paths
         
         print("Autoshutdown:", autoshutdown)
 
@@ -557,13 +770,20 @@ class UbuntuDiskImage(DiskImage):
 
         # TODO allow passing in arbitrary environment variables from caller (shouldn't really know about test and target here)
         init_script = build_bash_profile(image_launch_script_path, target_dir, "/test", autoshutdown=autoshutdown, dmesg_redirect=dmesg_redirect,
-                                          marker=self.launch_marker)
+                                          marker=self.launch_marker, agent=agent, console_policy=self.console_policy)
         
         print("Constructed init script")
         print(init_script)
         debug_pause()
-        # Add launch script to bash profile
-        temp_bash_path = os.path.join(self.temp_workdir, f"{script_name}")
+
+        # The guest's payload hook runs it, nothing in the image itself changes
+        if self.payload_disk is not None:
+            self.payload_disk.set_init_script(init_script, autorun=autorun)
+            print("Launch script set")
+            return
+
+        # Add launch script to bash profile (per image, so concurrent runs don't overwrite each other)
+        temp_bash_path = os.path.join(self.temp_workdir, f"{self.image_name}-{script_name}")
         with open(temp_bash_path, "w") as f:
             f.write(init_script)
         # Copy init script to image
@@ -585,8 +805,67 @@ class UbuntuDiskImage(DiskImage):
         print("Launch script set")
 
 
-    def boot_image(self, memory_mb=4096, cores=4, user_network=True, nographic=True, interactive=False, enable_kvm=False, gdb_str: str = None, aux_logfile_path: str=None, extra_args: str=None) -> subprocess.Popen:
-        """Boot the image, return subprocess of image (does not wait)"""
+    def get_boot_cmdline(self, extra_args: str=None, boot_profile: str=None, disable_cloud_init: bool=False) -> str:
+        """Command line the override kernel is booted with (also what AgentRunner.switch_kernel kexecs with)"""
+        if boot_profile is None:
+            boot_profile = self.boot_profile
+        cmdline = get_kernel_cmdline(disable_cloud_init=disable_cloud_init, fast_boot=boot_profile == BOOT_PROFILE_FAST,
+                                     console_policy=self.console_policy)
+        if extra_args is not None:
+            cmdline += " " + extra_args
+        return cmdline
+
+    def warm_snapshot_key(self, extra_args: str=None, boot_profile: str=None) -> Optional[dict]:
+        """Everything a warm start snapshot of the next boot depends on (see runners/warm_start.py),
+        None if it can't have one: that needs x86, an override kernel and a built payload disk, since
+        the snapshot is taken in the payload hook and everything after it has to come from the payload"""
+        if self.arch != Arch.X86 or not self.use_override_kernel or self.payload_disk is None or self.payload_disk.image_path is None:
+            return None
+        if boot_profile is None:
+            boot_profile = self.boot_profile
+
+        kernel_path = self.installed_kernel_path
+        if boot_profile == BOOT_PROFILE_FAST and self.pvh_kernel_path is not None:
+            kernel_path = self.pvh_kernel_path
+        backing_path = self.template_image_path()
+        if self.overlay and self.base_layer is not None and os.path.exists(self.layer_image_path(self.base_layer)):
+            backing_path = self.layer_image_path(self.base_layer)
+
+        def file_id(path):
+            if path is None or not os.path.exists(path):
+                return None
+            stat = os.stat(path)
+            return [os.path.realpath(path), stat.st_size, stat.st_mtime_ns]
+
+        return {
+            "kernel": file_id(kernel_path),
+            "cmdline": self.get_boot_cmdline(extra_args=extra_args, boot_profile=boot_profile),
+            "boot_profile": boot_profile,
+            "backing": file_id(backing_path),
+            "template": file_id(self.template_image_path()),
+            "guest_hooks": os.path.basename(self.guest_hooks_stamp_path()),
+            # Restoring needs the same devices, but the payload disk's contents can differ
+            "payload_size": os.path.getsize(self.payload_disk.image_path),
+            "launch_script": file_id(X86_MICROVM if boot_profile == BOOT_PROFILE_FAST else X86_CUSTOM_KERNEL),
+            "qemu": file_id(shutil.which("qemu-system-x86_64")),
+        }
+
+    def use_warm_disk(self, snapshot_disk_path: str) -> Result:
+        """Make the output image a fresh overlay on a warm start snapshot's disk, which is what the
+        snapshot's RAM expects to find"""
+        if os.path.exists(self.output_image_path()):
+            os.remove(self.output_image_path())
+        result = qemu_img_create_overlay(self.output_image_path(), snapshot_disk_path)
+        if result.is_failure():
+            error(f"[UbuntuDiskImage] Failed to overlay warm start disk {snapshot_disk_path}")
+        return result
+
+    def boot_image(self, memory_mb=4096, cores=4, user_network=True, nographic=True, interactive=False, enable_kvm=False, gdb_str: str = None, aux_logfile_path: str=None, extra_args: str=None, boot_profile: str=None, agent_socket_path: str=None, records_path: str=None, warm_socket_path: str=None, qmp_socket_path: str=None, incoming_state_path: str=None) -> subprocess.Popen:
+        """Boot the image, return subprocess of image (does not wait)
+        records_path: file to receive the results port (framed records, see results/records.py), only with a custom kernel
+        warm_socket_path, qmp_socket_path, incoming_state_path: warm start (see runners/warm_start.py), only with a custom kernel"""
+        if boot_profile is None:
+            boot_profile = self.boot_profile
 
         redirect = True
         disable_cloud_init = False
@@ -596,23 +875,36 @@ class UbuntuDiskImage(DiskImage):
 
         custom_kernel_path = None
         cmdline=""
+        # The distro kernel boots with its own command line, so only the override kernel can move its console
+        console = CONSOLE_SERIAL
         if self.use_override_kernel:
+            console = self.console_policy.kernel_console
             # 
             custom_kernel_path = self.installed_kernel_path
-            cmdline = get_kernel_cmdline(disable_cloud_init=disable_cloud_init)
+            cmdline = self.get_boot_cmdline(extra_args=extra_args, boot_profile=boot_profile, disable_cloud_init=disable_cloud_init)
+            if boot_profile == BOOT_PROFILE_FAST and self.pvh_kernel_path is not None:
+                custom_kernel_path = self.pvh_kernel_path
             # # Use the kernel override
             # cmdline = get_kernel_cmdline()
             # kernel = QemuKernel(self.installed_kernel_dir, cmdline=cmdline)
             # custom_kernel = kernel
-            if extra_args is not None:
-                cmdline += " " + extra_args
     
+        payload_path = self.payload_disk.image_path if self.payload_disk is not None else None
         process = launch_kernel_raw(arch = self.arch,
                                     image_path=self.output_image_path(),
                                     kernel_path=custom_kernel_path,
                                     cmdline=cmdline,
                                     redirect=redirect, 
-                                    aux_logfile_path=aux_logfile_path)
+                                    aux_logfile_path=aux_logfile_path,
+                                    lease=self.lease,
+                                    payload_path=payload_path,
+                                    boot_profile=boot_profile,
+                                    agent_socket_path=agent_socket_path,
+                                    records_path=records_path if self.use_override_kernel else None,
+                                    warm_socket_path=warm_socket_path,
+                                    qmp_socket_path=qmp_socket_path,
+                                    incoming_state_path=incoming_state_path,
+                                    console=console)
         return process
 
 
@@ -658,12 +950,23 @@ class UbuntuDiskImage(DiskImage):
 
     def boot_interactive(self, enable_kvm=False, extra_args: str=None):
         """Boot the image interactively"""
-        process = self.boot_image(interactive=True, enable_kvm=enable_kvm, extra_args=extra_args)
+        # Interactive boots need the getty the fast profile skips
+        process = self.boot_image(interactive=True, enable_kvm=enable_kvm, extra_args=extra_args, boot_profile=BOOT_PROFILE_DEFAULT)
         process.wait()
 
-    def __del__(self):
-        """Destructor to clean up resources"""
-        self.unmount_image()
+    # API method from parent
+    def cleanup(self):
+        """Unmount and delete the output image. Safe to call more than once, callers sharing
+        an nbd device should call this explicitly rather than relying on the destructor"""
+        if self.cleaned_up:
+            return
+        self.cleaned_up = True
+        if not self.payload:
+            self.unmount_image()
         if os.path.exists(self.output_image_path()):
             os.remove(self.output_image_path())
 
+    def __del__(self):
+        """Destructor to clean up resources"""
+        self.cleanup()
+
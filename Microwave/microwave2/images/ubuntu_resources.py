@@ -1,11 +1,331 @@
 from microwave2.utils.utils import Arch
+from microwave2.utils.console_policy import ConsolePolicy, get_console_policy, AUX_PORT_PATH
+from microwave2.results.kernel_log import BUNDLE_BEGIN_TAG, BUNDLE_END_TAG, LOADED_MODULES_TAG, AGENT_READY_TAG, AGENT_BEGIN_TAG, AGENT_END_TAG, AGENT_KEXEC_TAG, WARM_READY_TAG, WARM_RESUMED_TAG
+from microwave2.images.payload_disk import PAYLOAD_LABEL, PAYLOAD_ROOTFS, PAYLOAD_INIT_NAME, PAYLOAD_AUTORUN_NAME
+from microwave2.results.records import RECORD_MAGIC, RECORD_HEADER, RECORD_CRC, RECORD_MAX_PAYLOAD, NO_ITERATION, RECORD_BEGIN, RECORD_END, RECORD_RESULTS, RECORD_RAW, RESULTS_PORT_PATH, AGENT_SECTION
 
 # This cloud-init config creates a user with the username "ubuntu" and password "password",
 # and sets up autologin for the root user on ttyS0.
 
+import base64
 import os
 
 
+# Installed once into the template, sourced from root's .bash_profile on the autologin console
+PAYLOAD_HOOK_PATH = "/usr/local/sbin/microwave-payload"
+PAYLOAD_MOUNTPOINT = "/payload"
+# Only attached to warm start VMs, see runners/warm_start.py
+WARM_PORT_PATH = "/dev/virtio-ports/warm-port"
+
+def build_warm_wait() -> str:
+    """Warm start point: with a warm port, say so and wait for the host's "<epoch> <seed>" line before
+    touching the payload. The host snapshots the VM while it waits here, so a restored copy picks up
+    right here too, and gets the current time and fresh entropy instead of the snapshot's"""
+    return f"""if [ -e {WARM_PORT_PATH} ] && [ ! -e /run/microwave-warm ]; then
+    touch /run/microwave-warm
+    exec {{WARM_FD}}<>{WARM_PORT_PATH}
+    echo "{WARM_READY_TAG}" > /dev/kmsg
+    # EOF just means nothing is connected on the host side yet
+    until read -r -u $WARM_FD WARM_EPOCH WARM_SEED; do sleep 0.05; done
+    exec {{WARM_FD}}<&-
+    date -s "@$WARM_EPOCH" > /dev/null
+    echo "$WARM_SEED" > /dev/urandom
+    # The payload disk may not be the one attached at snapshot time, drop anything cached from it
+    for dev in /dev/vd[b-z]; do [ -b "$dev" ] && blockdev --flushbufs "$dev"; done
+    echo 3 > /proc/sys/vm/drop_caches
+    echo "{WARM_RESUMED_TAG}" > /dev/kmsg
+fi
+"""
+
+def build_payload_hook() -> str:
+    """Guest side of PayloadDisk: if a payload disk is attached, copy its rootfs over / (as root,
+    so the host's file owners don't matter) and run its init script. Only once per boot"""
+    return f"""#!/bin/bash
+{build_warm_wait()}PAYLOAD_DEV=$(blkid -L {PAYLOAD_LABEL})
+if [ -n "$PAYLOAD_DEV" ] && [ ! -e /run/microwave-payload ]; then
+    touch /run/microwave-payload
+    mkdir -p {PAYLOAD_MOUNTPOINT}
+    mount -o ro "$PAYLOAD_DEV" {PAYLOAD_MOUNTPOINT}
+    cp -r --preserve=mode,timestamps,links {PAYLOAD_MOUNTPOINT}/{PAYLOAD_ROOTFS}/. /
+    if [ -e {PAYLOAD_MOUNTPOINT}/{PAYLOAD_AUTORUN_NAME} ]; then
+        source {PAYLOAD_MOUNTPOINT}/{PAYLOAD_INIT_NAME}
+    fi
+fi
+"""
+
+def get_payload_hook_profile_line() -> str:
+    return f"[ -x {PAYLOAD_HOOK_PATH} ] && source {PAYLOAD_HOOK_PATH}"
+
+# init= for the fast boot profile, replaces systemd/getty/.bash_profile with just what a run needs
+FASTBOOT_INIT_PATH = "/usr/local/sbin/microwave-fastinit"
+FASTBOOT_INIT_TAG = "[TAG: FASTBOOT INIT]"
+
+def build_fastboot_init() -> str:
+    """Minimal PID 1: mount the API filesystems, recreate the virtio port links udev would have made,
+    run the payload hook (or the image's own init script), then power off"""
+    return f"""#!/bin/bash
+export PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin HOME=/root TERM=linux
+mount -t proc proc /proc
+mount -t sysfs sysfs /sys
+mount -t devtmpfs devtmpfs /dev
+mount -t tmpfs tmpfs /run
+mount -t tmpfs tmpfs /tmp
+mount -o remount,rw /
+echo "{FASTBOOT_INIT_TAG}" > /dev/kmsg
+mkdir -p /dev/virtio-ports
+for port in /sys/class/virtio-ports/*; do
+    [ -e "$port/name" ] && ln -sf "/dev/$(basename $port)" "/dev/virtio-ports/$(cat $port/name)"
+done
+hostname microwave-fastboot
+cd /root
+source {PAYLOAD_HOOK_PATH}
+if [ ! -e /run/microwave-payload ] && [ -e /root/microwave_init.sh ]; then
+    source /root/microwave_init.sh
+fi
+sync
+# shutdown needs systemd, so power off directly (sysrq as the fallback)
+poweroff -f
+echo o > /proc/sysrq-trigger
+sleep infinity
+"""
+
+# Guest side of the results port, see results/records.py for the frame format
+RECORD_WRITER_PATH = "/usr/local/sbin/microwave-record"
+
+def build_record_writer() -> str:
+    """microwave-record <results|raw|begin|end> <benchmark> [file]: frame file (or stdin) and write it
+    to the results port, tagged with $ITERATION. Does nothing if the VM has no results port"""
+    return f"""#!/usr/bin/env python3
+import fcntl
+import os
+import struct
+import sys
+import zlib
+
+TYPES = {{"begin": {RECORD_BEGIN}, "end": {RECORD_END}, "results": {RECORD_RESULTS}, "raw": {RECORD_RAW}}}
+
+def frame(type, name, iteration, payload):
+    data = struct.pack("{RECORD_HEADER.format}", {RECORD_MAGIC!r}, type, iteration, len(name), len(payload)) + name + payload
+    return data + struct.pack("{RECORD_CRC.format}", zlib.crc32(data))
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] not in TYPES:
+        sys.stderr.write("usage: microwave-record <results|raw|begin|end> <benchmark> [file]\\n")
+        return 2
+    if not os.path.exists("{RESULTS_PORT_PATH}"):
+        return 0
+    type, name = TYPES[sys.argv[1]], sys.argv[2].encode()
+    iteration = os.environ.get("ITERATION")
+    iteration = int(iteration) if iteration and iteration.isdigit() else {NO_ITERATION}
+    payload = b""
+    if type not in ({RECORD_BEGIN}, {RECORD_END}):
+        if len(sys.argv) > 3:
+            with open(sys.argv[3], "rb") as f:
+                payload = f.read()
+        else:
+            payload = sys.stdin.buffer.read()
+
+    chunks = [payload[i:i + {RECORD_MAX_PAYLOAD}] for i in range(0, len(payload), {RECORD_MAX_PAYLOAD})] or [b""]
+    with open("{RESULTS_PORT_PATH}", "ab", buffering=0) as port:
+        # Whole frames only, even with several writers
+        fcntl.flock(port, fcntl.LOCK_EX)
+        for chunk in chunks:
+            data = frame(type, name, iteration, chunk)
+            while data:
+                data = data[port.write(data):]
+    return 0
+
+sys.exit(main())
+"""
+
+# Guest agent, started by the init script instead of the launch script(s) when the host drives the run
+AGENT_PATH = "/usr/local/sbin/microwave-agent"
+AGENT_PORT_PATH = "/dev/virtio-ports/agent-port"
+# Where AgentRunner.switch_kernel puts the next kernel (tmpfs, gone once it has booted)
+AGENT_KEXEC_KERNEL_PATH = "/run/microwave-kexec/bzImage"
+# x86_64 syscall number, and reboot() command that jumps into the loaded kernel
+SYS_KEXEC_FILE_LOAD = 320
+KEXEC_FILE_NO_INITRAMFS = 0x4
+LINUX_REBOOT_CMD_KEXEC = 0x45584543
+
+def build_agent_script() -> str:
+    """Guest side of AgentRunner: reads one JSON request per line from the agent port, runs it and
+    answers with one JSON line. Command output goes where the console policy says (/dev/kmsg by default),
+    between begin/end tags so the host can cut each command's console output out of the boot log.
+    "put" and "kexec" let the host switch the VM to another kernel: kexec-tools if the image has it
+    (CONFIG_KEXEC), kexec_file_load otherwise (CONFIG_KEXEC_FILE)"""
+    return f"""#!/usr/bin/env python3
+import base64
+import ctypes
+import json
+import os
+import shutil
+import subprocess
+import time
+
+libc = ctypes.CDLL(None, use_errno=True)
+
+def kmsg(line):
+    with open("/dev/kmsg", "w") as f:
+        f.write(line + "\\n")
+
+def run_script(request):
+    env = dict(os.environ)
+    env.update(request.get("env") or {{}})
+    env["LAUNCH_SCRIPT"] = request["script"]
+    env["ITERATION"] = str(request.get("iteration", 0))
+    marker = request.get("marker")
+    section = "{AGENT_SECTION}".format(request["id"])
+    subprocess.run(["{RECORD_WRITER_PATH}", "begin", section], env=env, stderr=subprocess.DEVNULL)
+    kmsg("{AGENT_BEGIN_TAG}".format(request["id"]))
+    if marker:
+        kmsg(marker)
+    start = time.monotonic()
+    returncode, error = None, None
+    # Console policy can buffer output in a file instead, it goes to the aux log once the command is done
+    output = request.get("output") or "/dev/kmsg"
+    with open(output, "w") as out:
+        try:
+            proc = subprocess.run(["bash", "-c", "source $LAUNCH_SCRIPT"], env=env, cwd=request.get("cwd") or "/",
+                                  stdout=out, stderr=subprocess.STDOUT, timeout=request.get("timeout"))
+            returncode = proc.returncode
+        except subprocess.TimeoutExpired:
+            error = "timeout"
+    duration = time.monotonic() - start
+    if output != "/dev/kmsg":
+        try:
+            with open(output, "rb") as src, open("{AUX_PORT_PATH}", "ab") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(output)
+        except OSError:
+            pass
+    # Same report the init script gives after a normal run (kernel only mode checks it)
+    try:
+        with open("/proc/modules") as f:
+            modules = " ".join(line.split()[0] for line in f)
+    except OSError:
+        modules = ""
+    kmsg("{LOADED_MODULES_TAG} " + modules)
+    if marker:
+        kmsg(marker)
+    kmsg("{AGENT_END_TAG}".format(request["id"]))
+    subprocess.run(["{RECORD_WRITER_PATH}", "end", section], env=env, stderr=subprocess.DEVNULL)
+    return {{"ok": error is None, "returncode": returncode, "duration": duration, "error": error}}
+
+def put_file(request):
+    path = request["path"]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    offset = request.get("offset") or 0
+    with open(path, "r+b" if offset else "wb") as f:
+        f.seek(offset)
+        f.write(base64.b64decode(request["data"]))
+    return {{"ok": True}}
+
+def kexec_load(request):
+    cmdline = request.get("cmdline") or ""
+    if shutil.which("kexec"):
+        proc = subprocess.run(["kexec", "-l", request["kernel"], "--command-line=" + cmdline],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if proc.returncode != 0:
+            return {{"ok": False, "error": "kexec -l: " + proc.stdout.strip()}}
+        return {{"ok": True}}
+    fd = os.open(request["kernel"], os.O_RDONLY)
+    arg = cmdline.encode() + b"\\0"
+    ret = libc.syscall({SYS_KEXEC_FILE_LOAD}, fd, -1, len(arg), ctypes.c_char_p(arg), {KEXEC_FILE_NO_INITRAMFS})
+    os.close(fd)
+    if ret != 0:
+        return {{"ok": False, "error": "kexec_file_load: " + os.strerror(ctypes.get_errno())}}
+    return {{"ok": True}}
+
+def kexec_exec():
+    kmsg("{AGENT_KEXEC_TAG}")
+    os.sync()
+    libc.reboot({LINUX_REBOOT_CMD_KEXEC})
+    # Only returns if nothing was loaded
+    kmsg("{AGENT_KEXEC_TAG} failed: " + os.strerror(ctypes.get_errno()))
+
+def handle(request):
+    cmd = request.get("cmd")
+    if cmd == "ping":
+        return {{"ok": True}}
+    if cmd == "run":
+        return run_script(request)
+    if cmd == "put":
+        return put_file(request)
+    if cmd == "kexec":
+        return kexec_load(request)
+    if cmd == "shutdown":
+        return {{"ok": True}}
+    return {{"ok": False, "error": "unknown command " + str(cmd)}}
+
+def main():
+    fd = os.open("{AGENT_PORT_PATH}", os.O_RDWR)
+    kmsg("{AGENT_READY_TAG}")
+    buf = b""
+    while True:
+        data = os.read(fd, 65536)
+        if not data:
+            # Nothing connected on the host side yet
+            time.sleep(0.1)
+            continue
+        buf += data
+        while b"\\n" in buf:
+            line, buf = buf.split(b"\\n", 1)
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                response = handle(request)
+            except Exception as e:
+                request, response = {{}}, {{"ok": False, "error": repr(e)}}
+            response["id"] = request.get("id")
+            os.write(fd, (json.dumps(response) + "\\n").encode())
+            if request.get("cmd") == "shutdown":
+                return
+            if request.get("cmd") == "kexec" and response["ok"]:
+                kexec_exec()
+
+main()
+"""
+
+def get_guest_hooks() -> dict:
+    """Guest path -> contents of every helper script the framework installs into the template"""
+    return {
+        PAYLOAD_HOOK_PATH: build_payload_hook(),
+        FASTBOOT_INIT_PATH: build_fastboot_init(),
+        AGENT_PATH: build_agent_script(),
+        RECORD_WRITER_PATH: build_record_writer(),
+    }
+
+AUTOLOGIN_DROPIN = """[Service]
+ExecStart=
+ExecStart=-/sbin/agetty --autologin root --noclear %I $TERM
+"""
+
+def get_guest_config_files() -> dict:
+    """Guest path -> contents of every (non executable) config file the framework installs into the
+    template. The quiet console policy boots with console=hvc0, where systemd starts a getty on hvc0
+    instead of ttyS0, so that one needs autologin too for root's .bash_profile (and the launch script)
+    to run. Only one of the two ever has a getty, so the profile doesn't run twice"""
+    return {
+        "/etc/systemd/system/serial-getty@hvc0.service.d/autologin.conf": AUTOLOGIN_DROPIN,
+    }
+
+def get_guest_hook_files() -> str:
+    """cloud-init write_files entries for the guest hooks and config files"""
+    entries = []
+    files = [(path, contents, "0755") for path, contents in get_guest_hooks().items()]
+    files += [(path, contents, "0644") for path, contents in get_guest_config_files().items()]
+    for path, contents, permissions in files:
+        entries += [
+            f"  - path: {path}",
+            "    owner: root:root",
+            f"    permissions: '{permissions}'",
+            "    encoding: b64",
+            f"    content: {base64.b64encode(contents.encode()).decode()}",
+        ]
+    return "\n".join(entries) + "\n"
+
 def get_userdata(arch: Arch) -> str:
 
     if arch == Arch.ARM:
@@ -51,12 +371,13 @@ write_files:
   - path: /etc/sysctl.d/99-console-loglevel.conf
     content: |
       kernel.printk = 7 7 1 7
-
+{get_guest_hook_files()}
 runcmd:
   - sudo passwd -d root
+  - echo '{get_payload_hook_profile_line()}' >> /root/.bash_profile
   - apt-get update
   - apt-get -y upgrade
-  - apt-get -y install git python3 python3-pip
+  - apt-get -y install git python3 python3-pip kexec-tools
   - systemctl daemon-reload
   - systemctl restart serial-getty@{cloud_init_tty}.service
   - systemctl restart serial-getty@{boot_tty}.service
@@ -74,10 +395,15 @@ power_state:
     condition: True
 """
 
-def get_kernel_cmdline(disable_cloud_init:bool=False) -> str:
-    cmdline = "console=ttyS0,115200 earlyprintk=serial,ttyS0,115200 ignore_loglevel root=/dev/vda1"
+def get_kernel_cmdline(disable_cloud_init:bool=False, fast_boot:bool=False, console_policy: ConsolePolicy=None) -> str:
+    if console_policy is None:
+        console_policy = get_console_policy()
+    cmdline = f"{console_policy.kernel_cmdline_args()} root=/dev/vda1"
     if disable_cloud_init:
         cmdline += " cloud-init=disabled"
+    if fast_boot:
+        # Fail instead of hanging if init dies, QEMU runs with -no-reboot so that ends the VM
+        cmdline += f" rw init={FASTBOOT_INIT_PATH} panic=-1"
     return cmdline
 
 # def get_kernel_cmdline(arch: Arch) -> str:
@@ -88,14 +414,49 @@ def get_kernel_cmdline(disable_cloud_init:bool=False) -> str:
 #     else:
 #         raise ValueError("Unexpected architecture: {}".format(arch))
 
+def build_bundle_lines(launch_script_paths, dmesg_redirect=False, console_policy: ConsolePolicy=None) -> list:
+    """Run each launch script in order (in a subshell, so one exiting doesn't stop the rest), with
+    bundle markers written to both the console and the aux log so the host can split the output"""
+    if console_policy is None:
+        console_policy = get_console_policy()
+    console_redirect = " > /dev/kmsg" if dmesg_redirect else ""
+    output_redirect = console_policy.output_redirect() if dmesg_redirect else ""
+    lines = [f"export LAUNCH_SCRIPTS=\"{' '.join(launch_script_paths)}\""]
+    for launch_script_path in launch_script_paths:
+        name = os.path.basename(launch_script_path)
+        begin_tag = BUNDLE_BEGIN_TAG.format(name)
+        end_tag = BUNDLE_END_TAG.format(name)
+        lines += [
+            f"export LAUNCH_SCRIPT={launch_script_path}",
+            f"{RECORD_WRITER_PATH} begin {name} 2>/dev/null",
+            f"echo \"{begin_tag}\" >> {AUX_PORT_PATH}",
+            f"echo \"{begin_tag}\"{console_redirect}",
+            f"(source $LAUNCH_SCRIPT){output_redirect}",
+        ]
+        if dmesg_redirect:
+            lines += console_policy.output_flush_lines()
+        lines += [
+            f"echo \"{end_tag}\" >> {AUX_PORT_PATH}",
+            f"echo \"{end_tag}\"{console_redirect}",
+            f"{RECORD_WRITER_PATH} end {name} 2>/dev/null",
+        ]
+    return lines
+
 def build_bash_profile(launch_script_path, target_dir, test_dir, marker=None, autoshutdown=False, dmesg_redirect=False,
-                       noop_exec=False) -> str:
+                       noop_exec=False, agent=False, console_policy: ConsolePolicy=None) -> str:
+    """launch_script_path can be a list of scripts, which are then run one after another in the same boot.
+    With agent, the guest agent is started instead and the host decides what runs (see AgentRunner).
+    With dmesg_redirect, launch script output goes where console_policy says (/dev/kmsg by default)"""
+    if console_policy is None:
+        console_policy = get_console_policy()
+    bundle = isinstance(launch_script_path, list)
     script_lines = [
         "#!/bin/bash",
         "set +x", # Probably don't want this always
         f"export TARGET_DIR={target_dir}",
-        f"export TEST_DIR={test_dir}",
-        f"export LAUNCH_SCRIPT={launch_script_path}"]
+        f"export TEST_DIR={test_dir}"]
+    if not bundle:
+        script_lines.append(f"export LAUNCH_SCRIPT={launch_script_path}")
     
 
     # Construct marker line
@@ -106,8 +467,8 @@ def build_bash_profile(launch_script_path, target_dir, test_dir, marker=None, au
 
     execute_line = f"source $LAUNCH_SCRIPT"
     if dmesg_redirect:
-        # Redirect all output of the launch script to /dev/kmsg
-        execute_line = f"source $LAUNCH_SCRIPT > /dev/kmsg"
+        # Redirect all output of the launch script away from the tty
+        execute_line = f"source $LAUNCH_SCRIPT{console_policy.output_redirect()}"
 
 
     if noop_exec:
@@ -115,7 +476,21 @@ def build_bash_profile(launch_script_path, target_dir, test_dir, marker=None, au
         execute_line = f"echo \"LAUNCH COMMAND: {execute_line}\""
 
     script_lines.append(marker_line)
-    script_lines.append(execute_line)
+    script_lines += console_policy.run_setup_lines()
+    if agent:
+        script_lines.append(f"python3 {AGENT_PATH}")
+    elif bundle and not noop_exec:
+        script_lines += build_bundle_lines(launch_script_path, dmesg_redirect=dmesg_redirect, console_policy=console_policy)
+    else:
+        script_lines.append(execute_line)
+        if dmesg_redirect and not noop_exec:
+            script_lines += console_policy.output_flush_lines()
+
+    # Lets the host check that a kernel only boot really never loaded a module
+    modules_line = f"echo \"{LOADED_MODULES_TAG} $(cut -d' ' -f1 /proc/modules 2>/dev/null | tr '\\n' ' ')\""
+    if dmesg_redirect:
+        modules_line = f"{modules_line} > /dev/kmsg"
+    script_lines.append(modules_line)
     script_lines.append(marker_line)
 
     if autoshutdown:
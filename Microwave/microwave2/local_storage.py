@@ -11,7 +11,10 @@ class LocalPathManager:
         # Path to the root directory of the python project ('microwave-2.0')
         self.project_dir = os.path.abspath(os.path.join(cur_dir, '..'))
         
+        # MICROWAVE_WORKDIR lets several processes on one host (e.g. queue workers) keep separate working files
         self.workdir = workdir
+        if self.workdir is None:
+            self.workdir = os.environ.get("MICROWAVE_WORKDIR")
         if self.workdir is None:
             self.workdir = os.path.join(self.project_dir, ".working")
 
@@ -1,20 +1,165 @@
 from microwave2.results.result import TestResult, Status
+from microwave2.results.records import RecordSet, records_dir_for, load_records
+from microwave2.results.log_store import write_log_file, LogFile, is_log_file
 
 import re
 import json
+import os
+import shutil
+from array import array
+from collections.abc import Sequence
 
-from typing import List
+from typing import Dict, List, Optional
+
+# Optional, several times faster than json on big logs
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 KERNEL_LOG_LINE_REGEX = re.compile(r"^\[\s*\d+\.\d+\]\s*(.*)$")
 
+# Line the runner adds between the console output and the contents of the aux log
+AUX_LOG_MARKER = "Aux log file:"
+
+# Start of the marker lines guest scripts write, indexed when a log is saved
+TAG_PREFIX = "[TAG:"
+
+# Written (to both console and aux log) around each launch script when several run in one boot
+BUNDLE_BEGIN_TAG = "[TAG: BUNDLE BEGIN {}]"
+BUNDLE_END_TAG = "[TAG: BUNDLE END {}]"
+
+# Written to the console by the guest agent (see AgentRunner) around each command it runs
+AGENT_READY_TAG = "[TAG: AGENT READY]"
+AGENT_BEGIN_TAG = "[TAG: AGENT BEGIN {}]"
+AGENT_END_TAG = "[TAG: AGENT END {}]"
+# Written by the agent right before it kexecs into the next kernel (see AgentRunner.switch_kernel)
+AGENT_KEXEC_TAG = "[TAG: AGENT KEXEC]"
+
+# Written to the console by the payload hook of a warm start VM (see runners/warm_start.py): when it
+# is ready to be snapshotted, and once the host has let it (or its restored copy) carry on
+WARM_READY_TAG = "[TAG: WARM READY]"
+WARM_RESUMED_TAG = "[TAG: WARM RESUMED]"
+
+# Written once the launch script(s) finish, followed by the names of the loaded modules
+LOADED_MODULES_TAG = "[TAG: LOADED MODULES]"
+
 # TODO integrate kunit_parser
 
 
+# Encoding of the line buffer, surrogatepass so any str line comes back out unchanged
+LINE_ENCODING = "utf-8"
+LINE_ERRORS = "surrogatepass"
+
+
+class LinesView(Sequence):
+    """Read-only run of lines [start, end) of a KernelLog, referencing its buffer instead of
+    copying. Slicing gives another view, text() decodes the whole run in one go"""
+
+    def __init__(self, kernel_log: "KernelLog", start: int, end: int):
+        self.kernel_log = kernel_log
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step != 1:
+                return list(self)[idx]
+            return LinesView(self.kernel_log, self.start + start, self.start + max(start, stop))
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("line index out of range")
+        return self.kernel_log.get_line(self.start + idx)
+
+    def text(self) -> str:
+        """Lines joined with newlines"""
+        offsets = self.kernel_log.offsets
+        if self.start >= self.end:
+            return ""
+        # Every line in the buffer is followed by a newline, drop the last one
+        data = self.kernel_log.buffer[offsets[self.start]:offsets[self.end] - 1]
+        return data.decode(LINE_ENCODING, LINE_ERRORS)
+
+    def __iter__(self):
+        if self.start >= self.end:
+            return iter(())
+        return iter(self.text().split("\n"))
+
+    def index(self, value, start=0, stop=None):
+        """Position of the first line equal to value, tags are looked up in the section index"""
+        stop = len(self) if stop is None else stop
+        positions = self.kernel_log.sections.get(value)
+        if positions is not None:
+            for pos in positions:
+                if self.start + start <= pos < self.start + stop and self.kernel_log.get_line(pos) == value:
+                    return pos - self.start
+        for idx, line in enumerate(self[start:stop]):
+            if line == value:
+                return start + idx
+        raise ValueError(f"{value!r} is not in lines")
+
+    def __contains__(self, value):
+        try:
+            self.index(value)
+            return True
+        except ValueError:
+            return False
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __eq__(self, other):
+        if isinstance(other, (LinesView, list, tuple)):
+            return len(self) == len(other) and list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return f"LinesView({self.start}:{self.end} of {len(self.kernel_log)} lines)"
+
+
+def section_end_tag(name: str) -> str:
+    """End tag paired with a section's start tag: [TAG: X BEGIN n] -> [TAG: X END n],
+    [TAG: X] -> [TAG: X END]. None for the aux log marker, whose section runs to the end of the log"""
+    if name == AUX_LOG_MARKER or not name.startswith(TAG_PREFIX):
+        return None
+    if " BEGIN" in name:
+        return name.replace(" BEGIN", " END", 1)
+    return name[:-1] + " END]"
+
+
 class KernelLog:
-    """Record of kernel logs, eventually should support parsing Tests/KTAP"""
+    """Record of kernel logs, eventually should support parsing Tests/KTAP
+
+    Lines are kept newline separated in one buffer plus an array of where each starts, which takes
+    a fraction of the memory of a list of strs on multi-MB debug kernel logs. As lines are added,
+    every [TAG: ...] line (timestamp stripped) and the aux log marker is indexed by its text, so
+    sections are found without scanning the log"""
 
     def __init__(self, initial_lines: List[str] = None, test_marker=None):
-        self.raw_lines = []
+        self.buffer = bytearray()
+        self.offsets = array("Q", [0])
+        # Tag line (timestamp stripped) -> line numbers it appears at
+        self.sections: Dict[str, List[int]] = {}
+        # Seconds from launching the VM to the test section starting, set by the runner
+        self.boot_to_benchmark = None
+        # Records the guest sent on the results port (RecordSet), and every section of them by name
+        # (bundled boots have one per launch script), set by the runner
+        self.records = None
+        self.record_sections = {}
+        # Why the VM stopped ({"kind", "detail"}, see runners/log_monitor.py), set by the runner
+        self.stop_reason = None
+        # Name of the console policy the guest ran with (see utils/console_policy.py), set by the runner
+        self.console_policy = None
+        # Attempts it took to get this run (see testers/retry.py), set by the tester
+        self.attempts = None
 
         self.has_test_section = False
         if test_marker is not None:
@@ -27,27 +172,25 @@ class KernelLog:
             for line in initial_lines:
                 self.add_line(line)
 
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def raw_lines(self) -> LinesView:
+        return LinesView(self, 0, len(self))
+
     def get_raw_lines(self):
         """Return the raw lines in the log"""
         return self.raw_lines
 
+    def get_line(self, idx: int) -> str:
+        return self.buffer[self.offsets[idx]:self.offsets[idx + 1] - 1].decode(LINE_ENCODING, LINE_ERRORS)
+
     def check_line(self, line: str, idx: int):
         """Check if a line is a section marker, and record if so"""
         if not self.has_test_section:
             return False
 
-        # Extract log line from kernel log line
-        match = KERNEL_LOG_LINE_REGEX.match(line)
-        if match is None:
-         #   print("[KernelLog] Warning: line does not match kernel log regex")
-            return False
-
-        line = match.group(1)
-        # print(f"[KernelLog] Checking line {idx}: {line}")
-
-        # Strip line
-        line = line.strip()
-
         # Check if line is a section marker by comparing to regex
         if not self.test_marker.match(line):
             return False
@@ -82,45 +225,156 @@ class KernelLog:
 
         return self.raw_lines[self.test_section_start:self.test_section_end+1]
 
+    def console_window_bytes(self) -> Optional[int]:
+        """Bytes of console output (newlines included) within the test section, i.e. what went over the
+        kernel console while the benchmark was being measured. None without a test section"""
+        if not self.has_test_section or self.test_section_start is None:
+            return None
+        end = self.test_section_end
+        if end is None:
+            # Ran to the end of the console output, which the aux log follows
+            aux_positions = self.sections.get(AUX_LOG_MARKER)
+            end = aux_positions[0] - 1 if aux_positions else len(self) - 1
+        return self.offsets[end + 1] - self.offsets[self.test_section_start]
+
+    def missing_results(self) -> Optional[str]:
+        """Why there is nothing to extract results from, None if there is (or nothing to go by, without
+        a test marker). The guest prints the marker before any launch script runs, so a log without it
+        never got to the benchmark, unless the records came in on the results port anyway"""
+        if not self.has_test_section or self.test_section_start is not None:
+            return None
+        if self.records is not None:
+            return None
+        return f"test marker {self.test_marker.pattern} never printed"
+
     def add_line(self, line: str, strip=True):
         if strip:
             line = line.strip()
+        if "\n" in line:
+            line = line.replace("\n", " ")
+        idx = len(self)
+
+        # Only lines starting with [ can have a timestamp or be a tag, skip the regex for the rest
+        if line.startswith("["):
+            match = KERNEL_LOG_LINE_REGEX.match(line)
+            if match is not None:
+                stripped = match.group(1).strip()
+                # Test markers are only looked for in (timestamped) console lines
+                self.check_line(stripped, idx)
+            else:
+                stripped = line
+            if stripped.startswith(TAG_PREFIX):
+                self.sections.setdefault(stripped, []).append(idx)
+        elif line == AUX_LOG_MARKER:
+            self.sections.setdefault(line, []).append(idx)
+
+        self.buffer += line.encode(LINE_ENCODING, LINE_ERRORS)
+        self.buffer += b"\n"
+        self.offsets.append(len(self.buffer))
+
+    def find_tag(self, tag: str, after: int = -1, before: int = None) -> int:
+        """Line number of the first tag line after line after (and before line before), None if there isn't one"""
+        for idx in self.sections.get(tag, []):
+            if idx > after and (before is None or idx < before):
+                return idx
+        return None
+
+    def section(self, name: str, end_tag: str = None) -> LinesView:
+        """Lines strictly between the first name tag and the end tag after it (see section_end_tag
+        for the default), without copying. None if either tag is missing"""
+        start = self.find_tag(name)
+        if start is None:
+            return None
+        if end_tag is None:
+            end_tag = section_end_tag(name)
+        if end_tag is None:
+            return LinesView(self, start + 1, len(self))
+        end = self.find_tag(end_tag, after=start)
+        if end is None:
+            return None
+        return LinesView(self, start + 1, end)
 
-        self.check_line(line, len(self.raw_lines))
-        self.raw_lines.append(line)
+    def metadata(self):
+        return {
+            "test_marker": self.test_marker.pattern if self.has_test_section else None,
+            "boot_to_benchmark": self.boot_to_benchmark,
+            "stop_reason": self.stop_reason,
+            "console_policy": self.console_policy,
+            "console_bytes": self.console_window_bytes(),
+            "attempts": self.attempts
+        }
 
     def to_json_dict(self):
         """Return the log as a json dictionary"""
         return {
-            "lines": self.raw_lines,
-            "metadata": {
-                "test_marker": self.test_marker.pattern if self.has_test_section else None
-            }
+            "lines": list(self.raw_lines),
+            "metadata": self.metadata()
         }
 
+    def tag_index(self) -> Dict[str, List[int]]:
+        """Line numbers of every [TAG: ...] line (timestamp stripped) and the aux log marker"""
+        return {tag: list(positions) for tag, positions in self.sections.items()}
+
+    def save_records(self, path: str):
+        """Copy records into the directory next to path (see records_dir_for)"""
+        records_dir = records_dir_for(path)
+        if self.records is not None:
+            if os.path.abspath(records_dir) != os.path.abspath(self.records.records_dir):
+                self.records.copy_to(records_dir)
+        elif os.path.exists(records_dir):
+            # Left over from an earlier log saved to the same path
+            shutil.rmtree(records_dir)
+
     # Method to serialize log to and from disk (including test marker)
     # Formatted as json dictionary with two keys: "lines" and "metadata",
     # where "lines" is a list of strings and "metadata" is a dictionary for
     # now only containing the test marker
 
     def to_JSON(self, path: str):
-        """Dump the log to a file"""
+        """Dump the log to a file, records go in a directory next to it (see records_dir_for)"""
+        self.save_records(path)
         with open(path, "w") as f:
-            json.dump(
-                {
-                    "lines": self.raw_lines,
-                    "metadata":
-                        {
-                            "test_marker": self.test_marker.pattern
-                        }
-                }, f)
+            json.dump(self.to_json_dict(), f)
 
     @classmethod
     def from_JSON(cls, path: str):
         """Load the log from a file"""
-        with open(path, "r") as f:
-            data = json.load(f)
-            return cls(data["lines"], data["metadata"]["test_marker"])
+        if orjson is not None:
+            with open(path, "rb") as f:
+                data = orjson.loads(f.read())
+        else:
+            with open(path, "r") as f:
+                data = json.load(f)
+        return cls.from_saved(data["lines"], data["metadata"], path)
+
+    def to_file(self, path: str):
+        """Save the log in the compressed, indexed format (see log_store), records go next to it"""
+        self.save_records(path)
+        write_log_file(path, self.raw_lines, self.metadata(), self.tag_index())
+
+    @classmethod
+    def from_file(cls, path: str):
+        """Load a log saved with to_file"""
+        log_file = LogFile(path)
+        return cls.from_saved(log_file.lines(), log_file.metadata, path)
+
+    @classmethod
+    def load(cls, path: str):
+        """Load a saved log in either format"""
+        if is_log_file(path):
+            return cls.from_file(path)
+        return cls.from_JSON(path)
+
+    @classmethod
+    def from_saved(cls, lines: List[str], metadata: dict, path: str):
+        kernel_log = cls(lines, metadata["test_marker"])
+        kernel_log.boot_to_benchmark = metadata.get("boot_to_benchmark")
+        kernel_log.stop_reason = metadata.get("stop_reason")
+        kernel_log.console_policy = metadata.get("console_policy")
+        kernel_log.attempts = metadata.get("attempts")
+        # kernel_current is a symlink, its records are next to the log it points at
+        kernel_log.records = load_records(os.path.realpath(path))
+        return kernel_log
 
     def log_str(self, test_only: bool = False):
         """Return the log as a string"""
@@ -128,7 +382,7 @@ class KernelLog:
         if test_only:
             log_lines = self.test_lines()
 
-        return "\n".join(log_lines)
+        return log_lines.text()
 
     def dump_log(self, path: str, test_only: bool = False):
         """Dump the log to a file"""
@@ -136,6 +390,80 @@ class KernelLog:
             f.write(self.log_str(test_only=test_only))
 
 
+def strip_kernel_timestamp(line: str) -> str:
+    """Line without its leading [  12.345678] timestamp, if it has one"""
+    match = KERNEL_LOG_LINE_REGEX.match(line)
+    if match is None:
+        return line.strip()
+    return match.group(1).strip()
+
+
+def find_loaded_modules(lines: List[str]) -> List[str]:
+    """Modules the guest had loaded when its launch script(s) finished, None if it never reported"""
+    for line in lines:
+        stripped = strip_kernel_timestamp(line)
+        if stripped.startswith(LOADED_MODULES_TAG):
+            return stripped[len(LOADED_MODULES_TAG):].split()
+    return None
+
+
+def find_bundle_section(kernel_log: KernelLog, name: str, start: int = 0, stop: int = None):
+    """(start, end) line range of kernel_log between the bundle markers for name, looking only in
+    lines [start, stop). None if it never started. If the end marker is missing (e.g. timeout), the
+    section runs to stop"""
+    stop = len(kernel_log) if stop is None else stop
+    begin = kernel_log.find_tag(BUNDLE_BEGIN_TAG.format(name), after=start - 1, before=stop)
+    if begin is None:
+        return None
+    end = kernel_log.find_tag(BUNDLE_END_TAG.format(name), after=begin, before=stop)
+    if end is None:
+        return (begin, stop)
+    return (begin, end + 1)
+
+
+def split_bundle_log(kernel_log: KernelLog, names: List[str]) -> Dict[str, KernelLog]:
+    """Split the log of a boot that ran several launch scripts into one log per script. Each
+    gets the shared boot output, its own console section, then the aux marker and its own aux
+    section, so it looks the same as the log of a boot that only ran that script"""
+    lines = kernel_log.get_raw_lines()
+    aux_idx = kernel_log.find_tag(AUX_LOG_MARKER)
+    console_end = aux_idx if aux_idx is not None else len(lines)
+
+    console_sections = {}
+    for name in names:
+        section = find_bundle_section(kernel_log, name, stop=console_end)
+        if section is None:
+            print(f"[KernelLog] Warning: no bundle section for {name}, did it run?")
+            continue
+        console_sections[name] = section
+
+    if not console_sections:
+        return {}
+
+    # Everything before the first script started (boot log) is shared
+    boot_end = min(start for start, _ in console_sections.values())
+    boot_lines = lines[:boot_end]
+    test_marker = kernel_log.test_marker.pattern if kernel_log.has_test_section else None
+
+    split_logs = {}
+    for name, (start, end) in console_sections.items():
+        split_lines = list(boot_lines) + list(lines[start:end]) + [AUX_LOG_MARKER]
+        if aux_idx is not None:
+            aux_section = find_bundle_section(kernel_log, name, start=aux_idx + 1)
+            if aux_section is not None:
+                split_lines += lines[aux_section[0]:aux_section[1]]
+        split_logs[name] = KernelLog(split_lines, test_marker=test_marker)
+        split_logs[name].boot_to_benchmark = kernel_log.boot_to_benchmark
+        split_logs[name].console_policy = kernel_log.console_policy
+        split_logs[name].attempts = kernel_log.attempts
+        split_logs[name].records = kernel_log.record_sections.get(name)
+        # Only the script that was running when the VM stopped shares the boot's stop reason
+        if strip_kernel_timestamp(lines[end - 1]) != BUNDLE_END_TAG.format(name):
+            split_logs[name].stop_reason = kernel_log.stop_reason
+
+    return split_logs
+
+
 class RawKernelLogResult(TestResult):
     def __init__(self, kernel_log: KernelLog, name: str = None):
         self.kernel_log = kernel_log
@@ -0,0 +1,124 @@
+"""
+Compact on-disk format for saved kernel logs (.mwlog), replacing a json array of every line.
+
+    magic (4) | version (u8) | header length (u32) | header (json) | block | block | ...
+
+The header holds the run metadata, the line count, a tag index (tag -> line numbers) and a block
+table. Lines are stored newline joined in independently zstd compressed blocks of ~64KiB, so a reader
+that only wants one section (say the lmbench results in the aux log) looks its tags up in the
+index and decompresses just the blocks that cover it.
+"""
+import bisect
+import json
+import os
+import struct
+from typing import Dict, List
+
+import zstandard
+
+LOG_FILE_EXT = ".mwlog"
+LOG_FILE_MAGIC = b"MWLG"
+LOG_FILE_VERSION = 1
+LOG_FILE_HEADER = struct.Struct(">4sBI")
+
+# Uncompressed bytes per block, smaller means less to decompress per lookup but a worse ratio
+BLOCK_SIZE = 1 << 16
+COMPRESSION_LEVEL = 10
+
+
+def is_log_file(path: str) -> bool:
+    return path.endswith(LOG_FILE_EXT)
+
+
+def write_log_file(path: str, lines: List[str], metadata: dict, tags: Dict[str, List[int]] = None):
+    """Write lines (none containing a newline) to path, replacing it atomically"""
+    compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL)
+    blocks = []
+    chunks = []
+    offset = 0
+    first_line = 0
+    while first_line < len(lines):
+        size = 0
+        last_line = first_line
+        while last_line < len(lines) and (size < BLOCK_SIZE or last_line == first_line):
+            size += len(lines[last_line]) + 1
+            last_line += 1
+        chunk = compressor.compress("\n".join(lines[first_line:last_line]).encode(errors="backslashreplace"))
+        blocks.append([first_line, offset, len(chunk)])
+        chunks.append(chunk)
+        offset += len(chunk)
+        first_line = last_line
+
+    header = json.dumps({
+        "metadata": metadata,
+        "num_lines": len(lines),
+        "tags": tags or {},
+        "blocks": blocks,
+    }).encode()
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(LOG_FILE_HEADER.pack(LOG_FILE_MAGIC, LOG_FILE_VERSION, len(header)))
+        f.write(header)
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(tmp_path, path)
+
+
+class LogFile:
+    """Reader for a .mwlog file. Only the header is read up front, lines are decompressed on demand"""
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            magic, version, header_len = LOG_FILE_HEADER.unpack(f.read(LOG_FILE_HEADER.size))
+            if magic != LOG_FILE_MAGIC:
+                raise ValueError(f"{path} is not a kernel log file")
+            if version > LOG_FILE_VERSION:
+                raise ValueError(f"{path} has format version {version}, newer than this reader ({LOG_FILE_VERSION})")
+            header = json.loads(f.read(header_len))
+        self.data_start = LOG_FILE_HEADER.size + header_len
+        self.metadata = header["metadata"]
+        self.num_lines = header["num_lines"]
+        self.tags = header["tags"]
+        self.blocks = header["blocks"]
+        self.block_starts = [block[0] for block in self.blocks]
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def __len__(self):
+        return self.num_lines
+
+    def read_block(self, f, idx: int) -> List[str]:
+        _, offset, length = self.blocks[idx]
+        f.seek(self.data_start + offset)
+        return self.decompressor.decompress(f.read(length)).decode().split("\n")
+
+    def lines(self, start: int = 0, end: int = None) -> List[str]:
+        """Lines [start, end), decompressing only the blocks they are in"""
+        end = self.num_lines if end is None else min(end, self.num_lines)
+        if start >= end:
+            return []
+        first = bisect.bisect_right(self.block_starts, start) - 1
+        last = bisect.bisect_right(self.block_starts, end - 1) - 1
+        lines = []
+        with open(self.path, "rb") as f:
+            for idx in range(first, last + 1):
+                lines += self.read_block(f, idx)
+        offset = self.block_starts[first]
+        return lines[start - offset:end - offset]
+
+    def find_tag(self, tag: str, after: int = -1) -> int:
+        """Line number of the first occurrence of tag after line after, None if there isn't one"""
+        for line_no in self.tags.get(tag, []):
+            if line_no > after:
+                return line_no
+        return None
+
+    def section(self, start_tag: str, end_tag: str) -> List[str]:
+        """Lines strictly between start_tag and the next end_tag, None if either is missing"""
+        start = self.find_tag(start_tag)
+        if start is None:
+            return None
+        end = self.find_tag(end_tag, after=start)
+        if end is None:
+            return None
+        return self.lines(start + 1, end)
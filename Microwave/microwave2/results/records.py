@@ -0,0 +1,274 @@
+"""
+Framed result records, sent by the guest on their own virtio-serial port (results-port) so benchmark
+output never has to be fished out of the console or aux log by scanning for tags.
+
+Each frame is
+    magic (4) | type (u8) | iteration (u32) | name length (u16) | payload length (u32) | name | payload | crc32 (u32)
+big endian, with the crc over everything before it. A decoder that hits garbage skips ahead to the
+next magic, so a torn or corrupted frame only loses itself. A corrupted length can't be told apart
+from a frame still arriving, so that skip only happens at the end of the stream (finish()).
+
+BEGIN/END records (written around each script of a bundled boot, and each agent run) open and close a
+section, RESULTS/RAW records append their payload to <benchmark>.<kind> in the current section.
+"""
+import json
+import os
+import shutil
+import struct
+import zlib
+from typing import Dict, List
+
+from microwave2.utils.log import log, warn, error, debug, info
+
+RECORD_MAGIC = b"MWRC"
+RECORD_HEADER = struct.Struct(">4sBIHI")
+RECORD_CRC = struct.Struct(">I")
+# Guest writer splits payloads to at most this, anything claiming to be longer is garbage
+RECORD_MAX_PAYLOAD = 1 << 20
+RECORD_MAX_NAME = 255
+NO_ITERATION = 0xFFFFFFFF
+
+RECORD_BEGIN = 1
+RECORD_END = 2
+RECORD_RESULTS = 3
+RECORD_RAW = 4
+
+# Record type -> file extension of the data it carries
+RECORD_KINDS = {
+    RECORD_RESULTS: "results",
+    RECORD_RAW: "raw",
+}
+
+RESULTS_PORT_PATH = "/dev/virtio-ports/results-port"
+DEFAULT_SECTION = "main"
+# Section the guest agent wraps each run in, by request id
+AGENT_SECTION = "agent-{}"
+RECORD_INDEX_NAME = "index.json"
+
+
+class Record:
+    def __init__(self, type: int, benchmark: str, iteration: int, payload: bytes):
+        self.type = type
+        self.benchmark = benchmark
+        self.iteration = iteration
+        self.payload = payload
+
+    def __repr__(self):
+        return f"Record(type={self.type}, benchmark={self.benchmark}, iteration={self.iteration}, {len(self.payload)} bytes)"
+
+
+def encode_record(type: int, benchmark: str, iteration: int, payload: bytes) -> bytes:
+    name = benchmark.encode()
+    if len(name) > RECORD_MAX_NAME or len(payload) > RECORD_MAX_PAYLOAD:
+        raise ValueError("Record name or payload too long")
+    frame = RECORD_HEADER.pack(RECORD_MAGIC, type, NO_ITERATION if iteration is None else iteration,
+                               len(name), len(payload)) + name + payload
+    return frame + RECORD_CRC.pack(zlib.crc32(frame))
+
+
+class RecordDecoder:
+    """Incremental decoder, feed() it bytes as they arrive and finish() it at the end of the stream"""
+    def __init__(self):
+        self.buf = bytearray()
+        # Bad frames skipped, and the bytes thrown away with them
+        self.corrupt = 0
+        self.corrupt_bytes = 0
+        # Set while skipping the rest of a frame skip() already counted
+        self.resyncing = False
+
+    def feed(self, data: bytes) -> List[Record]:
+        self.buf += data
+        records = []
+        while True:
+            start = self.buf.find(RECORD_MAGIC)
+            if start < 0:
+                # Keep a possible partial magic at the end
+                dropped = max(0, len(self.buf) - len(RECORD_MAGIC) + 1)
+                self.corrupt_bytes += dropped
+                del self.buf[:dropped]
+                return records
+            if start > 0:
+                if not self.resyncing:
+                    self.corrupt += 1
+                self.corrupt_bytes += start
+                del self.buf[:start]
+            self.resyncing = False
+            if len(self.buf) < RECORD_HEADER.size:
+                return records
+
+            _, type, iteration, name_len, payload_len = RECORD_HEADER.unpack_from(self.buf)
+            if name_len > RECORD_MAX_NAME or payload_len > RECORD_MAX_PAYLOAD:
+                self.skip()
+                continue
+            frame_len = RECORD_HEADER.size + name_len + payload_len
+            if len(self.buf) < frame_len + RECORD_CRC.size:
+                return records
+
+            (crc,) = RECORD_CRC.unpack_from(self.buf, frame_len)
+            if crc != zlib.crc32(self.buf[:frame_len]):
+                self.skip()
+                continue
+
+            name = bytes(self.buf[RECORD_HEADER.size:RECORD_HEADER.size + name_len]).decode(errors="backslashreplace")
+            payload = bytes(self.buf[RECORD_HEADER.size + name_len:frame_len])
+            records.append(Record(type, name, None if iteration == NO_ITERATION else iteration, payload))
+            del self.buf[:frame_len + RECORD_CRC.size]
+
+    def skip(self):
+        """Drop a bad frame's magic so the next search finds the following frame"""
+        self.corrupt += 1
+        self.corrupt_bytes += len(RECORD_MAGIC)
+        self.resyncing = True
+        del self.buf[:len(RECORD_MAGIC)]
+
+    def finish(self) -> List[Record]:
+        """End of the stream. A frame still waiting for bytes will never get them, so its length was
+        corrupt: skip it and decode whatever frames follow it"""
+        records = self.feed(b"")
+        while self.buf.startswith(RECORD_MAGIC):
+            self.skip()
+            records += self.feed(b"")
+        self.corrupt_bytes += len(self.buf)
+        self.buf.clear()
+        return records
+
+
+class RecordSet:
+    """Directory of <benchmark>.<kind> files plus index.json, one per section of a run"""
+    def __init__(self, records_dir: str):
+        self.records_dir = records_dir
+        self.index = {}
+        index_path = os.path.join(records_dir, RECORD_INDEX_NAME)
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                self.index = json.load(f)
+
+    def file_name(self, benchmark: str, kind: str) -> str:
+        # Names come from the guest, keep them inside the directory
+        return f"{benchmark.replace('/', '_')}.{kind}"
+
+    def add(self, record: Record):
+        kind = RECORD_KINDS[record.type]
+        os.makedirs(self.records_dir, exist_ok=True)
+        name = self.file_name(record.benchmark, kind)
+        with open(os.path.join(self.records_dir, name), "ab") as f:
+            f.write(record.payload)
+        entry = self.index.setdefault(record.benchmark, {}).setdefault(kind, {"file": name, "size": 0, "iteration": None})
+        entry["size"] += len(record.payload)
+        entry["iteration"] = record.iteration
+        self.save_index()
+
+    def save_index(self):
+        os.makedirs(self.records_dir, exist_ok=True)
+        with open(os.path.join(self.records_dir, RECORD_INDEX_NAME), "w") as f:
+            json.dump(self.index, f, indent=4)
+
+    def benchmarks(self) -> List[str]:
+        return list(self.index.keys())
+
+    def get(self, benchmark: str, kind: str = "results") -> bytes:
+        """Payload the guest sent for benchmark, None if it sent nothing"""
+        entry = self.index.get(benchmark, {}).get(kind)
+        if entry is None:
+            return None
+        with open(os.path.join(self.records_dir, entry["file"]), "rb") as f:
+            return f.read()
+
+    def get_text(self, benchmark: str, kind: str = "results") -> str:
+        data = self.get(benchmark, kind)
+        if data is None:
+            return None
+        return data.decode(errors="backslashreplace")
+
+    def __len__(self):
+        return len(self.index)
+
+    def copy_to(self, dest_dir: str) -> "RecordSet":
+        """Copy into dest_dir (replacing whatever was there), returns the copy"""
+        shutil.rmtree(dest_dir, ignore_errors=True)
+        if os.path.exists(self.records_dir):
+            shutil.copytree(self.records_dir, dest_dir)
+        copy = RecordSet(dest_dir)
+        # An index even when empty, so a log saved with no records is told apart from one saved before records existed
+        copy.save_index()
+        return copy
+
+
+class RecordDemux:
+    """Decodes the results port stream and writes each record into its section's RecordSet as it comes in"""
+    def __init__(self, out_dir: str):
+        self.out_dir = out_dir
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.makedirs(out_dir)
+        self.decoder = RecordDecoder()
+        self.sections: Dict[str, RecordSet] = {}
+        self.current = DEFAULT_SECTION
+        self.num_records = 0
+
+    def section(self, name: str) -> RecordSet:
+        if name not in self.sections:
+            self.sections[name] = RecordSet(os.path.join(self.out_dir, name.replace("/", "_")))
+        return self.sections[name]
+
+    def feed(self, data: bytes):
+        self.dispatch(self.decoder.feed(data))
+
+    def finish(self):
+        """End of the stream, see RecordDecoder.finish"""
+        self.dispatch(self.decoder.finish())
+
+    def dispatch(self, records: List[Record]):
+        for record in records:
+            self.num_records += 1
+            if record.type == RECORD_BEGIN:
+                self.current = record.benchmark
+                self.section(self.current)
+            elif record.type == RECORD_END:
+                self.current = DEFAULT_SECTION
+            elif record.type in RECORD_KINDS:
+                self.section(self.current).add(record)
+            else:
+                warn(f"[RecordDemux] Ignoring record of unknown type {record.type}")
+
+    def get_section(self, name: str = DEFAULT_SECTION) -> RecordSet:
+        """Records of a section, empty if the guest never sent any"""
+        return self.section(name)
+
+
+class RecordTail:
+    """Follows the file QEMU writes the results port to, feeding a RecordDemux as it grows"""
+    def __init__(self, stream_path: str, demux: RecordDemux):
+        self.stream_path = stream_path
+        self.demux = demux
+        self.offset = 0
+
+    def poll(self):
+        if not os.path.exists(self.stream_path):
+            return
+        with open(self.stream_path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        self.offset += len(data)
+        if data:
+            self.demux.feed(data)
+
+    def finish(self):
+        self.poll()
+        self.demux.finish()
+        decoder = self.demux.decoder
+        if decoder.corrupt:
+            warn(f"[RecordTail] Skipped {decoder.corrupt} corrupt frames ({decoder.corrupt_bytes} bytes) in {self.stream_path}")
+        debug(f"[RecordTail] {self.demux.num_records} records from {self.stream_path}")
+
+
+def records_dir_for(json_path: str) -> str:
+    """Where the records of a saved kernel log json live (next to it)"""
+    return os.path.splitext(json_path)[0] + ".records"
+
+
+def load_records(json_path: str) -> RecordSet:
+    """Records saved with a kernel log json, None for logs saved without any"""
+    records_dir = records_dir_for(json_path)
+    if not os.path.exists(os.path.join(records_dir, RECORD_INDEX_NAME)):
+        return None
+    return RecordSet(records_dir)
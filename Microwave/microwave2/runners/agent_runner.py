@@ -0,0 +1,347 @@
+"""
+Runner that keeps one VM booted and drives it through the guest agent (see build_agent_script in
+ubuntu_resources), instead of rebooting for every launch script and iteration. The agent port is a
+virtio-serial port QEMU exposes as a unix socket, every request/response is one JSON line.
+"""
+import base64
+import json
+import os
+import re
+import socket
+import threading
+import time
+
+from microwave2.images.ubuntu_image import UbuntuDiskImage
+from microwave2.results.result import Result
+from microwave2.results.kernel_log import KernelLog, RawKernelLogResult, AUX_LOG_MARKER, AGENT_READY_TAG, AGENT_BEGIN_TAG, AGENT_END_TAG, AGENT_KEXEC_TAG, strip_kernel_timestamp
+from microwave2.results.records import RecordDemux, RecordTail, AGENT_SECTION
+from microwave2.utils.log import log, warn, error, debug, info
+from microwave2.utils.qemu import kill_vm
+from microwave2.images.ubuntu_resources import AGENT_KEXEC_KERNEL_PATH
+
+# Bytes of a file per "put" request (base64 encoded on the wire)
+PUT_CHUNK_SIZE = 1 << 20
+
+
+class AgentError(Exception):
+    """The agent didn't answer, or the connection to it broke"""
+
+
+class AgentClient:
+    """Host end of the agent port"""
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self.sock = None
+        self.buf = b""
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def connect(self, timeout: float):
+        """Connect to QEMU's end of the port, which only exists once QEMU has started"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.socket_path)
+                self.sock = sock
+                return
+            except OSError as e:
+                sock.close()
+                if time.monotonic() > deadline:
+                    raise AgentError(f"Couldn't connect to agent socket {self.socket_path}: {e}")
+                time.sleep(0.2)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def read_response(self, request_id: int, deadline: float) -> dict:
+        while True:
+            while b"\n" in self.buf:
+                line, self.buf = self.buf.split(b"\n", 1)
+                if not line.strip():
+                    continue
+                response = json.loads(line)
+                if response.get("id") == request_id:
+                    return response
+                # Answer to an earlier request we gave up on
+                debug(f"[AgentClient] Dropping stale response {response}")
+
+            remaining = deadline - time.monotonic() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                raise AgentError(f"No response to request {request_id}")
+            self.sock.settimeout(remaining)
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                raise AgentError(f"No response to request {request_id}")
+            if not data:
+                raise AgentError("Agent connection closed")
+            self.buf += data
+
+    def call(self, cmd: str, args: dict = None, timeout: float = None) -> dict:
+        """Send one request and wait for its response (forever if timeout is None)"""
+        with self.lock:
+            request_id = self.next_id
+            self.next_id += 1
+            request = dict(args or {}, id=request_id, cmd=cmd)
+            self.sock.sendall((json.dumps(request) + "\n").encode())
+            deadline = time.monotonic() + timeout if timeout is not None else None
+            return self.read_response(request_id, deadline)
+
+    def wait_ready(self, timeout: float, ping_timeout: float = 2):
+        """Ping until the agent answers. Until it has opened its end, the guest drops what we send"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self.call("ping", timeout=ping_timeout)
+            except AgentError:
+                if time.monotonic() > deadline:
+                    raise
+
+
+class AgentRunner:
+    """Boots disk_image once (its init script must start the agent, see set_launch_script(agent=True)),
+    then runs launch scripts on request. Each run() returns a RawKernelLogResult shaped like the
+    result of a normal boot that only ran that script, so existing log parsing works unchanged.
+    switch_kernel() kexecs the VM into another kernel, later runs then get that kernel's boot log"""
+    def __init__(self, disk_image: UbuntuDiskImage, aux_logfile_path: str, extra_args: str = None,
+                 boot_timeout: float = 600, boot_profile: str = None):
+        self.disk_image = disk_image
+        self.aux_logfile_path = aux_logfile_path
+        self.extra_args = extra_args
+        self.boot_timeout = boot_timeout
+        self.boot_profile = boot_profile
+        self.socket_path = os.path.join(disk_image.temp_workdir, f"agent-{disk_image.image_name}.sock")
+
+        self.process = None
+        self.client = None
+        self.reader = None
+        self.console_lines = []
+        self.console_changed = threading.Condition()
+        self.boot_to_ready = None
+        # Console index where the current kernel's boot starts (0 until switch_kernel)
+        self.segment_start = 0
+        self.records_path = f"{aux_logfile_path}.records"
+        self.demux = None
+        self.records_tail = None
+        self.records_lock = threading.Lock()
+
+    def read_console(self):
+        for line in self.process.stdout:
+            print(line, end="")
+            with self.console_changed:
+                self.console_lines.append(line.strip())
+                self.console_changed.notify_all()
+        with self.console_changed:
+            self.console_changed.notify_all()
+
+    def follow_records(self):
+        while self.process.poll() is None:
+            with self.records_lock:
+                self.records_tail.poll()
+            time.sleep(0.5)
+        with self.records_lock:
+            self.records_tail.finish()
+
+    def wait_console(self, tag: str, start: int, timeout: float) -> int:
+        """Index of the first console line at or after start that is tag, None on timeout or VM exit"""
+        deadline = time.monotonic() + timeout
+        with self.console_changed:
+            idx = start
+            while True:
+                while idx < len(self.console_lines):
+                    if strip_kernel_timestamp(self.console_lines[idx]) == tag:
+                        return idx
+                    idx += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self.process.poll() is not None:
+                    return None
+                self.console_changed.wait(remaining)
+
+    def start(self) -> Result:
+        """Boot the VM and wait for the agent to answer"""
+        if self.process is not None:
+            return Result.failure("Agent VM already started")
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        boot_start = time.perf_counter()
+        self.process = self.disk_image.boot_image(interactive=False, aux_logfile_path=self.aux_logfile_path,
+                                                  extra_args=self.extra_args, boot_profile=self.boot_profile,
+                                                  agent_socket_path=self.socket_path, records_path=self.records_path)
+        self.reader = threading.Thread(target=self.read_console, daemon=True)
+        self.reader.start()
+        self.demux = RecordDemux(f"{self.aux_logfile_path}.records.d")
+        self.records_tail = RecordTail(self.records_path, self.demux)
+        threading.Thread(target=self.follow_records, daemon=True).start()
+
+        self.client = AgentClient(self.socket_path)
+        try:
+            self.client.connect(timeout=60)
+            self.client.wait_ready(timeout=self.boot_timeout)
+        except AgentError as e:
+            error(f"[AgentRunner] Agent never came up: {e}")
+            self.kill()
+            return Result.failure("Agent never came up", e)
+
+        self.boot_to_ready = time.perf_counter() - boot_start
+        info(f"[AgentRunner] Agent ready after {self.boot_to_ready:.1f}s")
+        return Result.success()
+
+    def get_boot_lines(self) -> list:
+        """Console lines up to the agent coming up, minus the init script's own launch marker so
+        each run's log has exactly one marked test section"""
+        marker = re.compile(self.disk_image.get_launch_marker())
+        boot_lines = []
+        for line in self.console_lines[self.segment_start:]:
+            stripped = strip_kernel_timestamp(line)
+            if not marker.match(stripped):
+                boot_lines.append(line)
+            if stripped == AGENT_READY_TAG:
+                break
+        return boot_lines
+
+    def aux_size(self) -> int:
+        if not os.path.exists(self.aux_logfile_path):
+            return 0
+        return os.path.getsize(self.aux_logfile_path)
+
+    def read_aux(self, offset: int) -> list:
+        if not os.path.exists(self.aux_logfile_path):
+            return []
+        with open(self.aux_logfile_path, "r", errors="backslashreplace") as f:
+            f.seek(offset)
+            return [line.strip() for line in f]
+
+    def run(self, launch_script: str, name: str = None, iteration: int = None, env: dict = None,
+            timeout: float = 1200, cwd: str = "/test"):
+        """Run one launch script (path in the guest) in the booted VM. Returns a RawKernelLogResult
+        holding the boot log, the script's console output and its part of the aux log, or a failed Result"""
+        if self.client is None:
+            return Result.failure("Agent VM not started")
+
+        with self.console_changed:
+            console_start = len(self.console_lines)
+        aux_start = self.aux_size()
+
+        try:
+            # Guest enforces the timeout, give it a little longer to report back
+            args = {"script": launch_script, "iteration": iteration, "env": env, "cwd": cwd,
+                    "timeout": timeout, "marker": self.disk_image.get_launch_marker(),
+                    "output": self.disk_image.console_policy.output_path()}
+            response = self.client.call("run", args, timeout=timeout + 60)
+        except AgentError as e:
+            error(f"[AgentRunner] Lost the agent while running {launch_script}: {e}")
+            return Result.failure(f"Lost the agent while running {launch_script}", e)
+
+        # Console output travels separately (serial), wait for it to catch up with the response
+        end_tag = AGENT_END_TAG.format(response["id"])
+        end_idx = self.wait_console(end_tag, console_start, timeout=30)
+        begin_idx = self.wait_console(AGENT_BEGIN_TAG.format(response["id"]), console_start, timeout=0)
+        if end_idx is None or begin_idx is None:
+            warn(f"[AgentRunner] Console output of {launch_script} incomplete")
+        with self.console_changed:
+            if begin_idx is None:
+                begin_idx = console_start
+            if end_idx is None:
+                end_idx = len(self.console_lines) - 1
+            run_lines = self.console_lines[begin_idx:end_idx + 1]
+            boot_lines = self.get_boot_lines()
+
+        if not response.get("ok"):
+            error(f"[AgentRunner] {launch_script} failed in the guest: {response.get('error')}")
+            return Result.failure(f"{launch_script} failed: {response.get('error')}")
+
+        lines = boot_lines + run_lines + [AUX_LOG_MARKER] + self.read_aux(aux_start)
+        kernel_log = KernelLog(lines, test_marker=self.disk_image.get_launch_marker())
+        kernel_log.boot_to_benchmark = self.boot_to_ready
+        kernel_log.console_policy = self.disk_image.console_policy.name
+        with self.records_lock:
+            self.records_tail.poll()
+            kernel_log.records = self.demux.get_section(AGENT_SECTION.format(response["id"]))
+        info(f"[AgentRunner] {launch_script} (iteration {iteration}) finished in {response.get('duration', 0):.1f}s, exit code {response.get('returncode')}")
+        return RawKernelLogResult(kernel_log, name=name)
+
+    def push_file(self, local_path: str, guest_path: str) -> Result:
+        """Copy a host file into the guest over the agent port"""
+        try:
+            with open(local_path, "rb") as f:
+                offset = 0
+                while True:
+                    chunk = f.read(PUT_CHUNK_SIZE)
+                    response = self.client.call("put", {"path": guest_path, "offset": offset,
+                                                        "data": base64.b64encode(chunk).decode()}, timeout=60)
+                    if not response.get("ok"):
+                        return Result.failure(f"Failed to write {guest_path}: {response.get('error')}")
+                    offset += len(chunk)
+                    if len(chunk) < PUT_CHUNK_SIZE:
+                        break
+        except AgentError as e:
+            return Result.failure(f"Lost the agent while copying {local_path}", e)
+        return Result.success()
+
+    def switch_kernel(self, kernel_path: str, cmdline: str, timeout: float = None) -> Result:
+        """kexec the running VM into kernel_path (a bzImage) booted with cmdline, and wait for the agent
+        to come back up under it. QEMU keeps running, so its startup and memory preallocation aren't
+        paid again. The userspace is the booted image's, so the kernel must not need modules it lacks"""
+        if self.client is None:
+            return Result.failure("Agent VM not started")
+        if timeout is None:
+            timeout = self.boot_timeout
+
+        result = self.push_file(kernel_path, AGENT_KEXEC_KERNEL_PATH)
+        if result.is_failure():
+            error(f"[AgentRunner] {result.message}")
+            return result
+
+        with self.console_changed:
+            segment_start = len(self.console_lines)
+        switch_start = time.perf_counter()
+        try:
+            response = self.client.call("kexec", {"kernel": AGENT_KEXEC_KERNEL_PATH, "cmdline": cmdline}, timeout=60)
+        except AgentError as e:
+            return Result.failure("Lost the agent while loading the next kernel", e)
+        if not response.get("ok"):
+            error(f"[AgentRunner] Guest couldn't load {kernel_path}: {response.get('error')}")
+            return Result.failure(f"kexec load failed: {response.get('error')}")
+
+        # Ready tag of the new kernel's agent, the old one printed its own before segment_start
+        if self.wait_console(AGENT_KEXEC_TAG, segment_start, timeout=30) is None:
+            return Result.failure("Guest never kexeced")
+        if self.wait_console(AGENT_READY_TAG, segment_start, timeout=timeout) is None:
+            return Result.failure("Agent didn't come back after kexec")
+        try:
+            self.client.wait_ready(timeout=60)
+        except AgentError as e:
+            return Result.failure("Agent didn't answer after kexec", e)
+
+        self.segment_start = segment_start
+        self.boot_to_ready = time.perf_counter() - switch_start
+        info(f"[AgentRunner] Switched to {kernel_path} in {self.boot_to_ready:.1f}s")
+        return Result.success()
+
+    def kill(self):
+        if self.process is not None:
+            kill_vm(self.process)
+        if self.client is not None:
+            self.client.close()
+
+    def stop(self, timeout: float = 120) -> Result:
+        """Ask the agent to exit (the init script then shuts the VM down), kill the VM if it doesn't"""
+        if self.process is None:
+            return Result.success()
+        try:
+            self.client.call("shutdown", timeout=10)
+        except AgentError as e:
+            warn(f"[AgentRunner] Agent didn't acknowledge shutdown: {e}")
+        try:
+            self.process.wait(timeout=timeout)
+        except Exception:
+            warn("[AgentRunner] VM didn't shut down, killing it")
+        self.kill()
+        self.reader.join(timeout=10)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        return Result.success()
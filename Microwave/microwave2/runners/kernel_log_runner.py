@@ -2,14 +2,18 @@ from microwave2.runners.runner import Runner
 from microwave2.images.ubuntu_image import UbuntuDiskImage
 
 from microwave2.results.result import Result, TestResult
-from microwave2.results.kernel_log import KernelLog, RawKernelLogResult
+from microwave2.results.kernel_log import KernelLog, RawKernelLogResult, AUX_LOG_MARKER
+from microwave2.results.records import RecordDemux, RecordTail, DEFAULT_SECTION
+from microwave2.runners.log_monitor import LogMonitor, Detector, default_detectors, ABNORMAL_STOPS, STOP_EXITED
+from microwave2.runners.warm_start import warm_start_for
 
 from typing import List
 from dataclasses import dataclass
 import re
 
 import threading
-from microwave2.utils.qemu import QemuCommand, QemuKernel
+import time
+from microwave2.utils.qemu import QemuCommand, QemuKernel, kill_vm
 from microwave2.utils.utils import debug_pause
 import os
 
@@ -19,69 +23,113 @@ import os
 #   - getting logs from other places than kernel logs
 class KernelLogRunner:
     """Runner that takes in a disk image, runs it, and retrieves/parses kernel logs"""
-    def __init__(self, disk_image: UbuntuDiskImage, timeout: float = 600, extra_args: str = None):
+    def __init__(self, disk_image: UbuntuDiskImage, timeout: float = 600, extra_args: str = None, aux_logfile_path: str = None, boot_profile: str = None, detectors: List[Detector] = None, warm: bool = None):
         self.disk_image = disk_image
+        # Restore a snapshot of an earlier boot of the same kernel config instead of booting (see
+        # warm_start.py, payload images only). Defaults to MICROWAVE_WARM_START=1
+        if warm is None:
+            warm = os.environ.get("MICROWAVE_WARM_START", "0") == "1"
+        self.warm = warm
+        # What can end a boot early (see log_monitor), None for default_detectors
+        self.detectors = detectors
+        # None uses the image's default (see UbuntuDiskImage, BOOT_PROFILE_FAST for microvm + minimal init)
+        self.boot_profile = boot_profile
         self.kernel_log = None
         self.timeout = timeout
         self.extra_args = extra_args
-
-    def start_timeout_thread(self, timeout: float, process):
-        """Enforce the timeout in a background thread."""
-        def _wait_proc() -> None:
-            try:
-                process.wait(timeout=timeout)
-            except Exception as e:
-                print(e)
-                print("Error: Process likely hanging, terminating")
-                process.kill()
-                # process.wait()
-        waiter = threading.Thread(target=_wait_proc)
-        waiter.start()
+        # For now, default is directory of this file plus aux_logfile.txt (only safe with one VM at a time)
+        if aux_logfile_path is None:
+            aux_logfile_path = os.path.join(os.path.dirname(__file__), "aux_logfile.txt")
+        self.aux_logfile_path = aux_logfile_path
 
     def boot(self, timeout: float = 600, extra_args:str=None):
-        """Run the target code"""
+        """Run the target code, reading the console and aux log live. The detectors (default_detectors
+        unless given) can stop the VM early, why it stopped ends up in kernel_log.stop_reason"""
         print("Running target code")
 
         if self.kernel_log is not None:
             raise Exception("Kernel log already exists, cannot run again")
         
         self.kernel_log = KernelLog(test_marker=self.disk_image.get_launch_marker())
+        self.kernel_log.console_policy = self.disk_image.console_policy.name
         
-        # For now, just use directory of this file plus aux_logfile.txt
-        aux_logfile_path = os.path.join(os.path.dirname(__file__), "aux_logfile.txt")
+        aux_logfile_path = self.aux_logfile_path
 
         print("Booting image")
-        process = self.disk_image.boot_image(memory_mb=4096, cores=4, interactive=False, aux_logfile_path=aux_logfile_path, extra_args=extra_args)
-        self.start_timeout_thread(timeout, process)
+        records_path = f"{aux_logfile_path}.records"
+        demux = RecordDemux(f"{aux_logfile_path}.records.d")
+        records_tail = RecordTail(records_path, demux)
+        aux_lines = []
+        detectors = self.detectors if self.detectors is not None else default_detectors(self.disk_image.get_launch_marker())
+        warm_start = None
+        if self.warm:
+            warm_start = warm_start_for(self.disk_image, extra_args=extra_args, boot_profile=self.boot_profile)
+            if warm_start is None:
+                print("[KernelLogRunner] Warm start needs an x86 payload image with an override kernel, booting cold")
+            elif warm_start.restoring:
+                if self.disk_image.use_warm_disk(warm_start.snapshot.disk_path).is_failure():
+                    # Most likely the snapshot's disk is broken, the next boot takes a new one
+                    warm_start.snapshot.invalidate()
+                    return Result.failure("Failed to set up warm start disk")
+                print(f"[KernelLogRunner] Restoring warm start snapshot {warm_start.snapshot.snapshot_dir}")
+                # The log reads like a normal boot's, the boot itself just happened earlier
+                for line in warm_start.snapshot.boot_lines():
+                    self.kernel_log.add_line(line)
+            else:
+                print(f"[KernelLogRunner] No warm start snapshot yet, this boot takes {warm_start.snapshot.snapshot_dir}")
+        warm_args = warm_start.boot_args() if warm_start is not None else {}
 
-        print("Reading kernel log")
-        for line in process.stdout:
+        boot_start = time.perf_counter()
+        process = self.disk_image.boot_image(memory_mb=4096, cores=4, interactive=False, aux_logfile_path=aux_logfile_path, extra_args=extra_args, boot_profile=self.boot_profile, records_path=records_path, **warm_args)
+        if warm_start is not None:
+            warm_start.start()
+
+        def on_console(line: str):
+            if warm_start is not None:
+                warm_start.on_console(line)
             self.kernel_log.add_line(line)
-            print(line, end="")
+            if self.kernel_log.boot_to_benchmark is None and self.kernel_log.has_test_section and self.kernel_log.test_section_start is not None:
+                self.kernel_log.boot_to_benchmark = time.perf_counter() - boot_start
+                print(f"[KernelLogRunner] Boot to benchmark: {self.kernel_log.boot_to_benchmark:.2f}s")
 
-        print("Waiting for process to finish")
+        print("Reading kernel log")
+        monitor = LogMonitor(process, aux_logfile_path, detectors, on_console=on_console, on_aux=aux_lines.append,
+                             stop_vm=lambda: kill_vm(process), timeout=timeout, on_poll=records_tail.poll)
+        stop_event = monitor.run()
         process.wait()
+        records_tail.finish()
+        if warm_start is not None:
+            warm_start.finish()
+        self.kernel_log.stop_reason = stop_event.to_json()
+        self.kernel_log.records = demux.get_section(DEFAULT_SECTION)
+        self.kernel_log.record_sections = dict(demux.sections)
 
-        # IF aux logfile is not None, read it and append to kernel log
-        if aux_logfile_path is not None:
-            self.kernel_log.add_line("Aux log file:")
-            print("Aux log file:")
-            with open(aux_logfile_path, "r") as f:
-                for line in f:
-                    self.kernel_log.add_line(line)
-                    print(line, end="")
+        # Aux log goes after the console output, behind the marker
+        self.kernel_log.add_line(AUX_LOG_MARKER)
+        print(AUX_LOG_MARKER)
+        for line in aux_lines:
+            self.kernel_log.add_line(line)
+            print(line)
 
-        # Check process exit code
-        if process.returncode != 0:
+        print(f"[KernelLogRunner] VM stopped ({stop_event.kind}): {stop_event.detail}")
+        console_bytes = self.kernel_log.console_window_bytes()
+        if console_bytes is not None:
+            print(f"[KernelLogRunner] Console output during the test section: {console_bytes} bytes ({self.kernel_log.console_policy} console policy)")
+        if stop_event.kind in ABNORMAL_STOPS:
+            return Result.failure(f"VM stopped ({stop_event.kind}): {stop_event.detail}")
+        # Killed after the run completed is fine
+        if stop_event.kind == STOP_EXITED and process.returncode != 0:
             print("Error: Process exited with code", process.returncode)
             return Result.failure("Process exited with code " + str(process.returncode))
-        else:
-            print("Process exited successfully")
-            return Result.success()
+        print("Process exited successfully")
+        return Result.success()
         
     def run(self) -> TestResult:
         """Run the target code"""
-        self.boot(timeout=self.timeout, extra_args=self.extra_args)
+        result = self.boot(timeout=self.timeout, extra_args=self.extra_args)
+        # Failed before the VM ran (no stop reason), there is no log worth handing back
+        if result.is_failure() and self.kernel_log.stop_reason is None:
+            return result
 
         kernel_result = RawKernelLogResult(self.kernel_log)
 
@@ -0,0 +1,258 @@
+"""
+Live reading of a booted VM's console and aux log, with detectors that can end the run early.
+A detector looks at each line (or at the silence between them) and returns a StopEvent when the VM
+should go: the run finished, the kernel crashed, or nothing has been printed for too long. The
+monitor then gives the VM the event's grace period (to finish a crash dump or shut down cleanly)
+before killing it, and records why in the kernel log.
+"""
+import os
+import re
+import selectors
+import sys
+import time
+from typing import Callable, List
+
+from microwave2.results.kernel_log import strip_kernel_timestamp
+from microwave2.utils.log import log, warn, error, debug, info
+
+CONSOLE = "console"
+AUX = "aux"
+
+# Stop kinds, recorded as KernelLog.stop_reason["kind"]
+STOP_EXITED = "exited"
+STOP_COMPLETE = "complete"
+STOP_CRASH = "crash"
+STOP_INACTIVE = "inactive"
+STOP_TIMEOUT = "timeout"
+# Kinds where the run didn't get to finish
+ABNORMAL_STOPS = (STOP_CRASH, STOP_INACTIVE, STOP_TIMEOUT)
+
+READ_SIZE = 1 << 16
+
+
+class StopEvent:
+    def __init__(self, kind: str, detail: str, grace: float = 0):
+        self.kind = kind
+        self.detail = detail
+        self.grace = grace
+
+    def to_json(self):
+        return {"kind": self.kind, "detail": self.detail}
+
+    def __repr__(self):
+        return f"StopEvent({self.kind}: {self.detail})"
+
+
+class Detector:
+    """Base detector, override check_line and/or check_idle"""
+    def check_line(self, channel: str, line: str, now: float) -> StopEvent:
+        return None
+
+    def check_idle(self, now: float) -> StopEvent:
+        return None
+
+
+class CompletionDetector(Detector):
+    """Run is done once pattern has shown up occurrences times on the console (e.g. the launch
+    marker a second time, or a benchmark's COMPLETE tag). Leaves grace seconds for a clean shutdown"""
+    def __init__(self, pattern: str, occurrences: int = 1, grace: float = 10):
+        self.pattern = re.compile(pattern)
+        self.occurrences = occurrences
+        self.grace = grace
+        self.seen = 0
+
+    def check_line(self, channel, line, now):
+        if channel != CONSOLE or not self.pattern.match(line):
+            return None
+        self.seen += 1
+        if self.seen == self.occurrences:
+            return StopEvent(STOP_COMPLETE, line, grace=self.grace)
+        return None
+
+
+# Kernel splats that mean the run's results can't be trusted (or that it will never finish)
+CRASH_PATTERNS = [
+    r"Kernel panic - not syncing",
+    r"BUG: KASAN: ",
+    r"BUG: KFENCE: ",
+    r"UBSAN: ",
+    r"Oops: ",
+    r"general protection fault",
+    r"BUG: unable to handle",
+    r"kernel BUG at ",
+    r"BUG: soft lockup",
+    r"watchdog: BUG: soft lockup",
+    r"rcu: INFO: rcu_\w+ self-detected stall",
+]
+
+
+class CrashDetector(Detector):
+    """Kernel panic/oops/sanitizer report on the console. The grace period lets the rest of the
+    splat (backtrace, registers) reach the log"""
+    def __init__(self, patterns: List[str] = None, grace: float = 3):
+        self.pattern = re.compile("|".join(CRASH_PATTERNS if patterns is None else patterns))
+        self.grace = grace
+
+    def check_line(self, channel, line, now):
+        if channel == CONSOLE and self.pattern.search(line):
+            return StopEvent(STOP_CRASH, line, grace=self.grace)
+        return None
+
+
+class InactivityDetector(Detector):
+    """Nothing on either channel for timeout seconds, the guest is most likely hung"""
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.last_activity = time.monotonic()
+
+    def check_line(self, channel, line, now):
+        self.last_activity = now
+        return None
+
+    def check_idle(self, now):
+        if now - self.last_activity > self.timeout:
+            return StopEvent(STOP_INACTIVE, f"No output for {self.timeout:.0f}s")
+        return None
+
+
+def default_detectors(marker: str, inactivity_timeout: float = None) -> List[Detector]:
+    """Completion on the launch marker's second appearance (the init script prints it before and
+    after the launch script(s)), crash detection, and an inactivity watchdog.
+    inactivity_timeout defaults to MICROWAVE_INACTIVITY_TIMEOUT (seconds, 0 disables), or 600"""
+    if inactivity_timeout is None:
+        inactivity_timeout = float(os.environ.get("MICROWAVE_INACTIVITY_TIMEOUT", 600))
+    detectors = [CompletionDetector(marker, occurrences=2), CrashDetector()]
+    if inactivity_timeout > 0:
+        detectors.append(InactivityDetector(inactivity_timeout))
+    return detectors
+
+
+class LineSplitter:
+    """Turns chunks of bytes into complete lines, keeping the partial last line for the next chunk"""
+    def __init__(self):
+        self.partial = b""
+
+    def feed(self, data: bytes) -> List[str]:
+        data = self.partial + data
+        lines = data.split(b"\n")
+        self.partial = lines.pop()
+        return [line.decode(errors="backslashreplace").rstrip("\r") for line in lines]
+
+    def flush(self) -> List[str]:
+        if not self.partial:
+            return []
+        line = self.partial.decode(errors="backslashreplace")
+        self.partial = b""
+        return [line]
+
+
+class LogMonitor:
+    """Reads the console (the VM process's stdout) and aux log file together until the VM exits or a
+    detector stops it. on_console/on_aux get every complete line, stop_vm is called to kill the VM"""
+    def __init__(self, process, aux_logfile_path: str, detectors: List[Detector],
+                 on_console: Callable[[str], None], on_aux: Callable[[str], None],
+                 stop_vm: Callable[[], None], timeout: float = None, poll_interval: float = 0.2,
+                 echo: bool = True, on_poll: Callable[[], None] = None):
+        self.process = process
+        self.aux_logfile_path = aux_logfile_path
+        self.detectors = detectors
+        self.on_console = on_console
+        self.on_aux = on_aux
+        self.stop_vm = stop_vm
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.echo = echo
+        self.on_poll = on_poll
+
+        self.aux_offset = 0
+        self.aux_splitter = LineSplitter()
+        self.console_splitter = LineSplitter()
+        self.stop_event = None
+        self.kill_at = None
+
+    def handle_line(self, channel: str, line: str, now: float):
+        if channel == CONSOLE:
+            self.on_console(line)
+        else:
+            self.on_aux(line)
+        stripped = strip_kernel_timestamp(line)
+        for detector in self.detectors:
+            event = detector.check_line(channel, stripped, now)
+            if event is not None:
+                self.trigger(event, now)
+
+    def trigger(self, event: StopEvent, now: float):
+        # First event wins, later ones (e.g. the completion marker during a crash's grace period) are only logged
+        if self.stop_event is not None:
+            debug(f"[LogMonitor] Ignoring {event}, already stopping for {self.stop_event}")
+            return
+        info(f"[LogMonitor] Stopping VM ({event.kind}): {event.detail}" + (f", in {event.grace:g}s" if event.grace else ""))
+        self.stop_event = event
+        self.kill_at = now + event.grace
+
+    def read_aux(self, now: float):
+        if self.aux_logfile_path is None or not os.path.exists(self.aux_logfile_path):
+            return
+        with open(self.aux_logfile_path, "rb") as f:
+            f.seek(self.aux_offset)
+            data = f.read()
+        self.aux_offset += len(data)
+        for line in self.aux_splitter.feed(data):
+            self.handle_line(AUX, line, now)
+
+    def run(self) -> StopEvent:
+        """Monitor until the VM is gone, returns why it stopped"""
+        start = time.monotonic()
+        console_fd = self.process.stdout.fileno()
+        selector = selectors.DefaultSelector()
+        selector.register(console_fd, selectors.EVENT_READ)
+        console_open = True
+
+        while True:
+            ready = selector.select(timeout=self.poll_interval) if console_open else []
+            if not console_open:
+                time.sleep(self.poll_interval)
+            now = time.monotonic()
+
+            if ready:
+                data = os.read(console_fd, READ_SIZE)
+                if not data:
+                    console_open = False
+                    selector.unregister(console_fd)
+                else:
+                    if self.echo:
+                        sys.stdout.write(data.decode(errors="backslashreplace"))
+                    for line in self.console_splitter.feed(data):
+                        self.handle_line(CONSOLE, line, now)
+
+            self.read_aux(now)
+            if self.on_poll is not None:
+                self.on_poll()
+
+            if self.stop_event is None:
+                for detector in self.detectors:
+                    event = detector.check_idle(now)
+                    if event is not None:
+                        self.trigger(event, now)
+                if self.timeout is not None and now - start > self.timeout:
+                    self.trigger(StopEvent(STOP_TIMEOUT, f"Still running after {self.timeout:.0f}s"), now)
+
+            if not console_open and self.process.poll() is not None:
+                break
+            if self.kill_at is not None and now >= self.kill_at:
+                if self.process.poll() is None:
+                    self.stop_vm()
+                # Drain whatever the VM wrote before it died
+                self.kill_at = float("inf")
+
+        selector.close()
+        now = time.monotonic()
+        for line in self.console_splitter.flush():
+            self.handle_line(CONSOLE, line, now)
+        self.read_aux(now)
+        for line in self.aux_splitter.flush():
+            self.handle_line(AUX, line, now)
+
+        if self.stop_event is None:
+            self.stop_event = StopEvent(STOP_EXITED, f"Exit code {self.process.returncode}")
+        return self.stop_event
@@ -0,0 +1,188 @@
+"""
+Warm start for KernelLogRunner. The first boot of a kernel config is snapshotted at the point where
+the guest's payload hook waits on the warm port (see build_warm_wait), before anything of the run has
+happened: RAM and device state go to a file through a QMP migration, and the disk is copied while the
+VM is paused. Later boots of the same config restore that snapshot with -incoming instead of booting,
+so they go straight to the payload. Either way the host then sends the guest the current time and a
+fresh seed, so restored copies don't share the snapshot's clock or RNG state (q35 VMs also get a new
+vmgenid, which makes the guest kernel reseed by itself).
+
+Snapshots are keyed on everything a restore depends on (kernel, command line, image chain, payload
+disk size, QEMU), so changing any of it just costs one cold boot to take a new one.
+"""
+import hashlib
+import json
+import os
+import secrets
+import shutil
+import socket
+import threading
+import time
+from typing import List
+
+from microwave2.results.kernel_log import WARM_READY_TAG, strip_kernel_timestamp
+from microwave2.utils.qmp import QmpClient, QmpError
+from microwave2.utils.log import log, warn, error, debug, info
+
+WARM_SNAPSHOT_DIR_NAME = "warm-snapshots"
+STATE_NAME = "state.mig"
+DISK_NAME = "disk.qcow2"
+BOOT_LOG_NAME = "boot.log"
+META_NAME = "meta.json"
+
+
+def snapshot_key(key_parts: dict) -> str:
+    return hashlib.sha256(json.dumps(key_parts, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class WarmSnapshot:
+    """Directory holding one snapshot: migration stream, disk, and the console output of the boot
+    that took it (restored runs start their log with it, so it looks like a normal boot's)"""
+    def __init__(self, snapshot_dir: str):
+        self.snapshot_dir = snapshot_dir
+        self.state_path = os.path.join(snapshot_dir, STATE_NAME)
+        self.disk_path = os.path.join(snapshot_dir, DISK_NAME)
+
+    def exists(self) -> bool:
+        return os.path.exists(os.path.join(self.snapshot_dir, META_NAME))
+
+    def boot_lines(self) -> List[str]:
+        with open(os.path.join(self.snapshot_dir, BOOT_LOG_NAME), "r", errors="backslashreplace") as f:
+            return f.read().splitlines()
+
+    def save(self, qmp: QmpClient, disk_path: str, boot_lines: List[str], key_parts: dict):
+        """Snapshot the VM behind qmp, leaving it paused. Built in a temporary directory and renamed
+        into place, so concurrent VMs of the same config can't leave a half written snapshot"""
+        tmp_dir = f"{self.snapshot_dir}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        try:
+            start = time.perf_counter()
+            qmp.save_state(os.path.join(tmp_dir, STATE_NAME))
+            # Paused with its disks flushed, so the copy matches the saved RAM
+            shutil.copyfile(disk_path, os.path.join(tmp_dir, DISK_NAME))
+            with open(os.path.join(tmp_dir, BOOT_LOG_NAME), "w") as f:
+                f.write("\n".join(boot_lines) + "\n")
+            with open(os.path.join(tmp_dir, META_NAME), "w") as f:
+                json.dump({"key": key_parts, "created": time.time()}, f, indent=4)
+            if self.exists():
+                debug(f"[WarmSnapshot] {self.snapshot_dir} was taken meanwhile, keeping that one")
+                return
+            os.makedirs(os.path.dirname(self.snapshot_dir), exist_ok=True)
+            os.rename(tmp_dir, self.snapshot_dir)
+            size_mb = os.path.getsize(self.state_path) / (1 << 20)
+            info(f"[WarmSnapshot] Saved {self.snapshot_dir} ({size_mb:.0f} MB of state) in {time.perf_counter() - start:.1f}s")
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def invalidate(self):
+        shutil.rmtree(self.snapshot_dir, ignore_errors=True)
+
+
+def send_resume(socket_path: str, timeout: float = 30):
+    """Let the guest carry on, telling it the time and giving it a seed for its RNG"""
+    deadline = time.monotonic() + timeout
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path)
+            break
+        except OSError as e:
+            sock.close()
+            if time.monotonic() > deadline:
+                raise QmpError(f"Couldn't connect to warm port {socket_path}: {e}")
+            time.sleep(0.05)
+    with sock:
+        sock.sendall(f"{time.time():.6f} {secrets.token_hex(32)}\n".encode())
+
+
+class WarmStart:
+    """One warm start boot: restores the snapshot if there is one, otherwise takes it once the guest
+    says it is ready. boot_args() go to boot_image, on_console gets every console line"""
+    def __init__(self, snapshot: WarmSnapshot, key_parts: dict, disk_path: str, socket_dir: str, name: str):
+        self.snapshot = snapshot
+        self.key_parts = key_parts
+        self.disk_path = disk_path
+        self.restoring = snapshot.exists()
+        self.warm_socket_path = os.path.join(socket_dir, f"warm-{name}.sock")
+        self.qmp_socket_path = os.path.join(socket_dir, f"qmp-{name}.sock")
+        self.console_lines = []
+        self.ready = False
+        self.thread = None
+        self.launched = None
+        # Seconds from launching QEMU to the guest running again after a restore
+        self.restore_time = None
+
+    def boot_args(self) -> dict:
+        for path in (self.warm_socket_path, self.qmp_socket_path):
+            if os.path.exists(path):
+                os.remove(path)
+        args = {"warm_socket_path": self.warm_socket_path, "qmp_socket_path": self.qmp_socket_path}
+        if self.restoring:
+            args["incoming_state_path"] = self.snapshot.state_path
+        return args
+
+    def start(self):
+        """Call once QEMU has been launched"""
+        self.launched = time.perf_counter()
+        if self.restoring:
+            self.thread = threading.Thread(target=self.resume_restored, daemon=True)
+            self.thread.start()
+
+    def on_console(self, line: str):
+        if self.restoring or self.ready:
+            return
+        self.console_lines.append(line)
+        if strip_kernel_timestamp(line) == WARM_READY_TAG:
+            self.ready = True
+            self.thread = threading.Thread(target=self.snapshot_and_resume, daemon=True)
+            self.thread.start()
+
+    def resume_restored(self):
+        qmp = QmpClient(self.qmp_socket_path)
+        try:
+            qmp.connect()
+            qmp.wait_running(timeout=120)
+            self.restore_time = time.perf_counter() - self.launched
+            info(f"[WarmStart] Restored {self.snapshot.snapshot_dir} in {self.restore_time:.2f}s")
+            send_resume(self.warm_socket_path)
+        except (QmpError, OSError) as e:
+            # Most likely QEMU changed under it, the next boot takes a new one
+            error(f"[WarmStart] Restoring {self.snapshot.snapshot_dir} failed, dropping it: {e}")
+            self.snapshot.invalidate()
+        finally:
+            qmp.close()
+
+    def snapshot_and_resume(self):
+        qmp = QmpClient(self.qmp_socket_path)
+        try:
+            qmp.connect()
+            try:
+                self.snapshot.save(qmp, self.disk_path, self.console_lines, self.key_parts)
+            except (QmpError, OSError) as e:
+                warn(f"[WarmStart] Couldn't snapshot VM, carrying on cold: {e}")
+            qmp.execute("cont")
+            send_resume(self.warm_socket_path)
+        except (QmpError, OSError) as e:
+            error(f"[WarmStart] Lost the VM while snapshotting it: {e}")
+        finally:
+            qmp.close()
+
+    def finish(self):
+        """Call once the VM is gone"""
+        if self.thread is not None:
+            self.thread.join(timeout=10)
+        for path in (self.warm_socket_path, self.qmp_socket_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def warm_start_for(disk_image, extra_args: str = None, boot_profile: str = None) -> WarmStart:
+    """WarmStart for the next boot of disk_image (a constructed UbuntuDiskImage), None if this boot
+    can't be warm started (see UbuntuDiskImage.warm_snapshot_key)"""
+    key_parts = disk_image.warm_snapshot_key(extra_args=extra_args, boot_profile=boot_profile)
+    if key_parts is None:
+        return None
+    snapshot_dir = os.path.join(disk_image.temp_workdir, WARM_SNAPSHOT_DIR_NAME, snapshot_key(key_parts))
+    return WarmStart(WarmSnapshot(snapshot_dir), key_parts, disk_image.output_image_path(),
+                     disk_image.temp_workdir, disk_image.image_name)
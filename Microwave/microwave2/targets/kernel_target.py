@@ -19,15 +19,20 @@ from microwave2.results.result import Result, ProcResult
 
 import os
 
-from microwave2.utils.linux_make import LinuxMakeCommand
+from microwave2.utils.linux_make import LinuxMakeCommand, KernelBuildOptions
 from microwave2.utils.linux_kernel import LinuxKernel
+from microwave2.utils.artifact_store import KernelArtifactStore
 
 
 class KernelTargetConfig(TargetConfig):
     """Configuration for kernel target"""
-    def __init__(self, target_name: str, exec_arch: Arch, worker_arch: Arch, git_config: GitConfig, kconfig: Kconfig, target_subdir: str = None, sparse_download: bool = False):
+    def __init__(self, target_name: str, exec_arch: Arch, worker_arch: Arch, git_config: GitConfig, kconfig: Kconfig, target_subdir: str = None, sparse_download: bool = False, build_options: KernelBuildOptions = None):
         super().__init__(target_name=target_name, exec_arch=exec_arch, worker_arch=worker_arch, git_config=git_config, target_subdir=target_subdir, sparse_download=sparse_download)
         self.kconfig = kconfig
+        # ccache/tmpfs settings, by default taken from the environment
+        if build_options is None:
+            build_options = KernelBuildOptions.from_env()
+        self.build_options = build_options
 
 
 
@@ -45,6 +50,12 @@ class KernelTarget(Target):
         self.kconfig = target_config.kconfig
 
         self.linux_kernel = None # empty until after clone
+
+        self.artifact_store = None
+        if target_config.build_options.artifact_store:
+            self.artifact_store = KernelArtifactStore(target_config.build_options.artifact_store_dir)
+        # Fingerprint of the store entry this build was satisfied from, None if it was compiled here
+        self.artifact_hit = None
     def get_kernel_dir(self):
         return self.kernel_dir
     
@@ -77,7 +88,7 @@ class KernelTarget(Target):
         # info(f"[KernelModuleTarget] Target arch: {exec_arch}")
         
 
-        self.linux_kernel = LinuxKernel(source_dir=self.kernel_dir, build_dir=self.build_dir, target_arch=self.target_config.exec_arch, kconfig=self.kconfig)
+        self.linux_kernel = LinuxKernel(source_dir=self.kernel_dir, build_dir=self.build_dir, target_arch=self.target_config.exec_arch, kconfig=self.kconfig, build_options=self.target_config.build_options)
 
         return result
    
@@ -93,6 +104,19 @@ class KernelTarget(Target):
             if (result.is_failure()):
                 return result
 
+        # Resolve the config first, its fingerprint decides whether anything needs compiling
+        self.artifact_hit = None
+        if self.artifact_store is not None and not rebuild:
+            result = self.linux_kernel.configure()
+            if (result.is_failure()):
+                print("[KernelTarget] Failed to configure kernel")
+                return result
+            fingerprint = self.linux_kernel.get_build_fingerprint()
+            if fingerprint is not None and self.artifact_store.lookup(fingerprint) is not None:
+                print(f"[KernelTarget] Using stored kernel {fingerprint} for {self.kconfig.get_label()}, skipping build")
+                self.artifact_hit = fingerprint
+                return Result.success()
+
         # TODO this feels weird, why do we do this?
         if (mod_prep):
             # Prepare kernel for module build
@@ -107,23 +131,49 @@ class KernelTarget(Target):
         if (result.is_failure()):
             print("[KernelTarget] Failed to build kernel")
             return result
+        print(f"[KernelTarget] Kernel build dir: {self.linux_kernel.get_build_dir()}")
 
         debug_pause("[KernelTarget] kernel build finished")
         return result
     
+    def publish_artifacts(self, install_dir: str):
+        """Add a freshly built and installed kernel to the artifact store (failures only warn)"""
+        fingerprint = self.linux_kernel.get_build_fingerprint()
+        if self.artifact_store is None or fingerprint is None:
+            return
+        files = {
+            os.path.basename(self.linux_kernel.get_kernel_image_path()): self.linux_kernel.get_kernel_image_path(),
+            "System.map": self.linux_kernel.get_system_map_path(),
+            "config": self.linux_kernel.get_build_config_path(),
+            "build.log": self.linux_kernel.get_build_log_path(),
+        }
+        result = self.artifact_store.publish(fingerprint, self.kconfig.get_label(), self.linux_kernel.get_kernel_release(), install_dir, files)
+        if (result.is_failure()):
+            warn(f"[KernelTarget] Failed to store kernel artifacts: {result.message}")
+
     @timed
     def install(self, test_image: UbuntuDiskImage, copy_source:bool=False) -> Result:
         """Install into disk image. Could mount and directly set install location to mounted image, but 
         to let DiskImage manage itself instead we install in a tmp directory and then rsync it to the image"""
 
-        # Make temp install directory, deleting previous install if it exists
-        install_dir = os.path.join(self.temp_dir, "install")
+        # Make temp install directory, deleting previous install if it exists (per kconfig, so installs can overlap)
+        install_dir = os.path.join(self.temp_dir, "install", self.linux_kernel.kconfig.get_label())
         makedirs(install_dir, delete=True)
 
-        result = self.linux_kernel.install(install_dir)
-        if (result.is_failure()):
-            print("[KernelTarget] Failed to install kernel")
-            return result
+        if self.artifact_hit is not None:
+            result = self.artifact_store.materialize(self.artifact_hit, install_dir)
+            if (result.is_failure()):
+                print("[KernelTarget] Failed to unpack stored kernel")
+                return result
+        else:
+            if self.target_config.build_options.kernel_only:
+                result = self.linux_kernel.install_kernel_only(install_dir)
+            else:
+                result = self.linux_kernel.install(install_dir)
+            if (result.is_failure()):
+                print("[KernelTarget] Failed to install kernel")
+                return result
+            self.publish_artifacts(install_dir)
 
         # Second phase: install compiled products to image (could do all at once in single rsync?)
         # TODO don't need to delete other contents, but would need to update grub
@@ -137,6 +187,16 @@ class KernelTarget(Target):
         if (result.is_failure()):
             print("[KernelTarget] Failed to install kernel to image")
             return result
+
+        # Lets the fast boot profile skip decompression
+        pvh_image_path = self.linux_kernel.get_pvh_image_path()
+        if pvh_image_path is not None:
+            test_image.set_pvh_kernel(pvh_image_path)
+
+        # Booted with -kernel and nothing to load, the image itself stays untouched
+        if self.target_config.build_options.kernel_only:
+            debug_pause("[KernelTarget] successfully installed kernel only")
+            return Result.success()
         
         usr_dir = self.linux_kernel.get_install_usr_dir(install_dir)
         result = test_image.sync_folder(usr_dir, "/usr")
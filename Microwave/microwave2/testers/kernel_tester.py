@@ -11,8 +11,12 @@ from microwave2.tests.linux_test import LinuxTest
 from microwave2.targets.kernel_module_target import KernelModuleTarget
 from microwave2.targets.kernel_target import KernelTarget
 from microwave2.runners.kernel_log_runner import KernelLogRunner
+from microwave2.runners.agent_runner import AgentRunner
 
 from microwave2.remote import GitConfig, GitAuthInfo
+from microwave2.utils.qemu import QemuLease
+from microwave2.results.result import Result, TestResult
+from microwave2.results.kernel_log import find_loaded_modules
 
 # Tests where the target is a Kernel, and the test runs on an Ubuntu image
 class KernelTester(Tester):
@@ -23,11 +27,59 @@ class KernelTester(Tester):
         # exec_arch = Arch.ARM
         # config.target_config.exec_arch = exec_arch
         image_name = config.test_config.test_name + "-" + config.target_config.target_name + ".img"
-        self.test_image = UbuntuDiskImage(arch=exec_arch, image_name=image_name)
+        self.test_image = UbuntuDiskImage(arch=exec_arch, image_name=image_name, lease=config.lease)
+        # The kernel has to be built for the profile the image boots with
+        config.target_config.build_options.boot_profile = self.test_image.boot_profile
 
         # TODO make custom test for Kernel Modules?
-        self.test = LinuxTest(config.test_config)
+        self.test = LinuxTest(config.test_config, agent=config.agent)
         self.target = KernelTarget(config.target_config)
 
-        self.runner = KernelLogRunner(self.test_image, timeout=1200, extra_args=config.extra_args)
+        aux_logfile_path = config.lease.aux_logfile_path if config.lease is not None else None
+        # Bundled launch scripts all run in one boot, so give each its own share of the timeout
+        launch_script = config.test_config.launch_script
+        num_scripts = len(launch_script) if isinstance(launch_script, list) else 1
+        self.runner = KernelLogRunner(self.test_image, timeout=1200 * num_scripts, extra_args=config.extra_args, aux_logfile_path=aux_logfile_path)
 
+    def assign_lease(self, lease: QemuLease):
+        """Move the image and runner onto a lease (before install), for when the lease is only taken once the VM is needed"""
+        self.config.lease = lease
+        self.test_image.set_lease(lease)
+        self.runner.aux_logfile_path = lease.aux_logfile_path
+
+    def start_agent(self) -> AgentRunner:
+        """Boot the installed image with the guest agent (needs config.agent), None if it didn't come up.
+        The caller runs launch scripts with AgentRunner.run() and stops it when done"""
+        if not self.config.agent:
+            error("[KernelTester] Image wasn't installed with the agent")
+            return None
+        agent_runner = AgentRunner(self.test_image, aux_logfile_path=self.runner.aux_logfile_path,
+                                   extra_args=self.config.extra_args, boot_profile=self.runner.boot_profile)
+        result = agent_runner.start()
+        if result.is_failure():
+            return None
+        return agent_runner
+
+    def get_boot_kernel(self) -> tuple:
+        """(kernel path, command line) this tester's installed kernel boots with, for switching an
+        agent VM booted by another tester to it (AgentRunner.switch_kernel)"""
+        return self.test_image.installed_kernel_path, self.test_image.get_boot_cmdline(extra_args=self.config.extra_args, boot_profile=self.runner.boot_profile)
+
+    def check_loaded_modules(self, test_result: TestResult) -> TestResult:
+        """In kernel only mode, fail runs where the guest loaded a module (the image has none for this kernel)"""
+        if not self.config.target_config.build_options.kernel_only or test_result.is_failure():
+            return test_result
+
+        modules = find_loaded_modules(test_result.get_lines())
+        if modules is None:
+            error("[KernelTester] Guest never reported its loaded modules")
+            return Result.failure("Kernel only boot didn't report loaded modules")
+        if modules:
+            error(f"[KernelTester] Kernel only boot loaded modules: {', '.join(modules)}")
+            return Result.failure(f"Kernel only boot loaded modules: {', '.join(modules)}")
+        info("[KernelTester] Kernel only boot loaded no modules")
+        return test_result
+
+    def run(self) -> TestResult:
+        """Run, and in kernel only mode check the guest never needed a module"""
+        return self.check_loaded_modules(super().run())
@@ -0,0 +1,249 @@
+"""
+Stage-pipelined executor -- runs the download/build/install/run stages of many Testers as a DAG,
+so one Tester's kernel compiles while another's VM is booted
+"""
+from typing import Callable, Dict, List
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+
+from microwave2.results.result import Result, TestResult
+from microwave2.testers.tester import Tester
+from microwave2.local_storage import local_paths
+from microwave2.utils.qemu import QemuResourceAllocator, QemuLease
+from microwave2.utils.log import log, warn, error, debug, info
+
+
+DOWNLOAD_STAGE = "download"
+BUILD_STAGE = "build"
+INSTALL_STAGE = "install"
+RUN_STAGE = "run"
+
+# Builds already use every core (make -j nproc), so only one at a time. Boots are limited by the
+# QemuResourceAllocator instead.
+DEFAULT_STAGE_LIMITS = {
+    BUILD_STAGE: 1,
+    INSTALL_STAGE: 1,
+    RUN_STAGE: 2,
+}
+# Stages counted against another stage's limit. A download updates the kernel source tree every
+# config builds from, so it can't run while another config's make is reading that tree
+SHARED_STAGE_LIMITS = {
+    DOWNLOAD_STAGE: BUILD_STAGE,
+}
+
+
+@dataclass
+class PipelineNode:
+    """Single unit of work in the pipeline, runs once all deps have succeeded"""
+    name: str
+    stage: str
+    func: Callable[[], Result]
+    deps: List['PipelineNode'] = field(default_factory=list)
+    priority: float = 0 # Among ready nodes of the same stage, highest priority runs first
+    result: Result = None
+    start_time: float = None
+    end_time: float = None
+
+    def is_done(self):
+        return self.result is not None
+
+    def elapsed(self) -> float:
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+
+class BuildTimeHistory:
+    """Remembers how long past builds took (by build label), used to order builds longest first"""
+    def __init__(self, path: str = None):
+        if path is None:
+            path = os.path.join(local_paths.get_build_dir(), "build_times.json")
+        self.path = path
+        self.lock = threading.Lock()
+        self.times = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    self.times = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                warn(f"[BuildTimeHistory] Ignoring unreadable history at {self.path}: {e}")
+
+    def estimate(self, label: str) -> float:
+        """Last recorded build time, unknown builds are assumed to be the longest"""
+        return self.times.get(label, float("inf"))
+
+    def record(self, label: str, seconds: float):
+        with self.lock:
+            self.times[label] = seconds
+            with open(self.path, "w") as f:
+                json.dump(self.times, f, indent=4)
+
+
+class PipelineExecutor:
+    """Runs PipelineNodes as a DAG with a concurrency limit per stage. Whenever a stage has
+    a free slot, the highest priority ready node of that stage is started. If a node fails,
+    everything that depends on it is skipped (and marked failed)."""
+    def __init__(self, stage_limits: Dict[str, int] = None):
+        self.stage_limits = dict(DEFAULT_STAGE_LIMITS)
+        if stage_limits is not None:
+            self.stage_limits.update(stage_limits)
+        self.nodes: List[PipelineNode] = []
+
+    def add_node(self, name: str, stage: str, func: Callable[[], Result], deps: List[PipelineNode] = [], priority: float = 0) -> PipelineNode:
+        node = PipelineNode(name=name, stage=stage, func=func, deps=list(deps), priority=priority)
+        self.nodes.append(node)
+        return node
+
+    def limit_key(self, stage: str) -> str:
+        """Stage whose limit stage counts against"""
+        if stage in self.stage_limits:
+            return stage
+        return SHARED_STAGE_LIMITS.get(stage, stage)
+
+    def stage_limit(self, stage: str) -> int:
+        return self.stage_limits.get(self.limit_key(stage), 1)
+
+    def run_node(self, node: PipelineNode) -> Result:
+        info(f"[Pipeline] Starting {node.stage} for {node.name}")
+        node.start_time = time.perf_counter()
+        try:
+            result = node.func()
+        except Exception as e:
+            error(f"[Pipeline] {node.stage} for {node.name} raised: {e}")
+            result = Result.failure(f"{node.stage} raised an exception", e)
+        node.end_time = time.perf_counter()
+
+        if result is None:
+            result = Result.failure(f"{node.stage} returned no result")
+        info(f"[Pipeline] Finished {node.stage} for {node.name} in {node.elapsed():.1f}s: {result}")
+        return result
+
+    def skip_failed_dependents(self, pending: List[PipelineNode]) -> List[PipelineNode]:
+        """Mark pending nodes whose dependencies failed as failed, return the rest"""
+        still_pending = []
+        for node in pending:
+            failed = [dep for dep in node.deps if dep.is_done() and dep.result.is_failure()]
+            if failed:
+                node.result = Result.failure(f"Skipped, {failed[0].stage} for {failed[0].name} failed")
+                warn(f"[Pipeline] Skipping {node.stage} for {node.name}")
+            else:
+                still_pending.append(node)
+        return still_pending
+
+    def run(self) -> Dict[str, Result]:
+        """Run every node, returns the result of each node keyed by '<name>:<stage>'"""
+        pending = list(self.nodes)
+        running = {}
+        stage_running = {}
+        stages = {self.limit_key(node.stage) for node in self.nodes}
+        max_workers = max(1, sum(self.stage_limit(stage) for stage in stages))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                # Repeat until no more skips, since skipping can cascade down the DAG
+                while True:
+                    before = len(pending)
+                    pending = self.skip_failed_dependents(pending)
+                    if len(pending) == before:
+                        break
+
+                # Start ready nodes, highest priority first, while their stage has room
+                ready = [node for node in pending if all(dep.is_done() for dep in node.deps)]
+                ready.sort(key=lambda node: node.priority, reverse=True)
+                for node in ready:
+                    key = self.limit_key(node.stage)
+                    if stage_running.get(key, 0) >= self.stage_limit(key):
+                        continue
+                    stage_running[key] = stage_running.get(key, 0) + 1
+                    pending.remove(node)
+                    running[executor.submit(self.run_node, node)] = node
+
+                if not running:
+                    if pending:
+                        error("[Pipeline] Nodes left that can never run (dependency cycle?)")
+                        for node in pending:
+                            node.result = Result.failure("Unreachable node")
+                    break
+
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    node.result = future.result()
+                    stage_running[self.limit_key(node.stage)] -= 1
+
+        return {f"{node.name}:{node.stage}": node.result for node in self.nodes}
+
+    def add_tester(self,
+                   name: str,
+                   tester: Tester,
+                   allocator: QemuResourceAllocator = None,
+                   build_label: str = None,
+                   build_history: BuildTimeHistory = None,
+                   on_result: Callable[[TestResult], Result] = None,
+                   on_stage: Callable[[str], None] = None) -> PipelineNode:
+        """Add the download -> build -> install -> run chain for a Tester, returns the run node.
+        Each stage goes through the tester's retry policy (see retry.py)
+        - allocator: if given, a lease is taken at install time and released after the run
+        - build_label/build_history: used to order builds longest first, and updated after each build
+        - on_result: called with the run's TestResult (e.g. to save logs), its Result is the run node's
+        - on_stage: called with the stage name as each stage starts (e.g. to record progress)
+        """
+        priority = 0
+        if build_history is not None and build_label is not None:
+            priority = build_history.estimate(build_label)
+
+        # Lease (if any) is shared between install and run, so kept in a dict the closures can update
+        held = {}
+
+        def release_lease():
+            tester.cleanup()
+            lease = held.pop("lease", None)
+            if lease is not None:
+                allocator.release(lease)
+
+        def stage_started(stage: str):
+            if on_stage is not None:
+                on_stage(stage)
+
+        def do_download() -> Result:
+            stage_started(DOWNLOAD_STAGE)
+            return tester.run_stage(DOWNLOAD_STAGE, tester.download)
+
+        def do_build() -> Result:
+            stage_started(BUILD_STAGE)
+            start = time.perf_counter()
+            result = tester.run_stage(BUILD_STAGE, tester.build_code)
+            if result.is_success() and build_history is not None and build_label is not None:
+                build_history.record(build_label, time.perf_counter() - start)
+            return result
+
+        def do_install() -> Result:
+            stage_started(INSTALL_STAGE)
+            if allocator is not None:
+                lease = allocator.acquire(tester.test_image.get_image_name())
+                held["lease"] = lease
+                tester.assign_lease(lease)
+            result = tester.run_stage(INSTALL_STAGE, tester.install)
+            if result.is_failure():
+                release_lease()
+            return result
+
+        def do_run() -> Result:
+            stage_started(RUN_STAGE)
+            try:
+                result = tester.run_stage(RUN_STAGE, tester.run)
+                if on_result is not None and not result.is_failure():
+                    result = on_result(result)
+                return result
+            finally:
+                release_lease()
+
+        download_node = self.add_node(name, DOWNLOAD_STAGE, do_download, priority=priority)
+        build_node = self.add_node(name, BUILD_STAGE, do_build, deps=[download_node], priority=priority)
+        install_node = self.add_node(name, INSTALL_STAGE, do_install, deps=[build_node], priority=priority)
+        return self.add_node(name, RUN_STAGE, do_run, deps=[install_node], priority=priority)
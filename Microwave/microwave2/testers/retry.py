@@ -0,0 +1,262 @@
+"""
+Retries for Tester stages. A failed download/build/install/run is classified by its cause: transient
+causes (timeouts, host resources like an nbd device or disk space) are retried with exponential
+backoff, permanent ones (build errors, kernel panics, runs that left nothing to extract results from)
+put the tester in quarantine, so later iterations of the same campaign skip it instead of rebuilding
+a kernel that can't work. Run failures (panics, missing results) only quarantine the launch script(s)
+that were running, the same kernel with other scripts is still tried.
+Every attempt is recorded on the Tester (Tester.attempts), and for runs in the saved kernel log's
+metadata, so the time lost to retries shows up in the results.
+"""
+import errno
+import os
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from microwave2.results.result import Result
+from microwave2.runners.log_monitor import STOP_CRASH, STOP_INACTIVE, STOP_TIMEOUT
+from microwave2.utils.proc import ProcRunResult, OUTCOME_TIMEOUT, OUTCOME_EXITED
+from microwave2.utils.log import log, warn, error, debug, info
+
+# Failure causes
+CAUSE_TIMEOUT = "timeout"
+CAUSE_PANIC = "panic"
+CAUSE_HOST_RESOURCE = "host_resource"
+CAUSE_BUILD_ERROR = "build_error"
+# A run that finished but printed nothing results can be extracted from (see KernelLog.missing_results)
+CAUSE_EXTRACTION_ERROR = "extraction_error"
+CAUSE_UNKNOWN = "unknown"
+
+BUILD_STAGE = "build"
+
+# An unexplained failure is what a flaky one looks like, so it gets the retries too
+TRANSIENT_CAUSES = (CAUSE_TIMEOUT, CAUSE_HOST_RESOURCE, CAUSE_UNKNOWN)
+PERMANENT_CAUSES = (CAUSE_PANIC, CAUSE_BUILD_ERROR, CAUSE_EXTRACTION_ERROR)
+# Causes that say something about what ran, not the kernel, quarantined only for the scope they happened in
+SCOPED_CAUSES = (CAUSE_PANIC, CAUSE_EXTRACTION_ERROR)
+
+HOST_RESOURCE_ERRNOS = (errno.ENOSPC, errno.ENOMEM, errno.EBUSY, errno.EAGAIN, errno.EMFILE, errno.ENFILE,
+                        errno.EADDRINUSE, errno.ECONNREFUSED, errno.ECONNRESET, errno.ENETUNREACH)
+# Only things the host says, build output is full of paths like drivers/block/nbd.o
+HOST_RESOURCE_PATTERN = re.compile("|".join([
+    r"No space left on device",
+    r"Cannot allocate memory",
+    r"Device or resource busy",
+    r"Resource temporarily unavailable",
+    r"Too many open files",
+    r"Address already in use",
+    r"Failed to get .*lock",
+    r"qemu-nbd",
+    r"Failed to connect.*\bnbd",
+    r"Connection (refused|reset|timed out)",
+    r"Could not resolve host",
+    r"Temporary failure in name resolution",
+]), re.IGNORECASE)
+TIMEOUT_PATTERN = re.compile(r"\btimed out\b", re.IGNORECASE)
+
+
+def result_text(result: Result) -> str:
+    parts = [result.message or "", str(result.error) if result.error is not None else ""]
+    if isinstance(result, ProcRunResult):
+        # The end of the output is where a build says what went wrong
+        parts.append(result.stderr[-4096:] if result.stderr else "")
+    return "\n".join(parts)
+
+
+def classify_exception(stage: str, e: Exception) -> str:
+    if isinstance(e, TimeoutError):
+        return CAUSE_TIMEOUT
+    if isinstance(e, MemoryError):
+        return CAUSE_HOST_RESOURCE
+    if isinstance(e, OSError) and e.errno in HOST_RESOURCE_ERRNOS:
+        return CAUSE_HOST_RESOURCE
+    return classify_text(stage, str(e))
+
+
+def classify_text(stage: str, text: str) -> str:
+    if HOST_RESOURCE_PATTERN.search(text):
+        return CAUSE_HOST_RESOURCE
+    if TIMEOUT_PATTERN.search(text):
+        return CAUSE_TIMEOUT
+    if stage == BUILD_STAGE:
+        return CAUSE_BUILD_ERROR
+    return CAUSE_UNKNOWN
+
+
+def classify_result(stage: str, result: Result) -> Optional[str]:
+    """Cause of a stage's failure, None if it worked. A run whose VM was stopped early (see
+    log_monitor), or whose log has nothing to extract results from, counts as failed even though
+    the runner hands back its log"""
+    if result is None:
+        return CAUSE_UNKNOWN
+    kernel_log = result.get_kernel_log() if hasattr(result, "get_kernel_log") else None
+    stop_reason = getattr(kernel_log, "stop_reason", None)
+    if stop_reason is not None:
+        if stop_reason["kind"] == STOP_CRASH:
+            return CAUSE_PANIC
+        if stop_reason["kind"] in (STOP_TIMEOUT, STOP_INACTIVE):
+            return CAUSE_TIMEOUT
+    if not result.is_failure():
+        if kernel_log is not None and kernel_log.missing_results() is not None:
+            return CAUSE_EXTRACTION_ERROR
+        return None
+
+    if isinstance(result, ProcRunResult):
+        if result.outcome == OUTCOME_TIMEOUT:
+            return CAUSE_TIMEOUT
+        # make exiting non-zero is the build being broken, whatever the output happens to mention
+        if stage == BUILD_STAGE and result.outcome == OUTCOME_EXITED:
+            return CAUSE_BUILD_ERROR
+    if isinstance(result.error, Exception):
+        return classify_exception(stage, result.error)
+    return classify_text(stage, result_text(result))
+
+
+def failure_message(stage: str, cause: str, result: Result) -> str:
+    """What went wrong, for results that don't say (runs handing back their log)"""
+    if result is None:
+        return f"{stage} returned no result"
+    kernel_log = result.get_kernel_log() if hasattr(result, "get_kernel_log") else None
+    if kernel_log is not None and result.message is None:
+        if cause == CAUSE_EXTRACTION_ERROR:
+            return kernel_log.missing_results()
+        if kernel_log.stop_reason is not None:
+            return f"VM stopped ({kernel_log.stop_reason['kind']}): {kernel_log.stop_reason['detail']}"
+    return result.message
+
+
+@dataclass
+class Attempt:
+    """One try at a stage, cause is None if it worked"""
+    stage: str
+    attempt: int
+    cause: str = None
+    message: str = None
+    duration: float = 0
+    # Seconds waited before the next attempt
+    backoff: float = 0
+    # What a quarantine for this attempt covers (see Quarantine), None for the whole tester
+    scope: str = None
+
+    def to_json(self) -> Dict:
+        return {"stage": self.stage, "attempt": self.attempt, "cause": self.cause, "message": self.message,
+                "duration": self.duration, "backoff": self.backoff, "scope": self.scope}
+
+
+class Quarantine:
+    """Testers that failed for a permanent cause, shared by every policy that uses it. Entries are by
+    (run name, scope), scope None covers the whole run name (e.g. its kernel doesn't build), a scope
+    (e.g. the launch scripts) just that"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries: Dict[Tuple[str, Optional[str]], Attempt] = {}
+
+    def add(self, name: str, attempt: Attempt, scope: str = None):
+        with self.lock:
+            self.entries[(name, scope)] = attempt
+
+    def get(self, name: str, scope: str = None) -> Optional[Attempt]:
+        """Entry for the whole of name, else the one for scope"""
+        with self.lock:
+            entry = self.entries.get((name, None))
+            if entry is None and scope is not None:
+                entry = self.entries.get((name, scope))
+            return entry
+
+    def release(self, name: str, scope: str = None):
+        with self.lock:
+            self.entries.pop((name, scope), None)
+
+
+@dataclass
+class RetryPolicy:
+    # Tries per stage, 1 disables retrying
+    max_attempts: int = 3
+    base_delay: float = 10
+    max_delay: float = 300
+    transient_causes: tuple = TRANSIENT_CAUSES
+    quarantine: Quarantine = field(default_factory=Quarantine)
+
+    @classmethod
+    def from_env(cls, quarantine: Quarantine = None) -> "RetryPolicy":
+        """MICROWAVE_RETRY_ATTEMPTS and MICROWAVE_RETRY_DELAY (base delay in seconds) override the defaults"""
+        policy = cls(max_attempts=int(os.environ.get("MICROWAVE_RETRY_ATTEMPTS", 3)),
+                     base_delay=float(os.environ.get("MICROWAVE_RETRY_DELAY", 10)))
+        if quarantine is not None:
+            policy.quarantine = quarantine
+        return policy
+
+    def backoff(self, attempt: int) -> float:
+        """Delay after the given (1 based) failed attempt, jittered so VMs that failed together don't
+        all come back at the same moment"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def run_stage(self, name: str, stage: str, func: Callable[[], Result], attempts: List[Attempt],
+                  reset: Callable[[], None] = None, scope: str = None) -> Result:
+        """Run func (one stage of the tester called name) until it works, fails permanently or runs out
+        of attempts, returns its last result. Exceptions become failed Results. reset is called
+        before each retry to undo what a failed attempt left behind. scope (e.g. the launch scripts)
+        is what a SCOPED_CAUSES failure quarantines, instead of everything under name"""
+        quarantined = self.quarantine.get(name, scope)
+        if quarantined is not None:
+            what = name if quarantined.scope is None else f"{name} ({quarantined.scope})"
+            warn(f"[RetryPolicy] {what} is quarantined ({quarantined.stage}: {quarantined.cause}), skipping {stage}")
+            return Result.failure(f"Quarantined {what} after {quarantined.stage} failed ({quarantined.cause}): {quarantined.message}")
+
+        attempt_number = 0
+        while True:
+            attempt_number += 1
+            start = time.perf_counter()
+            try:
+                result = func()
+                cause = classify_result(stage, result)
+            except Exception as e:
+                error(f"[RetryPolicy] {stage} for {name} raised: {e}")
+                result = Result.failure(f"{stage} raised: {e}", e)
+                cause = classify_exception(stage, e)
+            attempt = Attempt(stage, attempt_number, cause, duration=time.perf_counter() - start)
+            attempts.append(attempt)
+            if cause is None:
+                if attempt_number > 1:
+                    info(f"[RetryPolicy] {stage} for {name} worked on attempt {attempt_number}")
+                return result
+
+            attempt.message = failure_message(stage, cause, result)
+            if cause not in self.transient_causes:
+                if cause in SCOPED_CAUSES:
+                    attempt.scope = scope
+                what = name if attempt.scope is None else f"{name} ({attempt.scope})"
+                error(f"[RetryPolicy] {stage} for {name} failed ({cause}), quarantining {what}: {attempt.message}")
+                self.quarantine.add(name, attempt, attempt.scope)
+                return result
+            if attempt_number >= self.max_attempts:
+                error(f"[RetryPolicy] {stage} for {name} failed ({cause}) {attempt_number} times, giving up")
+                return result
+
+            attempt.backoff = self.backoff(attempt_number)
+            warn(f"[RetryPolicy] {stage} for {name} failed ({cause}), retrying in {attempt.backoff:.0f}s: {attempt.message}")
+            time.sleep(attempt.backoff)
+            if reset is not None:
+                try:
+                    reset()
+                except Exception as e:
+                    error(f"[RetryPolicy] Couldn't reset {name} after a failed {stage}, giving up: {e}")
+                    return result
+
+
+_default_policy = None
+_default_policy_lock = threading.Lock()
+
+
+def get_default_policy() -> RetryPolicy:
+    """Policy (and quarantine) shared by every Tester that isn't given its own"""
+    global _default_policy
+    with _default_policy_lock:
+        if _default_policy is None:
+            _default_policy = RetryPolicy.from_env()
+        return _default_policy
@@ -17,6 +17,8 @@ from microwave2.runners.runner import Runner, RunnerConfig
 from microwave2.runners.kernel_log_runner import KernelLogRunner
 
 from microwave2.images.disk_image import DiskImage
+from microwave2.utils.qemu import QemuLease
+from microwave2.testers.retry import RetryPolicy, get_default_policy
 
 
 from microwave2.utils.log import log, warn, error, debug, info
@@ -31,10 +33,13 @@ class TesterConfig:
     test_config: TestConfig
     target_config: TargetConfig
     extra_args: str = None # TODO move to the right spot
+    lease: QemuLease = None # Host resources for the VM, if running several at once
+    agent: bool = False # Boot once with the guest agent and run launch scripts over it (see start_agent)
+    retry_policy: RetryPolicy = None # How failed stages are retried (see retry.py), None for the shared default
     
     def get_run_name(self):
     # Concatenate test and target name
-        return self.test_config.target_name + "-" + self.target_config.test_name
+        return self.test_config.test_name + "-" + self.target_config.target_name
     
     @classmethod
     def from_json(cls, json_config: Dict):
@@ -60,6 +65,35 @@ class Tester:
         self.target = None
         self.test_image = None
         self.runner = None
+        self.retry_policy = config.retry_policy if config.retry_policy is not None else get_default_policy()
+        # Every attempt at every stage run through run_stage (retry.Attempt)
+        self.attempts = []
+
+    def run_stage(self, stage: str, func, *args, **kwargs) -> Result:
+        """Run one stage (e.g. run_stage("build", self.build)) under the retry policy. Attempts are
+        kept in self.attempts, and a run's result gets them in its kernel log's metadata"""
+        result = self.retry_policy.run_stage(self.config.get_run_name(), stage, lambda: func(*args, **kwargs),
+                                             self.attempts, reset=lambda: self.reset_stage(stage),
+                                             scope=self.quarantine_scope())
+        kernel_log = result.get_kernel_log() if hasattr(result, "get_kernel_log") else None
+        if kernel_log is not None:
+            kernel_log.attempts = [attempt.to_json() for attempt in self.attempts]
+        return result
+
+    def quarantine_scope(self) -> str:
+        """What a panic in a run quarantines: the launch script(s) it ran, a bundle as a whole"""
+        launch_script = self.config.test_config.launch_script
+        if isinstance(launch_script, list):
+            return " ".join(launch_script)
+        return launch_script
+
+    def reset_stage(self, stage: str):
+        """Undo what a failed attempt at stage left behind, before it is retried"""
+        if self.test_image is not None and self.test_image.is_editable():
+            self.test_image.finish_edit()
+        # Runners only run once
+        if stage == "run" and getattr(self.runner, "kernel_log", None) is not None:
+            self.runner.kernel_log = None
 
     def download_test(self) -> Result:
         """Download the test code"""
@@ -157,16 +191,26 @@ class Tester:
     @timed
     def build(self, rebuild=False, interactive=False) -> Result:
         """Build test and target code, and install in a constructed test image"""
+        result = self.build_code()
+        if (result.is_failure()):
+            return result
+
+        return self.install(rebuild=rebuild, interactive=interactive)
+
+    @timed
+    def build_code(self) -> Result:
+        """Build test and target code (first half of build(), does not touch the image)"""
         debug_pause("[Tester] DISK BUILDING PHASE: START, now building test and target code")
 
         result = self.build_test_code()
         if (result.is_failure()):
             return result
         
-        result = self.build_target_code()
-        if (result.is_failure()):
-            return result
+        return self.build_target_code()
 
+    @timed
+    def install(self, rebuild=False, interactive=False) -> Result:
+        """Construct the test image and install built test and target code (second half of build())"""
         # return Result.failure("build() not implemented for this tester")
         # Construct the base test image 
         debug_pause("[Tester] DISK BUILDING PHASE: IMAGE, now creating image and installing test and target artifacts")
@@ -249,6 +293,15 @@ class Tester:
     #     self.test_image.unmount_image()
     #     return target_build_result
     
+    def assign_lease(self, lease: QemuLease):
+        """Move the tester onto a QemuLease before install, should be overridden by testers that boot VMs"""
+        raise NotImplementedError("assign_lease not implemented for this tester")
+
+    def cleanup(self):
+        """Release the test image's host resources"""
+        if (self.test_image is not None):
+            self.test_image.cleanup()
+
     # TODO move to kernel / module testers?
     def run_interactive(self) -> Result:
         result = self.test_image.boot_interactive(extra_args=self.config.extra_args)
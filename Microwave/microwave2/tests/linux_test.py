@@ -9,17 +9,24 @@ from microwave2.utils.rsync import RsyncCommand
 import os
 
 class LinuxTest(Test):
-    def __init__(self, test_config: DynamicTestConfig):
+    def __init__(self, test_config: DynamicTestConfig, agent: bool = False):
         super().__init__(test_config)
+        # Start the guest agent at boot instead of the launch script(s), the host runs them (see AgentRunner)
+        self.agent = agent
 
     # Doesn't override download or build 
     def install_launch_script(self, dest_dir:str, disk_image: UbuntuDiskImage, interactive:bool, target_name: str) -> Result:
 
+        # Several launch scripts are run one after another in the same boot
         launch_script_rel_path = self.test_config.launch_script
-        launch_script_path = os.path.join(dest_dir, launch_script_rel_path)
+        if isinstance(launch_script_rel_path, list):
+            launch_script_path = [os.path.join(dest_dir, rel_path) for rel_path in launch_script_rel_path]
+        else:
+            launch_script_path = os.path.join(dest_dir, launch_script_rel_path)
 
         try:
-            disk_image.set_launch_script(launch_script_path, target_name, autoshutdown=not interactive, autorun=not interactive)
+            disk_image.set_launch_script(launch_script_path, target_name, autoshutdown=not interactive, autorun=not interactive,
+                                         agent=self.agent and not interactive)
         except Exception as e:
             print(f"Failed to set launch script: {e}")
             return Result.failure("Failed to set launch script")
@@ -71,7 +71,7 @@ class DynamicTestConfig(TestConfig):
     """Config information about a test"""
     def __init__(self, test_name: str, module_name: str, launch_script: str, exec_arch: str, worker_arch: str, git_config: GitConfig, test_subdir: str = None, sparse_download: bool = False, build_entrypoint: str = None, target_mod_entrypoint: str = None):
         super().__init__(test_name, module_name, exec_arch, worker_arch, git_config, test_subdir, sparse_download, build_entrypoint, target_mod_entrypoint)
-        # Launch script is name of script to run test within image
+        # Launch script is name of script to run test within image, or a list of them to run in one boot
         self.launch_script = launch_script
 
 @dataclass
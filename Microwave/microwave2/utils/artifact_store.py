@@ -0,0 +1,197 @@
+"""
+Content-addressed store of built kernels, keyed by the build fingerprint (resolved .config + source
+revision + toolchain, see LinuxKernel.compute_build_fingerprint). Each entry holds the kernel image,
+System.map, final .config, build log and tarballs of the installed boot/modules/headers trees, plus
+a manifest with the sha256 of every file so hits can be verified before use.
+Nothing in an entry depends on the host, so the store can sit on a shared filesystem.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import socket
+import tarfile
+import time
+from contextlib import contextmanager
+
+from microwave2.local_storage import local_paths
+from microwave2.results.result import Result
+from microwave2.utils.log import log, warn, error, debug, info
+
+MANIFEST_NAME = "manifest.json"
+INDEX_NAME = "index.json"
+
+# Installed trees are stored as tarballs, named after the install dir they are unpacked into
+INSTALL_TARBALLS = {
+    "boot": "boot.tar",
+    "lib": "modules.tar",
+    "usr": "headers.tar",
+}
+
+
+def file_sha256(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class KernelArtifactStore:
+    """Directory of objects/<fingerprint>/ entries plus index.json (fingerprint -> summary)"""
+    def __init__(self, store_dir: str = None):
+        if store_dir is None:
+            store_dir = os.path.join(local_paths.get_build_dir(), "artifacts")
+        self.store_dir = store_dir
+        self.objects_dir = os.path.join(store_dir, "objects")
+        self.index_path = os.path.join(store_dir, INDEX_NAME)
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+    def entry_dir(self, fingerprint: str) -> str:
+        return os.path.join(self.objects_dir, fingerprint)
+
+    @contextmanager
+    def locked_index(self):
+        """Exclusive lock on the index, held while it is read-modify-written"""
+        with open(os.path.join(self.store_dir, "index.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_index(self) -> dict:
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path, "r") as f:
+            return json.load(f)
+
+    def write_index(self, index: dict):
+        # Write then rename, so readers on other hosts never see a partial file
+        tmp_path = f"{self.index_path}.{socket.gethostname()}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=4)
+        os.replace(tmp_path, self.index_path)
+
+    def get_manifest(self, fingerprint: str) -> dict:
+        manifest_path = os.path.join(self.entry_dir(fingerprint), MANIFEST_NAME)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+
+    def verify(self, fingerprint: str) -> Result:
+        """Check every file of an entry against the hashes in its manifest"""
+        manifest = self.get_manifest(fingerprint)
+        if manifest is None:
+            return Result.failure(f"No artifact entry for {fingerprint}")
+        entry_dir = self.entry_dir(fingerprint)
+        for name, expected in manifest["files"].items():
+            path = os.path.join(entry_dir, name)
+            if not os.path.exists(path):
+                return Result.failure(f"Artifact {name} of {fingerprint} is missing")
+            if file_sha256(path) != expected["sha256"]:
+                return Result.failure(f"Artifact {name} of {fingerprint} doesn't match its hash")
+        return Result.success()
+
+    def lookup(self, fingerprint: str, verify: bool = True) -> dict:
+        """Manifest of the entry for fingerprint if there is a usable one, otherwise None"""
+        manifest = self.get_manifest(fingerprint)
+        if manifest is None:
+            info(f"[KernelArtifactStore] Miss for {fingerprint}")
+            return None
+        if verify:
+            result = self.verify(fingerprint)
+            if result.is_failure():
+                warn(f"[KernelArtifactStore] Ignoring corrupt entry: {result.message}")
+                return None
+        info(f"[KernelArtifactStore] Hit for {fingerprint} ({'verified' if verify else 'unverified'}), built {manifest['created']} on {manifest['host']}")
+        return manifest
+
+    def publish(self, fingerprint: str, label: str, kernel_release: str, install_dir: str, files: dict) -> Result:
+        """Add an entry. install_dir is a finished LinuxKernel.install() tree, files maps artifact
+        names (e.g. bzImage, System.map, config, build.log) to paths. Existing entries are kept"""
+        entry_dir = self.entry_dir(fingerprint)
+        if os.path.exists(entry_dir):
+            self.add_to_index(fingerprint, label, self.get_manifest(fingerprint))
+            return Result.success()
+
+        # Assemble in a private dir and rename into place, so a half written entry is never visible
+        staging_dir = f"{entry_dir}.{socket.gethostname()}.{os.getpid()}.tmp"
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        os.makedirs(staging_dir)
+        try:
+            for name, path in files.items():
+                if path is None or not os.path.exists(path):
+                    warn(f"[KernelArtifactStore] Artifact {name} not found at {path}, not storing it")
+                    continue
+                shutil.copy2(path, os.path.join(staging_dir, name))
+
+            for subdir, tarball in INSTALL_TARBALLS.items():
+                source = os.path.join(install_dir, subdir)
+                if not os.path.exists(source):
+                    continue
+                with tarfile.open(os.path.join(staging_dir, tarball), "w") as tar:
+                    tar.add(source, arcname=subdir)
+
+            manifest = {
+                "fingerprint": fingerprint,
+                "kernel_release": kernel_release,
+                "label": label,
+                "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "host": socket.gethostname(),
+                "files": {name: {"sha256": file_sha256(os.path.join(staging_dir, name)),
+                                 "size": os.path.getsize(os.path.join(staging_dir, name))}
+                          for name in sorted(os.listdir(staging_dir))},
+            }
+            with open(os.path.join(staging_dir, MANIFEST_NAME), "w") as f:
+                json.dump(manifest, f, indent=4)
+
+            try:
+                os.rename(staging_dir, entry_dir)
+            except OSError:
+                # Someone else published the same fingerprint first, theirs is just as good
+                shutil.rmtree(staging_dir, ignore_errors=True)
+                manifest = self.get_manifest(fingerprint)
+        except Exception as e:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            error(f"[KernelArtifactStore] Failed to publish {fingerprint}: {e}")
+            return Result.failure("Failed to publish kernel artifacts", e)
+
+        self.add_to_index(fingerprint, label, manifest)
+        info(f"[KernelArtifactStore] Stored {label} as {fingerprint}")
+        return Result.success()
+
+    def add_to_index(self, fingerprint: str, label: str, manifest: dict):
+        with self.locked_index():
+            index = self.read_index()
+            entry = index.setdefault(fingerprint, {
+                "kernel_release": manifest["kernel_release"] if manifest else None,
+                "created": manifest["created"] if manifest else None,
+                "labels": [],
+            })
+            if label not in entry["labels"]:
+                entry["labels"].append(label)
+            self.write_index(index)
+
+    def materialize(self, fingerprint: str, install_dir: str) -> Result:
+        """Unpack an entry's boot/modules/headers trees into install_dir, in the same layout
+        LinuxKernel.install() produces"""
+        entry_dir = self.entry_dir(fingerprint)
+        os.makedirs(install_dir, exist_ok=True)
+        for subdir, tarball in INSTALL_TARBALLS.items():
+            tarball_path = os.path.join(entry_dir, tarball)
+            if not os.path.exists(tarball_path):
+                continue
+            try:
+                with tarfile.open(tarball_path, "r") as tar:
+                    # Our own tarballs, and modules have absolute build/source symlinks the data filter rejects
+                    if hasattr(tarfile, "fully_trusted_filter"):
+                        tar.extractall(install_dir, filter="fully_trusted")
+                    else:
+                        tar.extractall(install_dir)
+            except (OSError, tarfile.TarError) as e:
+                error(f"[KernelArtifactStore] Failed to unpack {tarball} of {fingerprint}: {e}")
+                return Result.failure(f"Failed to unpack {tarball}", e)
+        return Result.success()
@@ -24,11 +24,6 @@ class LdCommand:
         self.link_script = link_script
 
     def run(self, workdir=None) -> ProcResult:
-        # First, enter the workdir
-        old_cwd = os.getcwd()
-        if workdir is not None:
-            os.chdir(workdir)
-
         # Build the command
         command = ["ld"]
         if self.arch == Arch.i386:
@@ -42,11 +37,7 @@ class LdCommand:
         command += self.input_files
 
         # Run the command
-        result = run_command_better(command, verbose=self.verbose)
-
-        # Return to the old workdir
-        if workdir is not None:
-            os.chdir(old_cwd)
+        result = run_command_better(command, verbose=self.verbose, cwd=workdir)
 
         return result
 
@@ -68,11 +59,6 @@ class GCCCommand:
         
 
     def run(self, workdir=None) -> ProcResult:
-        # First, enter the workdir
-        old_cwd = os.getcwd()
-        if workdir is not None:
-            os.chdir(workdir)
-
         # Build the command
         command = ["gcc"]
         if self.arch == Arch.i386: 
@@ -91,11 +77,7 @@ class GCCCommand:
         command += self.input_files
 
         # Run the command
-        result = run_command_better(command, verbose=self.verbose)
-
-        # Return to the old workdir
-        if workdir is not None:
-            os.chdir(old_cwd)
+        result = run_command_better(command, verbose=self.verbose, cwd=workdir)
 
         return result
 
@@ -114,11 +96,6 @@ class ASCommand:
         self.extra_params = extra_params
 
     def run(self, workdir=None) -> ProcResult:
-        # First, enter the workdir
-        old_cwd = os.getcwd()
-        if workdir is not None:
-            os.chdir(workdir)
-
         # Build the command
         command = ["as"]
         if self.arch == Arch.i386: 
@@ -131,11 +108,7 @@ class ASCommand:
         command += self.input_files
 
         # Run the command
-        result = run_command_better(command, verbose=self.verbose)
-
-        # Return to the old workdir
-        if workdir is not None:
-            os.chdir(old_cwd)
+        result = run_command_better(command, verbose=self.verbose, cwd=workdir)
 
         return result
 
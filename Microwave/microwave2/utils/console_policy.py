@@ -0,0 +1,99 @@
+"""
+Where a guest's output goes while it runs. The "serial" policy is what the framework always did:
+kernel messages go to the emulated ttyS0 UART (115200 baud, ignore_loglevel) and launch script output
+is written to /dev/kmsg, so every line a benchmark prints is a synchronous printk to the UART in the
+middle of the measurement. The "quiet" policy keeps that off the measured path:
+- the kernel console is virtio-console (hvc0) instead of the UART (early boot still uses ttyS0)
+- once the launch script starts, only warnings and worse reach the console
+- launch script output is buffered in tmpfs and appended to the aux log (virtio-serial) once the
+  script is done. Benchmarks open the aux port themselves and a virtio port can only be open once,
+  so output can't be streamed to it. The catch is that a run that hangs or crashes loses its output
+
+Test markers and [TAG: ...] lines are still written to /dev/kmsg either way (at the default message
+level, which the quiet loglevel lets through), they delimit the test section and are only a few lines.
+Select with MICROWAVE_CONSOLE_POLICY=quiet or UbuntuDiskImage(console_policy=...).
+"""
+import os
+from dataclasses import dataclass
+
+# Kernel console device
+CONSOLE_SERIAL = "serial"
+CONSOLE_HVC = "hvc"
+KERNEL_CONSOLES = [CONSOLE_SERIAL, CONSOLE_HVC]
+
+# Where launch script output goes
+OUTPUT_KMSG = "kmsg"
+OUTPUT_AUX = "aux"
+
+KMSG_PATH = "/dev/kmsg"
+# virtserialport the qemu launch scripts expose, read back on the host as the aux log
+AUX_PORT_PATH = "/dev/virtio-ports/host-port"
+# Where launch script output waits for the script to finish with OUTPUT_AUX (/run is tmpfs)
+OUTPUT_BUFFER_PATH = "/run/microwave-output.log"
+
+
+@dataclass
+class ConsolePolicy:
+    name: str
+    kernel_console: str = CONSOLE_SERIAL
+    # Console loglevel while the launch script runs (only messages more severe reach the console),
+    # None leaves every message going to the console (ignore_loglevel)
+    loglevel: int = None
+    benchmark_output: str = OUTPUT_KMSG
+
+    def kernel_cmdline_args(self) -> str:
+        """console= and loglevel part of the kernel command line"""
+        if self.kernel_console == CONSOLE_HVC:
+            args = "console=hvc0 earlyprintk=serial,ttyS0,115200"
+        else:
+            args = "console=ttyS0,115200 earlyprintk=serial,ttyS0,115200"
+        # The boot log stays verbose, the loglevel is only lowered for the run itself
+        if self.loglevel is None:
+            args += " ignore_loglevel"
+        return args
+
+    def output_path(self) -> str:
+        """Guest path launch script output is redirected to"""
+        return OUTPUT_BUFFER_PATH if self.benchmark_output == OUTPUT_AUX else KMSG_PATH
+
+    def output_redirect(self) -> str:
+        """Shell redirection for launch script output"""
+        if self.benchmark_output == OUTPUT_AUX:
+            # stderr too, it would otherwise go to the console tty, which is the UART
+            return f" > {OUTPUT_BUFFER_PATH} 2>&1"
+        return f" > {KMSG_PATH}"
+
+    def output_flush_lines(self) -> list:
+        """Init script lines to run after each launch script, moving its buffered output to the aux log"""
+        if self.benchmark_output != OUTPUT_AUX:
+            return []
+        return [f"cat {OUTPUT_BUFFER_PATH} >> {AUX_PORT_PATH} 2>/dev/null", f"rm -f {OUTPUT_BUFFER_PATH}"]
+
+    def run_setup_lines(self) -> list:
+        """Init script lines to run right before the launch script(s)"""
+        if self.loglevel is None:
+            return []
+        return [f"dmesg -n {self.loglevel} 2>/dev/null"]
+
+    def to_json(self) -> dict:
+        return {"name": self.name, "kernel_console": self.kernel_console,
+                "loglevel": self.loglevel, "benchmark_output": self.benchmark_output}
+
+
+CONSOLE_POLICY_SERIAL = "serial"
+CONSOLE_POLICY_QUIET = "quiet"
+CONSOLE_POLICIES = {
+    CONSOLE_POLICY_SERIAL: ConsolePolicy(CONSOLE_POLICY_SERIAL),
+    # 5: KERN_WARNING and worse, which includes /dev/kmsg writes without a level (the tags)
+    CONSOLE_POLICY_QUIET: ConsolePolicy(CONSOLE_POLICY_QUIET, kernel_console=CONSOLE_HVC, loglevel=5,
+                                        benchmark_output=OUTPUT_AUX),
+}
+
+
+def get_console_policy(name: str = None) -> ConsolePolicy:
+    """Policy by name, defaults to MICROWAVE_CONSOLE_POLICY or serial"""
+    if name is None:
+        name = os.environ.get("MICROWAVE_CONSOLE_POLICY", CONSOLE_POLICY_SERIAL)
+    if name not in CONSOLE_POLICIES:
+        raise ValueError(f"Unknown console policy: {name} (one of {', '.join(CONSOLE_POLICIES)})")
+    return CONSOLE_POLICIES[name]
@@ -10,6 +10,7 @@
 # TODO: add a qemu wrapper that includes qemu params for each architecture?? Like kunit_kernel.py
 
 import os
+import hashlib
 from dataclasses import dataclass
 import re
 from typing import Any, Dict, Iterable, List, Tuple
@@ -60,6 +61,9 @@ class Kconfig:
         for name, value in self._entries.items():
             yield KconfigEntry(name, value)
 
+    def as_dict(self) -> Dict[str, str]:
+        return dict(self._entries)
+
     def add_entry(self, name: str, value: str) -> None:
         self._entries[name] = value
 
@@ -83,6 +87,16 @@ class Kconfig:
                 diff.append(pair)
         return diff
 
+    def fingerprint(self) -> str:
+        """Hash of the entries, independent of label and entry order"""
+        lines = sorted(str(e) for e in self.as_entries())
+        return hashlib.sha256('\n'.join(lines).encode()).hexdigest()
+
+    def option_distance(self, other: 'Kconfig') -> int:
+        """Number of options whose value differs, a missing option counts as 'n'"""
+        names = set(self._entries) | set(other._entries)
+        return sum(1 for name in names if self._entries.get(name, 'n') != other._entries.get(name, 'n'))
+
     def merge_in_entries(self, other: 'Kconfig') -> None:
         for name, value in other._entries.items():
             self._entries[name] = value
@@ -8,6 +8,10 @@ from microwave2.utils.kernel_config import Kconfig, generate_kconfig, parse_file
 
 
 import shutil
+import filecmp
+import hashlib
+import subprocess
+import time
 from microwave2.targets.target import Target, TargetConfig
 
 from microwave2.images.disk_image import DiskImage
@@ -17,7 +21,8 @@ from microwave2.results.result import Result, ProcResult
 
 import os
 
-from microwave2.utils.linux_make import LinuxMakeCommand
+from microwave2.utils.linux_make import LinuxMakeCommand, KernelBuildOptions
+from microwave2.utils.qemu import BOOT_PROFILE_FAST, FAST_BOOT_KCONFIG
 
 # farfetch+0x195/0xf80
 
@@ -32,10 +37,60 @@ CONFIGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "linux-co
 
 DEFAULT_DEFCONFIG = "def_localmod"
 
+# Written into a build tree once make succeeds, holds the fingerprint the tree was built for
+BUILD_STAMP_NAME = ".microwave_build_fingerprint"
+# Present in a config dir whose .config was generated in kernel only mode (no modules)
+KERNEL_ONLY_STAMP_NAME = ".microwave_kernel_only"
+
+def clone_tree(source: str, dest: str) -> bool:
+    """Copy a directory tree, sharing blocks (reflink) where the filesystem supports it. Falls back
+    to a plain copy, not hardlinks, since the compiler rewrites objects in place"""
+    try:
+        subprocess.run(["cp", "-a", "--reflink=auto", source, dest], capture_output=True, check=True)
+        return True
+    except (OSError, subprocess.CalledProcessError) as e:
+        warn(f"[LinuxKernel] Failed to clone {source} to {dest}: {e}")
+        shutil.rmtree(dest, ignore_errors=True)
+        return False
+
+def count_newer_objects(build_dir: str, since: float) -> int:
+    """Number of .o files under build_dir written after since"""
+    count = 0
+    for dirpath, _, filenames in os.walk(build_dir):
+        for filename in filenames:
+            if filename.endswith(".o") and os.path.getmtime(os.path.join(dirpath, filename)) > since:
+                count += 1
+    return count
+
+def source_revision(source_dir: str) -> str:
+    """HEAD commit of the kernel source, plus a hash of uncommitted changes and untracked
+    file names if the tree is dirty. None if source_dir isn't a git checkout"""
+    try:
+        head = subprocess.run(["git", "-C", source_dir, "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        diff = subprocess.run(["git", "-C", source_dir, "diff", "HEAD"], capture_output=True, check=True).stdout
+        untracked = subprocess.run(["git", "-C", source_dir, "ls-files", "--others", "--exclude-standard"], capture_output=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        warn(f"[LinuxKernel] Could not get source revision of {source_dir}: {e}")
+        return None
+
+    if diff or untracked:
+        head += "-dirty-" + hashlib.sha256(diff + untracked).hexdigest()[:16]
+    return head
+
 # TODO add more functionality, particularly for configuring
+def with_fast_boot_options(kconfig: Kconfig) -> Kconfig:
+    """Copy of kconfig (same label) with FAST_BOOT_KCONFIG merged in. If olddefconfig drops any of
+    them (unmet dependencies), validate_config fails the build instead of booting a kernel without a disk"""
+    fast_kconfig = Kconfig(kconfig_label=kconfig.get_label())
+    fast_kconfig.merge_in_entries(kconfig)
+    for name, value in FAST_BOOT_KCONFIG.items():
+        fast_kconfig.add_entry(name, value)
+    return fast_kconfig
+
+
 class LinuxKernel():
     """Manages a cloned linux kernel"""
-    def __init__(self, source_dir: str, build_dir: str, target_arch: Arch, kconfig: Kconfig=None):      
+    def __init__(self, source_dir: str, build_dir: str, target_arch: Arch, kconfig: Kconfig=None, build_options: KernelBuildOptions=None):      
         self.source_dir = source_dir
 
 
@@ -45,27 +100,88 @@ class LinuxKernel():
         #     # TODO make this a default defconfig
         #     defconfig_name = "def_localmod"
         self.kconfig = kconfig
-        self.build_dir =  os.path.join(build_dir, kconfig.get_label())
         self.arch = target_arch
         # self.defconfig_name = defconfig_name
 
-        self.config_path = os.path.join(self.build_dir, ".config")
-        self.old_config_path = os.path.join(self.build_dir, ".last.config")
-
-        # Make command for repeat use
+        # The .config is resolved (olddefconfig) per label, but the actual build tree is shared by every
+        # label whose resolved config, source and toolchain match (see select_build_dir)
+        if build_options is None:
+            build_options = KernelBuildOptions.from_env()
+        self.build_options = build_options
+        if build_options.boot_profile == BOOT_PROFILE_FAST and target_arch == Arch.X86:
+            self.kconfig = with_fast_boot_options(kconfig)
+
+        self.config_dir = os.path.join(build_dir, kconfig.get_label())
+        self.builds_root = os.path.join(build_dir, "builds")
+        if build_options.tmpfs_dir is not None:
+            # Build trees (not the resolved configs) live on tmpfs, keyed by the same target dir name
+            self.builds_root = os.path.join(build_options.tmpfs_dir, "microwave-builds", os.path.basename(os.path.normpath(build_dir)))
+        self.build_dir = self.config_dir
+        self.build_fingerprint = None
+        self.seeded_from = None # Build tree this one was cloned from, if any
+        self.last_rebuilt_objects = None
+
+        self.config_path = os.path.join(self.config_dir, ".config")
+        self.old_config_path = os.path.join(self.config_dir, ".last.config")
+        self.kernel_only_stamp_path = os.path.join(self.config_dir, KERNEL_ONLY_STAMP_NAME)
+
+        # Only used to resolve the config
+        self.config_make_command = LinuxMakeCommand(kernel_dir=self.source_dir,
+                                                    exec_arch=target_arch,
+                                                    output_dir=self.config_dir,
+                                                    default_verbose=True)
+
+        # Make command for repeat use, output_dir moves to the shared build tree once configured
         self.make_command = LinuxMakeCommand(kernel_dir=self.source_dir,
                                              exec_arch=target_arch,
                                              output_dir=self.build_dir,
-                                             default_verbose=True)
+                                             default_verbose=True,
+                                             build_options=build_options)
         
         # makedirs(self.source_dir)
-        makedirs(self.build_dir)
+        makedirs(self.config_dir)
 
     def get_source_dir(self):
         return self.source_dir
 
     def get_build_dir(self):
         return self.build_dir
+
+    def get_kernel_image_path(self) -> str:
+        """Compressed kernel image in the build tree"""
+        image_name = "Image" if self.arch == Arch.ARM else "bzImage"
+        return os.path.join(self.build_dir, "arch", self.arch.linux_make_config_str(), "boot", image_name)
+
+    def get_pvh_image_path(self) -> str:
+        """Uncompressed vmlinux if this tree is built and has a PVH entry point (for direct boot), otherwise None"""
+        vmlinux_path = os.path.join(self.build_dir, "vmlinux")
+        if not self.build_is_current() or not os.path.exists(vmlinux_path):
+            return None
+        if parse_file(self.get_build_config_path()).as_dict().get("PVH") != "y":
+            return None
+        return vmlinux_path
+
+    def get_system_map_path(self) -> str:
+        return os.path.join(self.build_dir, "System.map")
+
+    def get_build_config_path(self) -> str:
+        """Final .config the tree was built with"""
+        return os.path.join(self.build_dir, ".config")
+
+    def get_build_log_path(self) -> str:
+        return os.path.join(self.build_dir, "build.log")
+
+    def get_kernel_release(self) -> str:
+        """Release string of the built kernel (uname -r), None if not built yet"""
+        release_path = os.path.join(self.build_dir, "include", "config", "kernel.release")
+        if not os.path.exists(release_path):
+            return None
+        with open(release_path, "r") as f:
+            return f.read().strip()
+
+    def get_build_fingerprint(self) -> str:
+        """Fingerprint of the resolved config + source + toolchain, None until configured"""
+        return self.build_fingerprint
     
     def kconfig_changed(self) -> bool:
 
@@ -92,7 +208,7 @@ class LinuxKernel():
     def build_config(self) -> Result:
     
         self.kconfig.write_to_file(self.config_path)
-        result = self.make_command.make_olddefconfig()
+        result = self.config_make_command.make_olddefconfig()
         if result.is_failure():
             error("[LinuxKernel] Failed to run make olddefconfig")
             return Result.failure(message="Failed to run make olddefconfig")
@@ -101,6 +217,12 @@ class LinuxKernel():
             error("[LinuxKernel] Failed to validate config")
             return Result.failure(message="Failed to validate config")
 
+        if os.path.exists(self.kernel_only_stamp_path):
+            os.remove(self.kernel_only_stamp_path)
+        if self.build_options.kernel_only:
+            result = self.build_builtin_config()
+            if result.is_failure():
+                return result
        
         if os.path.exists(self.old_config_path):
             os.remove(self.old_config_path)  # write_to_file appends to the file
@@ -117,7 +239,8 @@ class LinuxKernel():
         existing_kconfig = parse_file(self.config_path)
         # self._kconfig = self._ops.make_arch_config(self._kconfig)
 
-        if self.kconfig.is_subset_of(existing_kconfig) and not self.kconfig_changed():
+        kernel_only_changed = os.path.exists(self.kernel_only_stamp_path) != self.build_options.kernel_only
+        if self.kconfig.is_subset_of(existing_kconfig) and not self.kconfig_changed() and not kernel_only_changed:
             return Result.success()
         print('Regenerating .config ...')
         os.remove(self.config_path)
@@ -125,16 +248,145 @@ class LinuxKernel():
 
 
 
+    def build_builtin_config(self) -> Result:
+        """Kernel only mode: build every module into the kernel, so the guest never has to load one"""
+        result = self.config_make_command.make_mod2yesconfig()
+        if result.is_failure():
+            error("[LinuxKernel] Failed to run make mod2yesconfig")
+            return Result.failure(message="Failed to run make mod2yesconfig")
+
+        modules = [entry.name for entry in parse_file(self.config_path).as_entries() if entry.value == "m"]
+        if modules:
+            error(f"[LinuxKernel] Options still built as modules: {', '.join(modules)}")
+            return Result.failure(message="Not every module could be built in")
+
+        open(self.kernel_only_stamp_path, "w").close()
+        info(f"[LinuxKernel] Built every module into {self.kconfig.get_label()}")
+        return Result.success()
+
+    def compute_build_fingerprint(self) -> str:
+        """Hash of the resolved .config, kernel source revision and toolchain. None if either
+        the source revision or toolchain can't be determined (then builds aren't shared)"""
+        revision = source_revision(self.source_dir)
+        toolchain = self.make_command.toolchain_version()
+        if revision is None or toolchain is None:
+            return None
+
+        resolved = parse_file(self.config_path)
+        parts = [resolved.fingerprint(), revision, toolchain, self.arch.linux_make_str()]
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()[:16]
+
+    def select_build_dir(self) -> Result:
+        """Point the build at the tree for this config's fingerprint, so labels that only differ in
+        things that don't change the resolved .config (e.g. boot args) share one build"""
+        fingerprint = self.compute_build_fingerprint()
+        if fingerprint is None:
+            warn("[LinuxKernel] Could not fingerprint build, building in per-label directory")
+            self.build_fingerprint = None
+            self.build_dir = self.config_dir
+            self.make_command.output_dir = self.build_dir
+            return Result.success()
+
+        self.build_fingerprint = fingerprint
+        self.build_dir = os.path.join(self.builds_root, fingerprint)
+        self.make_command.output_dir = self.build_dir
+        if not os.path.exists(self.build_dir) and self.build_options.seed_builds:
+            self.seed_build_dir()
+        makedirs(self.build_dir)
+
+        # Only copy if changed, touching .config makes kbuild re-run syncconfig
+        build_config_path = os.path.join(self.build_dir, ".config")
+        if not os.path.exists(build_config_path) or not filecmp.cmp(self.config_path, build_config_path, shallow=False):
+            shutil.copy(self.config_path, build_config_path)
+
+        info(f"[LinuxKernel] Config {self.kconfig.get_label()} uses build {fingerprint}")
+        return Result.success()
+
+    def find_seed_build(self) -> str:
+        """Finished build tree (under builds_root) whose .config is closest to ours, None if there is none
+        within build_options.seed_max_distance"""
+        if not os.path.isdir(self.builds_root):
+            return None
+        resolved = parse_file(self.config_path)
+        max_distance = self.build_options.seed_max_distance
+        best_dir, best_distance, skipped = None, None, 0
+        for name in os.listdir(self.builds_root):
+            candidate = os.path.join(self.builds_root, name)
+            candidate_config = os.path.join(candidate, ".config")
+            if not os.path.exists(os.path.join(candidate, BUILD_STAMP_NAME)) or not os.path.exists(candidate_config):
+                continue
+            distance = resolved.option_distance(parse_file(candidate_config))
+            if max_distance is not None and distance > max_distance:
+                skipped += 1
+                continue
+            if best_distance is None or distance < best_distance:
+                best_dir, best_distance = candidate, distance
+        if best_dir is not None:
+            info(f"[LinuxKernel] Closest finished build to {self.kconfig.get_label()} is {os.path.basename(best_dir)} ({best_distance} options differ)")
+        elif skipped:
+            info(f"[LinuxKernel] No finished build within {max_distance} options of {self.kconfig.get_label()} ({skipped} too far off), building from scratch")
+        return best_dir
+
+    def seed_build_dir(self):
+        """Start a new build tree as a clone of the closest finished one, so the incremental make only
+        recompiles what the config difference touches. Cloned into a temp dir and renamed, so an
+        interrupted clone never looks like a real tree"""
+        seed_dir = self.find_seed_build()
+        if seed_dir is None:
+            return
+        tmp_dir = f"{self.build_dir}.seed-{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not clone_tree(seed_dir, tmp_dir):
+            return
+        stamp_path = os.path.join(tmp_dir, BUILD_STAMP_NAME)
+        if os.path.exists(stamp_path):
+            os.remove(stamp_path)
+        try:
+            os.rename(tmp_dir, self.build_dir)
+        except OSError:
+            # Another process created this build tree meanwhile, use theirs
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.seeded_from = os.path.basename(seed_dir)
+        info(f"[LinuxKernel] Seeded build {self.build_fingerprint} from {self.seeded_from}")
+
+    def build_is_current(self) -> bool:
+        """True if the selected build tree already finished a build for this fingerprint"""
+        if self.build_fingerprint is None:
+            return False
+        stamp_path = os.path.join(self.build_dir, BUILD_STAMP_NAME)
+        if not os.path.exists(stamp_path):
+            return False
+        with open(stamp_path, "r") as f:
+            return f.read().strip() == self.build_fingerprint
+
+    def mark_build_complete(self):
+        if self.build_fingerprint is None:
+            return
+        with open(os.path.join(self.build_dir, BUILD_STAMP_NAME), "w") as f:
+            f.write(self.build_fingerprint)
+
+    def clear_build_stamp(self):
+        stamp_path = os.path.join(self.build_dir, BUILD_STAMP_NAME)
+        if os.path.exists(stamp_path):
+            os.remove(stamp_path)
+
     @timed
     def configure(self, force_reconfig:bool=False) -> Result:
         # If force reconfig, remove config and build new one
         if (force_reconfig):
             info("[LinuxKernel] Cleaning kernel source")
-            os.remove(self.config_path)
-            return self.build_config()
-        
-        # Otherwise, just call bulid_reconfig
-        return self.build_reconfig()
+            if os.path.exists(self.config_path):
+                os.remove(self.config_path)
+            result = self.build_config()
+        else:
+            # Otherwise, just call bulid_reconfig
+            result = self.build_reconfig()
+
+        if result.is_failure():
+            return result
+
+        return self.select_build_dir()
 
     @timed
     def old_configure(self, force_reconfig:bool=False) -> Result:
@@ -220,18 +472,34 @@ class LinuxKernel():
         # Clean kernel if force_rebuild
         if (force_rebuild):
             info("[LinuxKernel] Cleaning kernel tree")
+            self.clear_build_stamp()
             result = self.make_command.make_clean()
             if (result.is_failure()):
                 info("[LinuxKernel] Failed to clean kernel tree")
                 return result
 
+        # Another config with the same fingerprint already built this tree
+        if self.build_is_current():
+            info(f"[LinuxKernel] Reusing existing build {self.build_fingerprint} for {self.kconfig.get_label()}")
+            return Result.success()
+
         # Build kernel
         info("[LinuxKernel] Building kernel")
+        self.clear_build_stamp()
+        build_start = time.time()
         result = self.make_command.make()
+        with open(self.get_build_log_path(), "w") as f:
+            f.write(result.get_stdout())
+            f.write(result.get_stderr())
         if (result.is_failure()):
             info("[LinuxKernel] Failed to build kernel")
         else: 
-            info("[LinuxKernel] Kernel built successfully")
+            self.mark_build_complete()
+            self.last_rebuilt_objects = count_newer_objects(self.build_dir, build_start)
+            seeded = f" (seeded from {self.seeded_from})" if self.seeded_from is not None else ""
+            info(f"[LinuxKernel] Kernel built successfully, {self.last_rebuilt_objects} objects rebuilt{seeded}")
+            if self.make_command.last_ccache_stats is not None:
+                info(f"[LinuxKernel] Build ccache stats: {self.make_command.last_ccache_stats}")
 
         debug_pause("LinuxKernel build finished", level=4)
         return result
@@ -268,6 +536,20 @@ class LinuxKernel():
         """Get the lib directory for the kernel"""
         return os.path.join(install_dir, "lib")
     
+    def install_kernel_only(self, install_dir: str) -> Result:
+        """Kernel only mode: put just the kernel image (plus System.map and config, for reference)
+        in install_dir/boot, named like make install would, instead of installing modules and headers"""
+        release = self.get_kernel_release()
+        if release is None or not os.path.exists(self.get_kernel_image_path()):
+            return Result.failure("Kernel not built, nothing to install")
+
+        boot_dir = self.get_install_boot_dir(install_dir)
+        makedirs(boot_dir)
+        shutil.copy(self.get_kernel_image_path(), os.path.join(boot_dir, f"vmlinuz-{release}"))
+        shutil.copy(self.get_system_map_path(), os.path.join(boot_dir, f"System.map-{release}"))
+        shutil.copy(self.get_build_config_path(), os.path.join(boot_dir, f"config-{release}"))
+        return Result.success()
+
     @timed
     def install(self, install_dir: str) -> Result:
         """Install into the specified directory, which is then ready to be installecd into an image. Will clobber the directory if it exists."""
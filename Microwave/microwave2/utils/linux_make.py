@@ -1,5 +1,10 @@
 from microwave2.utils.utils import Arch, run_command_better
+from microwave2.utils.qemu import BOOT_PROFILE_DEFAULT
+from microwave2.local_storage import local_paths
+from dataclasses import dataclass
 import os 
+import re
+import shutil
 import subprocess
 #!/usr/bin/env python3
 import re
@@ -17,13 +22,76 @@ from microwave2.results.result import Result, ProcResult
 #         self.stderr = stderr
 
 
+# Only required for gcc 15 I think
+DEFAULT_CC = "gcc -std=gnu11"
+
+@dataclass
+class KernelBuildOptions:
+    """How kernels are compiled, shared by every build of a target"""
+    ccache: bool = True # Only used if ccache is installed
+    ccache_dir: str = None # Defaults to <build dir>/ccache, point several workdirs/hosts at one dir to share it
+    ccache_max_size: str = "20G"
+    tmpfs_dir: str = None # If set (e.g. /dev/shm), build trees are placed here instead of under the build dir
+    artifact_store: bool = True # Reuse/publish finished kernels in a KernelArtifactStore
+    artifact_store_dir: str = None # Defaults to <build dir>/artifacts, can be shared between hosts
+    seed_builds: bool = True # Start new build trees from a copy of the closest finished one
+    seed_max_distance: int = 200 # Differing options past which a seed rebuilds about as much as a clean tree, None for no limit
+    kernel_only: bool = False # Build every module in (=y) and boot just the kernel image, leaving the disk image untouched
+    boot_profile: str = BOOT_PROFILE_DEFAULT # Kernels for the fast profile get the options it needs (FAST_BOOT_KCONFIG)
+
+    @classmethod
+    def from_env(cls):
+        """Defaults, overridden by MICROWAVE_CCACHE=0, MICROWAVE_CCACHE_DIR, MICROWAVE_CCACHE_MAX_SIZE, MICROWAVE_BUILD_TMPFS,
+        MICROWAVE_ARTIFACT_STORE=0, MICROWAVE_ARTIFACT_STORE_DIR, MICROWAVE_SEED_BUILDS=0, MICROWAVE_SEED_MAX_DISTANCE, MICROWAVE_KERNEL_ONLY=1 and MICROWAVE_BOOT_PROFILE"""
+        options = cls()
+        if os.environ.get("MICROWAVE_CCACHE") == "0":
+            options.ccache = False
+        options.ccache_dir = os.environ.get("MICROWAVE_CCACHE_DIR", options.ccache_dir)
+        options.ccache_max_size = os.environ.get("MICROWAVE_CCACHE_MAX_SIZE", options.ccache_max_size)
+        options.tmpfs_dir = os.environ.get("MICROWAVE_BUILD_TMPFS", options.tmpfs_dir)
+        if os.environ.get("MICROWAVE_ARTIFACT_STORE") == "0":
+            options.artifact_store = False
+        options.artifact_store_dir = os.environ.get("MICROWAVE_ARTIFACT_STORE_DIR", options.artifact_store_dir)
+        if os.environ.get("MICROWAVE_SEED_BUILDS") == "0":
+            options.seed_builds = False
+        if os.environ.get("MICROWAVE_SEED_MAX_DISTANCE"):
+            options.seed_max_distance = int(os.environ["MICROWAVE_SEED_MAX_DISTANCE"])
+        if os.environ.get("MICROWAVE_KERNEL_ONLY") == "1":
+            options.kernel_only = True
+        options.boot_profile = os.environ.get("MICROWAVE_BOOT_PROFILE", options.boot_profile)
+        return options
+
+    def get_ccache_dir(self) -> str:
+        if self.ccache_dir is not None:
+            return self.ccache_dir
+        return os.path.join(local_paths.get_build_dir(), "ccache")
+
+
+def parse_ccache_stats(text: str) -> dict:
+    """Hit/miss counts from `ccache --print-stats` (ccache 4) or `ccache -s` (ccache 3) output"""
+    counters = {}
+    for line in text.splitlines():
+        parts = line.split("\t")
+        if len(parts) == 2 and parts[1].strip().isdigit():
+            counters[parts[0].strip()] = int(parts[1])
+    if counters:
+        hits = counters.get("direct_cache_hit", 0) + counters.get("preprocessed_cache_hit", 0)
+        return {"hits": hits, "misses": counters.get("cache_miss", 0)}
+
+    hits = sum(int(count) for count in re.findall(r"^cache hit \((?:direct|preprocessed)\)\s+(\d+)", text, re.MULTILINE))
+    misses = re.search(r"^cache miss\s+(\d+)", text, re.MULTILINE)
+    if not hits and misses is None:
+        return None
+    return {"hits": hits, "misses": int(misses.group(1)) if misses else 0}
+
+
 # TODO expand to support full kernel comands (clean, config, etc), for now only does modules
 # TODO maybe make a specific ProcResult subclass MakeResult?
 class LinuxMakeCommand:
-    def __init__(self, kernel_dir: str, exec_arch: Arch, jobs: int=None, output_dir: str=None, default_verbose: bool = False):
+    def __init__(self, kernel_dir: str, exec_arch: Arch, jobs: int=None, output_dir: str=None, default_verbose: bool = False, build_options: KernelBuildOptions = None):
         """- kernel_dir is the directory of the compiled kernel
            - output_dir is the directory where the output of the build will be placed
-           
+           - build_options controls compiler caching (ccache) for make()
            """
         self.kernel_dir = kernel_dir
         self.arch = exec_arch
@@ -44,6 +112,19 @@ class LinuxMakeCommand:
         self.output_dir = output_dir
         self.default_verbose = default_verbose
 
+        if build_options is None:
+            build_options = KernelBuildOptions()
+        self.build_options = build_options
+        self.use_ccache = False
+        if build_options.ccache:
+            if shutil.which("ccache") is None:
+                warn("[LinuxMakeCommand] ccache not installed, building without compiler cache")
+            else:
+                self.use_ccache = True
+                os.makedirs(build_options.get_ccache_dir(), exist_ok=True)
+        # Hit/miss counts of the last make(), None if ccache isn't used
+        self.last_ccache_stats = None
+
     # def run_command(self, command, verbose:bool) -> ProcResult:
     #     try:
     #         proc = subprocess.Popen(command,
@@ -68,12 +149,12 @@ class LinuxMakeCommand:
     #         info("Error: ", e)
     #         return ProcResult(returncode=-1, stdout="", stderr="", error=e, message="Failed to run command: {}".format(self.str_command(command)))
 
-    def run_command(self, command, verbose:bool = None) -> ProcResult:
+    def run_command(self, command, verbose:bool = None, env: dict = None) -> ProcResult:
 
         if verbose is None:
             verbose = self.default_verbose
         print("[LinuxMakeCommand][run_command] running command")
-        result = run_command_better(command, verbose=verbose)
+        result = run_command_better(command, verbose=verbose, env=env)
         # If result is a failure, print stdout as debug and stderr as error
         if result.is_failure():
             debug("STDOUT:\n" + result.get_stdout())
@@ -81,6 +162,40 @@ class LinuxMakeCommand:
 
         return result
 
+    def ccache_env(self) -> dict:
+        """Environment for a ccache build. Paths under the workdir are made relative (CCACHE_BASEDIR),
+        so trees in different build dirs can hit each other's cache entries"""
+        env = os.environ.copy()
+        env["CCACHE_DIR"] = self.build_options.get_ccache_dir()
+        env["CCACHE_MAXSIZE"] = self.build_options.ccache_max_size
+        env["CCACHE_BASEDIR"] = os.path.commonpath([local_paths.get_workdir(), self.kernel_dir])
+        env["CCACHE_SLOPPINESS"] = "time_macros"
+        return env
+
+    def ccache_stats(self) -> dict:
+        """Current hit/miss counters of the cache, None if they can't be read"""
+        for flag in ["--print-stats", "-s"]:
+            proc = subprocess.run(["ccache", flag], capture_output=True, text=True, env=self.ccache_env())
+            if proc.returncode != 0:
+                continue
+            stats = parse_ccache_stats(proc.stdout)
+            if stats is not None:
+                return stats
+        warn("[LinuxMakeCommand] Could not read ccache stats")
+        return None
+
+    def toolchain_version(self) -> str:
+        """First line of the compiler's --version, used to tell builds from different toolchains apart"""
+        compiler = (self.cross_compile or "") + "gcc"
+        try:
+            proc = subprocess.run([compiler, "--version"], capture_output=True, text=True)
+        except OSError as e:
+            warn(f"[LinuxMakeCommand] Could not run {compiler}: {e}")
+            return None
+        if proc.returncode != 0 or not proc.stdout:
+            return None
+        return proc.stdout.splitlines()[0].strip()
+
     def str_command(self, command):
         return " ".join(command)
 
@@ -124,6 +239,14 @@ class LinuxMakeCommand:
         info("Running command:", self.str_command(command))
         return self.run_command(command)
     
+    def make_mod2yesconfig(self) -> ProcResult:
+        """Turn every =m option in the existing .config into =y"""
+        command = self.base_command()
+        command.extend(["-C", self.kernel_dir])
+        command.append("mod2yesconfig")
+        info("Running command:", self.str_command(command))
+        return self.run_command(command)
+
     def make_localmodconfig(self) -> ProcResult:
         command = self.base_command()
         command.extend(["-C", self.kernel_dir])
@@ -137,12 +260,24 @@ class LinuxMakeCommand:
     def make(self, verbose:bool = None) -> ProcResult:
         command = self.base_command()
         command.extend(["-C", self.kernel_dir])
-        # Only required for gcc 15 I think
-        command.append("CC=gcc -std=gnu11")
-        # command.append("KCFLAGS=-Wno-error")
-        # command.extend(["KCFLAGS=-Wno-error"]) # TODO make this configurable
+        if not self.use_ccache:
+            command.append(f"CC={DEFAULT_CC}")
+            # command.append("KCFLAGS=-Wno-error")
+            # command.extend(["KCFLAGS=-Wno-error"]) # TODO make this configurable
+            info("Running command:", self.str_command(command))
+            return self.run_command(command, verbose=verbose)
+
+        command.append(f"CC=ccache {DEFAULT_CC}")
         info("Running command:", self.str_command(command))
-        return self.run_command(command, verbose=verbose)
+
+        # Per build stats are the difference in the (shared) cache counters
+        before = self.ccache_stats()
+        result = self.run_command(command, verbose=verbose, env=self.ccache_env())
+        after = self.ccache_stats()
+        if before is not None and after is not None:
+            self.last_ccache_stats = {key: after[key] - before[key] for key in after}
+            info(f"[LinuxMakeCommand] ccache hits: {self.last_ccache_stats['hits']}, misses: {self.last_ccache_stats['misses']}")
+        return result
 
 
     def make_install(self, install_path: str=None) -> ProcResult:
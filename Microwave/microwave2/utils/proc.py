@@ -0,0 +1,361 @@
+"""
+Process supervisor. Commands run as asyncio subprocesses on one event loop, which lives in a daemon
+thread, so any number of concurrent builds, rsyncs or VMs share that thread instead of taking two
+reader threads (and a timeout thread) each. Every command gets:
+- its own cwd and env (nothing process global is touched, so concurrent callers can't race on cwd)
+- its own process group, so a timeout or kill takes down everything it started
+- bounded output: only the last max_output_bytes of each stream are kept in memory, tee_path gets all of it
+- a ProcRunResult saying how it ended: exited, killed by a signal, timed out, or never started
+
+Blocking callers use run() (or start() for a handle to something long running), code already on the
+loop awaits run_async(). get_supervisor() gives the shared instance.
+"""
+import asyncio
+import codecs
+import os
+import signal
+import sys
+import threading
+import time
+import warnings
+from collections import deque
+from typing import Callable, List, Optional
+
+from microwave2.results.result import ProcResult, Status
+from microwave2.utils.log import log, warn, error, debug, info
+
+READ_SIZE = 1 << 16
+# Per stream, kernel builds can print a lot more than anyone looks at
+DEFAULT_MAX_OUTPUT_BYTES = 16 << 20
+# Between SIGTERM and SIGKILL when a command times out or is killed
+DEFAULT_KILL_GRACE = 5
+
+OUTCOME_EXITED = "exited"
+OUTCOME_SIGNALED = "signaled"
+OUTCOME_TIMEOUT = "timeout"
+OUTCOME_FAILED_TO_START = "failed_to_start"
+
+
+class ExitProtocol(asyncio.subprocess.SubprocessStreamProtocol):
+    """Stream protocol that also says when the process exited. Process.wait() before 3.12 only returns
+    once the pipes are closed too, which a grandchild keeping them open can hold up indefinitely"""
+    def __init__(self, loop):
+        super().__init__(limit=2 ** 16, loop=loop)
+        self.exited = loop.create_future()
+
+    def process_exited(self):
+        super().process_exited()
+        if not self.exited.done():
+            self.exited.set_result(None)
+
+
+class ProcRunResult(ProcResult):
+    """ProcResult that also says how the process ended. returncode is negative for a signal, like
+    subprocess's. Only the tail of each stream is kept when it was longer than the buffer (truncated)"""
+    def __init__(self, command: List[str], returncode: int, stdout: str, stderr: str, outcome: str,
+                 signal_number: int = None, duration: float = 0, truncated: bool = False,
+                 message: str = None, error: Exception = None):
+        self.command = command
+        self.outcome = outcome
+        self.signal_number = signal_number
+        self.duration = duration
+        self.truncated = truncated
+        super().__init__(returncode=returncode, stdout=stdout, stderr=stderr, message=message, error=error)
+
+    def timed_out(self) -> bool:
+        return self.outcome == OUTCOME_TIMEOUT
+
+    def signal_name(self) -> Optional[str]:
+        if self.signal_number is None:
+            return None
+        try:
+            return signal.Signals(self.signal_number).name
+        except ValueError:
+            return str(self.signal_number)
+
+    def to_json(self):
+        parent_json = super().to_json()
+        parent_json["command"] = self.command
+        parent_json["outcome"] = self.outcome
+        parent_json["signal"] = self.signal_name()
+        parent_json["duration"] = self.duration
+        parent_json["truncated"] = self.truncated
+        return parent_json
+
+    def __str__(self):
+        return f"ProcRunResult(outcome={self.outcome}, returncode={self.returncode}, duration={self.duration:.1f}s)"
+
+
+class TailBuffer:
+    """Keeps the last max_bytes (roughly, in characters) of a stream"""
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.chunks = deque()
+        self.size = 0
+        self.truncated = False
+
+    def append(self, text: str):
+        if not text:
+            return
+        self.chunks.append(text)
+        self.size += len(text)
+        while self.size > self.max_bytes and self.chunks:
+            excess = self.size - self.max_bytes
+            first = self.chunks[0]
+            if len(first) <= excess:
+                self.chunks.popleft()
+                self.size -= len(first)
+            else:
+                self.chunks[0] = first[excess:]
+                self.size -= excess
+            self.truncated = True
+
+    def getvalue(self) -> str:
+        return "".join(self.chunks)
+
+
+def kill_group(pid: int, sig: int = signal.SIGKILL):
+    """Signal a process group started by the supervisor (its leader's pid is the group id)"""
+    try:
+        os.killpg(pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def signal_proc(proc, sig: int, own_group: bool):
+    if own_group:
+        kill_group(proc.pid, sig)
+        return
+    try:
+        proc.send_signal(sig)
+    except ProcessLookupError:
+        pass
+
+
+class ProcHandle:
+    """A command running under the supervisor. result() blocks until it is done"""
+    def __init__(self, supervisor: "ProcSupervisor", command: List[str]):
+        self.supervisor = supervisor
+        self.command = command
+        self.pid = None
+        self.started = threading.Event()
+        self.future = None
+        # Set by kill(), the run stops its process group once it sees it
+        self.kill_requested = None
+
+    @property
+    def returncode(self) -> Optional[int]:
+        if self.future is None or not self.future.done():
+            return None
+        return self.future.result().returncode
+
+    def done(self) -> bool:
+        return self.future is not None and self.future.done()
+
+    def result(self, timeout: float = None) -> ProcRunResult:
+        return self.future.result(timeout=timeout)
+
+    def kill(self):
+        """Stop the whole process group (SIGTERM, then SIGKILL after the grace period)"""
+        if self.kill_requested is not None:
+            self.supervisor.loop.call_soon_threadsafe(self.kill_requested.set)
+
+
+class ProcSupervisor:
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self.lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                self.use_pidfd_watcher(loop)
+                self.thread = threading.Thread(target=loop.run_forever, name="proc-supervisor", daemon=True)
+                self.thread.start()
+                self.loop = loop
+        return self.loop
+
+    @staticmethod
+    def use_pidfd_watcher(loop: asyncio.AbstractEventLoop):
+        """Before 3.12 the default child watcher starts a thread per process to wait on it, a pidfd
+        watcher waits on the loop instead (3.12+ picks one by itself)"""
+        if sys.version_info >= (3, 12) or not hasattr(asyncio, "PidfdChildWatcher") or not hasattr(os, "pidfd_open"):
+            return
+        try:
+            os.close(os.pidfd_open(os.getpid()))
+        except OSError:
+            return
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", DeprecationWarning)
+            watcher = asyncio.PidfdChildWatcher()
+            watcher.attach_loop(loop)
+            asyncio.get_event_loop_policy().set_child_watcher(watcher)
+
+    def in_loop(self) -> bool:
+        return self.thread is not None and threading.current_thread() is self.thread
+
+    async def run_async(self, command: List[str], cwd: str = None, env: dict = None, timeout: float = None,
+                        tee_path: str = None, max_output_bytes: int = DEFAULT_MAX_OUTPUT_BYTES,
+                        on_line: Callable[[str, str], None] = None, merge_stderr: bool = False,
+                        kill_grace: float = DEFAULT_KILL_GRACE, own_group: bool = True, stdin=asyncio.subprocess.DEVNULL,
+                        handle: ProcHandle = None) -> ProcRunResult:
+        """Run command to completion. on_line(stream, line) gets every line as it arrives ("stdout" or
+        "stderr", called on the loop, so it must not block), merge_stderr sends stderr to stdout.
+        own_group=False keeps the command in our session (sudo needs the terminal to ask for a password),
+        a timeout or kill then only reaches the command itself. stdin=None inherits ours"""
+        command = [str(part) for part in command]
+        start = time.perf_counter()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        try:
+            # Before starting anything, so a bad tee_path can't leave a process nobody reads from
+            tee = open(tee_path, "w", errors="backslashreplace") if tee_path is not None else None
+        except OSError as e:
+            if handle is not None:
+                handle.started.set()
+            return ProcRunResult(command, returncode=-1, stdout="", stderr="", outcome=OUTCOME_FAILED_TO_START,
+                                 message=f"Failed to open {tee_path}: {e}", error=e)
+        try:
+            # create_subprocess_exec, but keeping hold of the protocol
+            loop = asyncio.get_running_loop()
+            transport, protocol = await loop.subprocess_exec(
+                lambda: ExitProtocol(loop),
+                *command, cwd=cwd, env=env,
+                stdin=stdin,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT if merge_stderr else asyncio.subprocess.PIPE,
+                start_new_session=own_group)
+            proc = asyncio.subprocess.Process(transport, protocol, loop)
+        except OSError as e:
+            if tee is not None:
+                tee.close()
+            if handle is not None:
+                handle.started.set()
+            return ProcRunResult(command, returncode=-1, stdout="", stderr="", outcome=OUTCOME_FAILED_TO_START,
+                                 message=f"Failed to start {command[0]}: {e}", error=e)
+
+        kill_requested = asyncio.Event()
+        if handle is not None:
+            handle.pid = proc.pid
+            handle.kill_requested = kill_requested
+            handle.started.set()
+
+        buffers = {"stdout": TailBuffer(max_output_bytes), "stderr": TailBuffer(max_output_bytes)}
+        pumps = [asyncio.ensure_future(self.pump(proc.stdout, "stdout", buffers["stdout"], tee, on_line))]
+        if not merge_stderr:
+            pumps.append(asyncio.ensure_future(self.pump(proc.stderr, "stderr", buffers["stderr"], tee, on_line)))
+
+        outcome = None
+        waiter = asyncio.ensure_future(asyncio.shield(protocol.exited))
+        killer = asyncio.ensure_future(kill_requested.wait())
+        try:
+            done, _ = await asyncio.wait([waiter, killer], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            drain_timeout = kill_grace
+            if waiter not in done:
+                outcome = OUTCOME_TIMEOUT if killer not in done else None
+                await self.stop(proc, waiter, kill_grace, own_group)
+            elif deadline is not None:
+                drain_timeout = max(deadline - time.monotonic(), kill_grace)
+            # Not killing the group after a normal exit, some commands leave a daemon behind on purpose.
+            # Something outside the group we signalled (or such a daemon) can hold the pipes open
+            # indefinitely though, so once the command is gone its output is only waited for kill_grace
+            # (or what's left of the timeout)
+            _, still_reading = await asyncio.wait(pumps, timeout=drain_timeout)
+            if still_reading:
+                warn(f"[ProcSupervisor] {command[0]} exited but something still holds its output open, not waiting for it")
+                for pump in still_reading:
+                    pump.cancel()
+                transport.close()
+        except asyncio.CancelledError:
+            signal_proc(proc, signal.SIGKILL, own_group)
+            raise
+        finally:
+            killer.cancel()
+            if tee is not None:
+                tee.close()
+
+        returncode = proc.returncode
+        signal_number = -returncode if returncode is not None and returncode < 0 else None
+        if outcome is None:
+            outcome = OUTCOME_SIGNALED if signal_number is not None else OUTCOME_EXITED
+        message = None
+        if outcome == OUTCOME_TIMEOUT:
+            message = f"{command[0]} timed out after {timeout:g}s"
+        elif outcome == OUTCOME_SIGNALED:
+            message = f"{command[0]} killed by signal {signal_number}"
+        result = ProcRunResult(command, returncode=returncode, stdout=buffers["stdout"].getvalue(),
+                               stderr=buffers["stderr"].getvalue(), outcome=outcome, signal_number=signal_number,
+                               duration=time.perf_counter() - start,
+                               truncated=buffers["stdout"].truncated or buffers["stderr"].truncated, message=message)
+        # A timeout is a failure even if the process exited cleanly on SIGTERM
+        if outcome == OUTCOME_TIMEOUT:
+            result.status = Status.FAILURE
+        return result
+
+    @staticmethod
+    async def stop(proc, waiter, kill_grace: float, own_group: bool):
+        signal_proc(proc, signal.SIGTERM, own_group)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=kill_grace)
+        except asyncio.TimeoutError:
+            signal_proc(proc, signal.SIGKILL, own_group)
+            await waiter
+
+    @staticmethod
+    async def pump(stream, name: str, buffer: TailBuffer, tee, on_line):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="backslashreplace")
+        partial = ""
+        while True:
+            data = await stream.read(READ_SIZE)
+            text = decoder.decode(data, final=not data)
+            buffer.append(text)
+            if tee is not None:
+                tee.write(text)
+            if on_line is not None:
+                lines = (partial + text).split("\n")
+                partial = lines.pop()
+                if not data and partial:
+                    lines.append(partial)
+                for line in lines:
+                    try:
+                        on_line(name, line)
+                    except Exception as e:
+                        error(f"[ProcSupervisor] on_line callback failed: {e}")
+                        on_line = None
+                        break
+            if not data:
+                return
+
+    def start(self, command: List[str], **kwargs) -> ProcHandle:
+        """Start command without waiting for it, takes the same arguments as run_async"""
+        loop = self.ensure_loop()
+        if self.in_loop():
+            raise RuntimeError("ProcSupervisor.start called from the supervisor loop, await run_async instead")
+        handle = ProcHandle(self, command)
+        handle.future = asyncio.run_coroutine_threadsafe(self.run_async(command, handle=handle, **kwargs), loop)
+        # Also if run_async raised before starting anything
+        handle.future.add_done_callback(lambda _: handle.started.set())
+        handle.started.wait()
+        return handle
+
+    def run(self, command: List[str], **kwargs) -> ProcRunResult:
+        """Run command and wait for it, takes the same arguments as run_async"""
+        return self.start(command, **kwargs).result()
+
+    def run_many(self, commands: List[List[str]], **kwargs) -> List[ProcRunResult]:
+        """Run several commands at once (same arguments for each), results in the same order"""
+        handles = [self.start(command, **kwargs) for command in commands]
+        return [handle.result() for handle in handles]
+
+
+_supervisor = None
+_supervisor_lock = threading.Lock()
+
+
+def get_supervisor() -> ProcSupervisor:
+    global _supervisor
+    with _supervisor_lock:
+        if _supervisor is None:
+            _supervisor = ProcSupervisor()
+        return _supervisor
@@ -1,9 +1,16 @@
 
 from microwave2.utils.utils import Arch, debug_pause, run_command_better
 from microwave2.results.result import Result, ProcResult
+from microwave2.local_storage import local_paths
+from microwave2.utils.console_policy import CONSOLE_SERIAL, CONSOLE_HVC, KERNEL_CONSOLES
 import subprocess, os
+import signal
 from microwave2.utils.utils import run_command_better
 import shlex
+import socket
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
 
 # Scripts dir is the same as this file plus /scripts
 # TODO convert to python wrapper 
@@ -14,11 +21,242 @@ ARM_UNMODIFIED = os.path.join(SCRIPTS_DIR, "launch_arm_unmodified.sh")
 X86_CUSTOM_KERNEL = os.path.join(SCRIPTS_DIR, "launch_x86_isolated_custom_kernel.sh")
 # X86_UNMODIFIED = os.path.join(SCRIPTS_DIR, "launch_x86_unmodified.sh")
 X86_UNMODIFIED = os.path.join(SCRIPTS_DIR, "launch_x86_isolated_unmodified.sh")
+X86_MICROVM = os.path.join(SCRIPTS_DIR, "launch_x86_microvm.sh")
+
+# Boot profiles for custom kernel boots: the usual q35 + systemd boot, or microvm + minimal init
+BOOT_PROFILE_DEFAULT = "default"
+BOOT_PROFILE_FAST = "fast"
+BOOT_PROFILES = [BOOT_PROFILE_DEFAULT, BOOT_PROFILE_FAST]
+# Options an x86 kernel needs to boot with BOOT_PROFILE_FAST: microvm has no PCI, so its disks are
+# virtio-mmio devices QEMU lists on the command line, and PVH lets vmlinux be booted directly
+FAST_BOOT_KCONFIG = {
+    "HYPERVISOR_GUEST": "y",
+    "PVH": "y",
+    "VIRTIO_MMIO": "y",
+    "VIRTIO_MMIO_CMDLINE_DEVICES": "y",
+}
+
+
+@dataclass
+class QemuLease:
+    """Host resources handed to a single VM by a QemuResourceAllocator. Every field is
+    unique among the leases that are outstanding at the same time."""
+    slot: int
+    cores: list[int]
+    ssh_port: int
+    gdb_port: int
+    aux_logfile_path: str
+    nbd_device: str
+    image_name: str
+
+    def coreset_str(self) -> str:
+        """Core list in the format taskset -c expects"""
+        return ",".join(str(core) for core in self.cores)
+
+    def launch_env(self) -> dict:
+        """Environment for the qemu_scripts launch scripts, which read these overrides"""
+        env = os.environ.copy()
+        env["CORESET"] = self.coreset_str()
+        env["SSH_PORT"] = str(self.ssh_port)
+        env["GDB_PORT"] = str(self.gdb_port)
+        return env
+
+
+def port_is_free(port: int) -> bool:
+    """Check whether a TCP port on the host can currently be bound"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        try:
+            sock.bind(("", port))
+        except OSError:
+            return False
+    return True
+
+
+class QemuResourceAllocator:
+    """Hands out QemuLeases so several VMs can run on one host at once. Each slot gets a
+    disjoint set of host cores, its own nbd device, forwarded ssh port, gdb port, aux log
+    file and output image name. acquire() blocks until a slot is free.
+    - reserved_cores are left to the host (the old launch scripts left cores 0-1 alone)
+    - ports are assigned base + slot, skipping any port already bound on the host
+    """
+    def __init__(self,
+                 cores_per_vm: int = 4,
+                 reserved_cores: tuple = (0, 1),
+                 host_cores: int = None,
+                 nbd_devices: list[str] = None,
+                 base_ssh_port: int = 2223,
+                 base_gdb_port: int = 1234,
+                 aux_log_dir: str = None,
+                 max_vms: int = None):
+
+        if host_cores is None:
+            host_cores = os.cpu_count()
+        available_cores = [core for core in range(host_cores) if core not in reserved_cores]
+
+        # Split available cores into disjoint sets, dropping any leftover partial set
+        self.core_sets = [available_cores[i:i + cores_per_vm]
+                          for i in range(0, len(available_cores) - cores_per_vm + 1, cores_per_vm)]
+        if not self.core_sets:
+            raise ValueError(f"Not enough host cores for a single VM ({cores_per_vm} cores, {len(available_cores)} available)")
+
+        # nbd0/nbd1 are left alone since other tools tend to grab them, matches old default of /dev/nbd2
+        if nbd_devices is None:
+            nbd_devices = [f"/dev/nbd{i}" for i in range(2, 16)]
+        self.nbd_devices = nbd_devices
+
+        self.base_ssh_port = base_ssh_port
+        self.base_gdb_port = base_gdb_port
+
+        if aux_log_dir is None:
+            aux_log_dir = os.path.join(local_paths.get_temp_dir(), "qemu-leases")
+        os.makedirs(aux_log_dir, exist_ok=True)
+        self.aux_log_dir = aux_log_dir
+
+        num_slots = min(len(self.core_sets), len(self.nbd_devices))
+        if max_vms is not None:
+            num_slots = min(num_slots, max_vms)
+        self.num_slots = num_slots
+
+        self.free_slots = list(range(self.num_slots))
+        self.used_ports = set()
+        self.condition = threading.Condition()
+
+    def get_num_slots(self) -> int:
+        """Maximum number of VMs that can hold a lease at once"""
+        return self.num_slots
+
+    def pick_port(self, base_port: int, slot: int) -> int:
+        """First free port at or above base_port + slot that no other lease holds. Stride by
+        num_slots so slots don't walk into each other's default ports."""
+        port = base_port + slot
+        while port in self.used_ports or not port_is_free(port):
+            port += self.num_slots
+        self.used_ports.add(port)
+        return port
+
+    def acquire(self, image_name: str, slot: int = None) -> QemuLease:
+        """Block until a slot is free and return a lease on it. image_name is the base
+        name of the output image, the returned lease holds a slot-unique variant of it.
+        - slot: wait for this specific slot (e.g. so separate processes on one host don't overlap)"""
+        if slot is not None and not 0 <= slot < self.num_slots:
+            raise ValueError(f"Slot {slot} out of range, host has {self.num_slots} slots")
+
+        with self.condition:
+            if slot is None:
+                while not self.free_slots:
+                    self.condition.wait()
+                slot = self.free_slots.pop(0)
+            else:
+                while slot not in self.free_slots:
+                    self.condition.wait()
+                self.free_slots.remove(slot)
+
+            root, ext = os.path.splitext(image_name)
+            lease = QemuLease(slot=slot,
+                              cores=self.core_sets[slot],
+                              ssh_port=self.pick_port(self.base_ssh_port, slot),
+                              gdb_port=self.pick_port(self.base_gdb_port, slot),
+                              aux_logfile_path=os.path.join(self.aux_log_dir, f"aux_logfile_slot{slot}.txt"),
+                              nbd_device=self.nbd_devices[slot],
+                              image_name=f"{root}-slot{slot}{ext}")
+        print(f"[QemuResourceAllocator] Leased slot {slot}: {lease}")
+        return lease
+
+    def release(self, lease: QemuLease):
+        """Return a lease's resources to the pool"""
+        with self.condition:
+            self.used_ports.discard(lease.ssh_port)
+            self.used_ports.discard(lease.gdb_port)
+            self.free_slots.append(lease.slot)
+            # notify_all, since a waiter for a specific slot may not be the one that can use it
+            self.condition.notify_all()
+        print(f"[QemuResourceAllocator] Released slot {lease.slot}")
+
+    @contextmanager
+    def lease(self, image_name: str):
+        """Context manager wrapper around acquire/release"""
+        lease = self.acquire(image_name)
+        try:
+            yield lease
+        finally:
+            self.release(lease)
+
+
+def kill_vm(process: subprocess.Popen):
+    """Kill a VM started by launch_kernel_raw. Killing just the launch script would leave QEMU running"""
+    if process.poll() is not None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        process.kill()
+    process.wait()
+
 
 # TODO add support for other architectures
-def launch_kernel_raw(arch: Arch, image_path: str, kernel_path: str=None, cmdline: str="", cdrom_path: str=None, redirect=True, aux_logfile_path: str=None) -> subprocess.Popen:
+def launch_kernel_raw(arch: Arch, image_path: str, kernel_path: str=None, cmdline: str="", cdrom_path: str=None, redirect=True, aux_logfile_path: str=None, lease: QemuLease=None, payload_path: str=None, boot_profile: str=BOOT_PROFILE_DEFAULT, agent_socket_path: str=None, records_path: str=None, warm_socket_path: str=None, qmp_socket_path: str=None, incoming_state_path: str=None, console: str=CONSOLE_SERIAL) -> subprocess.Popen:
     """Launch a kernel with QEMU
-    Redirect=true means we capture STDOUT and STDERR, if false let stdio interact"""
+    Redirect=true means we capture STDOUT and STDERR, if false let stdio interact
+    If a lease is given, the VM is pinned to its cores and uses its ports and aux log file
+    payload_path attaches a read-only payload disk (x86 custom kernel launches only)
+    boot_profile BOOT_PROFILE_FAST boots on microvm (x86 custom kernel launches only)
+    agent_socket_path exposes the guest agent port as a unix socket QEMU listens on (x86 custom kernel launches only)
+    records_path is where QEMU writes the results port (x86 custom kernel launches only)
+    warm_socket_path, qmp_socket_path expose the warm start port and QMP as unix sockets QEMU listens on,
+    incoming_state_path restores a saved migration stream instead of booting (x86 custom kernel launches only)
+    console CONSOLE_HVC adds a virtio console sharing stdio with the serial port (x86 custom kernel launches only)"""
+
+    if lease is not None and aux_logfile_path is None:
+        aux_logfile_path = lease.aux_logfile_path
+
+    # Launch scripts fall back to their hardcoded defaults without a lease
+    env = lease.launch_env() if lease is not None else None
+    if payload_path is not None:
+        if arch != Arch.X86 or kernel_path is None:
+            raise ValueError("Payload disks are only supported for x86 custom kernel launches")
+        if env is None:
+            env = os.environ.copy()
+        env["PAYLOAD_PATH"] = os.path.abspath(payload_path)
+    if agent_socket_path is not None:
+        if arch != Arch.X86 or kernel_path is None:
+            raise ValueError("The guest agent is only supported for x86 custom kernel launches")
+        if env is None:
+            env = os.environ.copy()
+        env["AGENT_SOCKET"] = os.path.abspath(agent_socket_path)
+    if records_path is not None:
+        if arch != Arch.X86 or kernel_path is None:
+            raise ValueError("The results port is only supported for x86 custom kernel launches")
+        if env is None:
+            env = os.environ.copy()
+        env["RECORDS_PATH"] = os.path.abspath(records_path)
+        # QEMU truncates it anyway, but a runner tailing it mustn't see the last boot's records first
+        if os.path.exists(records_path):
+            os.remove(records_path)
+    warm_env = {
+        "WARM_SOCKET": warm_socket_path and os.path.abspath(warm_socket_path),
+        "QMP_SOCKET": qmp_socket_path and os.path.abspath(qmp_socket_path),
+        "INCOMING_URI": incoming_state_path and "exec:cat " + shlex.quote(os.path.abspath(incoming_state_path)),
+    }
+    for name, value in warm_env.items():
+        if value is None:
+            continue
+        if arch != Arch.X86 or kernel_path is None:
+            raise ValueError("Warm start is only supported for x86 custom kernel launches")
+        if env is None:
+            env = os.environ.copy()
+        env[name] = value
+    if console not in KERNEL_CONSOLES:
+        raise ValueError(f"Unknown kernel console: {console}")
+    if console == CONSOLE_HVC:
+        if arch != Arch.X86 or kernel_path is None:
+            raise ValueError("The virtio console is only supported for x86 custom kernel launches")
+        if env is None:
+            env = os.environ.copy()
+        env["KERNEL_CONSOLE"] = console
+    if boot_profile not in BOOT_PROFILES:
+        raise ValueError(f"Unknown boot profile: {boot_profile}")
+    if boot_profile == BOOT_PROFILE_FAST and (arch != Arch.X86 or kernel_path is None):
+        raise ValueError("The fast boot profile is only supported for x86 custom kernel launches")
 
     # if aux logfile path is none, use default /tmp/aux_logfile.txt
     if aux_logfile_path is None:
@@ -35,7 +273,9 @@ def launch_kernel_raw(arch: Arch, image_path: str, kernel_path: str=None, cmdlin
         else:
             command = [ARM_UNMODIFIED, image_path]
     elif arch == Arch.X86:
-        if kernel_path is not None:
+        if boot_profile == BOOT_PROFILE_FAST:
+            command = [X86_MICROVM, image_path, kernel_path, aux_logfile_path]
+        elif kernel_path is not None:
             command = [X86_CUSTOM_KERNEL, image_path, kernel_path, aux_logfile_path]
         else:
             command = [X86_UNMODIFIED, image_path, aux_logfile_path]
@@ -57,15 +297,17 @@ def launch_kernel_raw(arch: Arch, image_path: str, kernel_path: str=None, cmdlin
     debug_pause("Running QEMU command", level=10)
 
     if (redirect):
+        # Own session, so kill_vm can take down QEMU along with the launch script that started it
         return subprocess.Popen(command,
                 stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
-                text=True, errors='backslashreplace')
+                text=True, errors='backslashreplace', env=env,
+                start_new_session=True)
     else:
         return subprocess.Popen(command, 
                         text=True, 
-                        errors='backslashreplace')
+                        errors='backslashreplace', env=env)
 
  
 
@@ -89,6 +331,13 @@ def qemu_img_resize(path: str, size_gb: int) -> ProcResult:
     return run_command_better(command, verbose=True)
 
 
+def qemu_img_create_overlay(path: str, backing_path: str, backing_format: str = "qcow2") -> ProcResult:
+    """Create a qcow2 image that only stores writes on top of backing_path (which must not change
+    while the overlay is in use). Only metadata is written, so this is near instant"""
+    command = ["qemu-img", "create", "-f", "qcow2", "-b", os.path.abspath(backing_path), "-F", backing_format, path]
+    return run_command_better(command, verbose=True)
+
+
 def qemu_nbd_disconnect(devname: str):
     """Disconnect a QEMU NBD device"""
     try:
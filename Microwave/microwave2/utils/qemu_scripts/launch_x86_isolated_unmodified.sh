@@ -24,7 +24,9 @@ fi
 
 # Uses -device and -blockdev combo rather than -drive to be more explicit
 # -device is what guest sees, -blockdev is how qemu processes data 
-CORESET="2,3,4,5"
+# CORESET and SSH_PORT can be overridden from the environment
+CORESET="${CORESET:-2,3,4,5}"
+SSH_PORT="${SSH_PORT:-2222}"
 
 echo "Booting image $IMAGE_PATH..."
 taskset -c $CORESET qemu-system-x86_64 \
@@ -38,7 +40,7 @@ taskset -c $CORESET qemu-system-x86_64 \
     -blockdev driver=file,node-name=hd_file,filename="$IMAGE_PATH" \
     -blockdev driver=qcow2,node-name=hd0,file=hd_file \
     -device virtio-net-pci,netdev=net1 \
-    -netdev user,id=net1,hostfwd=tcp::2222-:22 \
+    -netdev user,id=net1,hostfwd=tcp::$SSH_PORT-:22 \
     -serial mon:stdio $CDROM_ARGS \
     -chardev file,id=log0,path=$LOG_PATH \
     -device virtio-serial-pci,id=virtio-serial0 \
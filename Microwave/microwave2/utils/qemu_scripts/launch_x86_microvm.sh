@@ -0,0 +1,100 @@
+#!/bin/bash
+
+# Fast boot profile: boot a kernel on QEMU's microvm machine (no PCI, no firmware, virtio-mmio
+# devices only). KERNEL_PATH can be an uncompressed vmlinux with a PVH entry point (CONFIG_PVH),
+# which skips decompression, or a bzImage. The kernel needs CONFIG_VIRTIO_MMIO and
+# CONFIG_VIRTIO_MMIO_CMDLINE_DEVICES, QEMU appends the device list to the command line. Kernels
+# built for the fast profile get these merged in (FAST_BOOT_KCONFIG in qemu.py).
+
+IMAGE_PATH=$1
+KERNEL_PATH=$2
+LOG_PATH=$3
+KERNEL_ARGS="${*:4}"
+
+echo "IMAGE_PATH: $IMAGE_PATH"
+echo "KERNEL_PATH: $KERNEL_PATH"
+echo "LOG_PATH: $LOG_PATH"
+echo "KERNEL_ARGS: $KERNEL_ARGS"
+
+set -x
+
+if [ -z "$IMAGE_PATH" ] || [ -z "$KERNEL_PATH" ]; then
+    echo "Usage: $0 <path_to_image> <path_to_kernel> <log_path> <kernel_args>"
+    exit 1
+fi
+
+# Same overrides as launch_x86_isolated_custom_kernel.sh (see QemuResourceAllocator in qemu.py)
+CORESET="${CORESET:-2,3,4,5}"
+SSH_PORT="${SSH_PORT:-2223}"
+GDB_PORT="${GDB_PORT:-1234}"
+
+# Optional guest agent channel (see runners/agent_runner.py), QEMU listens on AGENT_SOCKET
+AGENT_ARGS=""
+if [ -n "$AGENT_SOCKET" ]; then
+    AGENT_ARGS="-chardev socket,id=agent0,path=$AGENT_SOCKET,server=on,wait=off -device virtserialport,chardev=agent0,name=agent-port,bus=virtio-serial0.0"
+fi
+
+# Optional results channel (see results/records.py), framed records are written to RECORDS_PATH
+RECORDS_ARGS=""
+if [ -n "$RECORDS_PATH" ]; then
+    RECORDS_ARGS="-chardev file,id=records0,path=$RECORDS_PATH -device virtserialport,chardev=records0,name=results-port,bus=virtio-serial0.0"
+fi
+
+# Optional warm start channels (see runners/warm_start.py): the warm port the guest waits on before
+# running anything, and QMP for the host to snapshot the VM. INCOMING_URI restores a snapshot
+WARM_ARGS=""
+if [ -n "$WARM_SOCKET" ]; then
+    WARM_ARGS="-chardev socket,id=warm0,path=$WARM_SOCKET,server=on,wait=off -device virtserialport,chardev=warm0,name=warm-port,bus=virtio-serial0.0"
+fi
+QMP_ARGS=""
+if [ -n "$QMP_SOCKET" ]; then
+    QMP_ARGS="-qmp unix:$QMP_SOCKET,server=on,wait=off"
+fi
+INCOMING_ARGS=()
+if [ -n "$INCOMING_URI" ]; then
+    INCOMING_ARGS=(-incoming "$INCOMING_URI")
+fi
+
+# Kernel console (see utils/console_policy.py): the serial port by default, or with KERNEL_CONSOLE=hvc a
+# virtio console (hvc0) sharing stdio with the serial port, which then only carries early boot output
+SERIAL_ARGS="-serial stdio"
+CONSOLE_ARGS=""
+if [ "$KERNEL_CONSOLE" = "hvc" ]; then
+    SERIAL_ARGS="-chardev stdio,id=con0,mux=on -serial chardev:con0"
+    CONSOLE_ARGS="-device virtconsole,chardev=con0,bus=virtio-serial0.0"
+fi
+
+PAYLOAD_ARGS=""
+if [ -n "$PAYLOAD_PATH" ]; then
+    PAYLOAD_ARGS="-device virtio-blk-device,drive=payload0 -blockdev driver=file,node-name=payload_file,filename=$PAYLOAD_PATH,read-only=on -blockdev driver=raw,node-name=payload0,file=payload_file,read-only=on"
+fi
+
+echo "Booting image $IMAGE_PATH (microvm, with kernel at $KERNEL_PATH)..."
+taskset -c $CORESET qemu-system-x86_64 \
+    -M microvm,x-option-roms=off,rtc=on,isa-serial=on,acpi=off \
+    -enable-kvm \
+    -nodefaults \
+    -nographic \
+    -no-reboot \
+    -m 8192 -mem-prealloc \
+    -cpu host \
+    -smp 8,sockets=1,cores=8,threads=1 \
+    -kernel $KERNEL_PATH \
+    -append "$KERNEL_ARGS" \
+    -device virtio-blk-device,drive=hd0 \
+    -blockdev driver=file,node-name=hd_file,filename="$IMAGE_PATH" \
+    -blockdev driver=qcow2,node-name=hd0,file=hd_file \
+    -device virtio-net-device,netdev=net1 \
+    -netdev user,id=net1,hostfwd=tcp::$SSH_PORT-:22 \
+    $SERIAL_ARGS \
+    -gdb tcp::$GDB_PORT \
+    -chardev file,id=log0,path=$LOG_PATH \
+    -device virtio-serial-device,id=virtio-serial0 \
+    -device virtserialport,chardev=log0,name=host-port,bus=virtio-serial0.0 \
+    $CONSOLE_ARGS \
+    $PAYLOAD_ARGS \
+    $AGENT_ARGS \
+    $RECORDS_ARGS \
+    $WARM_ARGS \
+    $QMP_ARGS \
+    "${INCOMING_ARGS[@]}"
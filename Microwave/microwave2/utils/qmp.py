@@ -0,0 +1,96 @@
+"""
+Minimal QMP (QEMU Machine Protocol) client, for a VM launched with QMP on a unix socket
+(qmp_socket_path in launch_kernel_raw). One JSON object per line each way.
+"""
+import json
+import shlex
+import socket
+import time
+
+from microwave2.utils.log import log, warn, error, debug, info
+
+
+class QmpError(Exception):
+    """QEMU refused a command, or the connection to it broke"""
+
+
+class QmpClient:
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self.sock = None
+        self.buf = b""
+
+    def connect(self, timeout: float = 30):
+        """Connect (QEMU creates the socket shortly after starting) and enter command mode"""
+        deadline = time.monotonic() + timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+                break
+            except OSError as e:
+                sock.close()
+                if time.monotonic() > deadline:
+                    raise QmpError(f"Couldn't connect to QMP socket {self.socket_path}: {e}")
+                time.sleep(0.05)
+        self.sock = sock
+        self.sock.settimeout(timeout)
+        # Greeting first, then capabilities negotiation
+        self.read_message()
+        self.execute("qmp_capabilities")
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def read_message(self) -> dict:
+        while b"\n" not in self.buf:
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                raise QmpError("Timed out waiting for QEMU")
+            if not data:
+                raise QmpError("QMP connection closed")
+            self.buf += data
+        line, self.buf = self.buf.split(b"\n", 1)
+        return json.loads(line)
+
+    def execute(self, command: str, arguments: dict = None) -> dict:
+        """Run a command, returns its "return" value"""
+        request = {"execute": command}
+        if arguments is not None:
+            request["arguments"] = arguments
+        self.sock.sendall((json.dumps(request) + "\n").encode())
+        while True:
+            message = self.read_message()
+            if "event" in message:
+                debug(f"[QmpClient] Event {message['event']}")
+                continue
+            if "error" in message:
+                raise QmpError(f"{command} failed: {message['error'].get('desc')}")
+            return message.get("return")
+
+    def wait_running(self, timeout: float):
+        """Wait for the VM to run, e.g. once an incoming migration has been loaded"""
+        deadline = time.monotonic() + timeout
+        while not self.execute("query-status").get("running"):
+            if time.monotonic() > deadline:
+                raise QmpError("VM never started running")
+            time.sleep(0.01)
+
+    def save_state(self, path: str, timeout: float = 300):
+        """Write the VM's state (RAM and devices, not disks) to path as a migration stream. The VM
+        is left paused with its disks flushed, "cont" resumes it"""
+        self.execute("migrate", {"uri": "exec:cat > " + shlex.quote(path)})
+        deadline = time.monotonic() + timeout
+        while True:
+            status = self.execute("query-migrate").get("status")
+            if status == "completed":
+                return
+            if status in ("failed", "cancelled"):
+                raise QmpError(f"Saving VM state to {path} {status}")
+            if time.monotonic() > deadline:
+                self.execute("migrate_cancel")
+                raise QmpError(f"Saving VM state to {path} timed out")
+            time.sleep(0.05)
@@ -14,6 +14,7 @@ import urllib.request
 from microwave2.results.result import Result, ProcResult
 
 from microwave2.utils.log import log, warn, error, debug, info
+from microwave2.utils.proc import get_supervisor, OUTCOME_EXITED, OUTCOME_FAILED_TO_START
 
 from tqdm import tqdm
 
@@ -222,84 +223,31 @@ def timed(func):
     return wrapper
 
 
-# Emulate subprocess communicate but also print stdout and stderr live
-# Assumes proc is already running
-def verbose_communicate(proc: subprocess.Popen):
-    
-    # Function to be launched in a thread, reads from stream, prints, and returns 
-    # list of lines read
-    def read_stream(stream, output_list):
-        while True:
-            line = stream.readline()
-            if not line:
-                break
-            debug(line, end='')
-            output_list.append(line)
-
-    stdout_lines = []
-    stderr_lines = []
-    debug("[verbose_communicate] Starting threads to read stdout and stderr")
-    # Start threads to read stdout and stderr
-    stdout_thread = threading.Thread(target=read_stream, args=(proc.stdout, stdout_lines))
-    stderr_thread = threading.Thread(target=read_stream, args=(proc.stderr, stderr_lines))
-    debug("[verbose_communicate] Starting threads")
-    stdout_thread.start()
-    stderr_thread.start()
-    debug("[verbose_communicate] Waiting for threads to finish")
-
-    # Wait for threads to finish
-    stdout_thread.join()
-    stderr_thread.join()
-    debug("[verbose_communicate] Threads finished")
-    # Convert lists to strings
-    stdout = ''.join(stdout_lines)
-    stderr = ''.join(stderr_lines)
-
-    return stdout, stderr
-
-
 # Takes in a command as a list of strings and runs it, returning a ProcResult
 # In verbose mode, also prints stdout and stderr live
+# Runs on the shared process supervisor (see proc.py), so no threads per command and cwd is per call
 # Should merge with run_command
-def run_command_better(command, verbose: bool = True, cwd :str =None) -> ProcResult:
+def run_command_better(command, verbose: bool = True, cwd :str =None, env: dict = None, timeout: float = None, tee_path: str = None) -> ProcResult:
     str_command = " ".join(command)
     if verbose:
         debug(f"[Command List]  {command}")
         info(f"[Command] {str_command}")
+        if cwd is not None:
+            info(f"[Command] In directory {cwd}")
 
-    # Switch to cwd if specified, save previous
-    prev_cwd = os.getcwd()
-    if cwd is not None:
-        info(f"[Command] Changing to directory {cwd}")
-        os.chdir(cwd)
-
-    try:
-        proc = subprocess.Popen(command,
-                    stderr=subprocess.PIPE,
-                    stdout=subprocess.PIPE,
-                    text=True,
-                    bufsize=1)
-      
-        if verbose:
-            stdout, stderr = verbose_communicate(proc)
-        else:
-            stdout, stderr = proc.communicate()
-
-        # Wait for process to finish (TODO necessary?)
-        info("[run_command_better] Waiting for process to finish")
-        proc.wait()
-        info("[run_command_better] Process finished")
+    on_line = None
+    if verbose:
+        on_line = lambda stream, line: debug(line)
 
-    except Exception as e:
+    # Stays in our session with our stdin, like before, so sudo can still prompt
+    result = get_supervisor().run(command, cwd=cwd, env=env, timeout=timeout, tee_path=tee_path,
+                                  on_line=on_line, own_group=False, stdin=None)
+    if result.outcome == OUTCOME_FAILED_TO_START:
         error("Failed to run command: {}".format(str_command))
-        error("Error: ", e)
-        os.chdir(prev_cwd)
-        return ProcResult(returncode=-1, stdout="", stderr="", error=e, message="Failed to run command: {}".format(str_command))
-
-
-
-    result = ProcResult(returncode=proc.returncode, stdout=stdout, stderr=stderr)
-    os.chdir(prev_cwd)
+        error("Error: ", result.error)
+        result.message = "Failed to run command: {}".format(str_command)
+    elif result.outcome != OUTCOME_EXITED:
+        warn(f"[run_command_better] {result.message}")
     return result
 
     # return result